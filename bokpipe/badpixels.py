@@ -16,13 +16,13 @@ bok_badcols = {
 }
 
 class BadPixelMaskFromFlats(BokProcess):
+	outputType = 'mask'
 	def __init__(self,**kwargs):
 		super(BadPixelMaskFromFlats,self).__init__(**kwargs)
 		kwargs.setdefault('header_key','BPMSK')
 		self.loCut,self.hiCut = kwargs.get('good_range',(0.90,1.10))
 		self.loCut2,self.hiCut2 = kwargs.get('grow_range',(0.95,1.05))
 		self.addBadCols = kwargs.get('add_bad_cols',True)
-		self.noConvert = True  # casting to unsigned int below
 	def process_hdu(self,extName,data,hdr):
 		im = np.ma.masked_array(data,mask=((data<0.5) | (data>1.5)))
 		# mask the edges
@@ -47,7 +47,7 @@ class BadPixelMaskFromFlats(BokProcess):
 				badpix[:,jj] |= True
 			except KeyError:
 				pass
-		return badpix.astype(np.uint8),hdr
+		return badpix,hdr
 
 def build_mask_from_flat(flatFile,bpMaskFile,outDir,**kwargs):
 	hdr = fitsio.read_header(flatFile,0)
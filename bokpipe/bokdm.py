@@ -135,6 +135,10 @@ class SimpleFileNameMap(FileNameMap):
 #####
 
 class BokCalibrator(object):
+	# loads the calibration images, can be replaced by a shared store
+	fitsLoader = FakeFITS
+	def setLoader(self,loader):
+		self.fitsLoader = loader
 	def setTarget(self,f):
 		raise NotImplementedError
 	def getImage(self,extn):
@@ -160,7 +164,7 @@ class MasterCalibrator(BokCalibrator):
 	def _load_fits(self):
 		if self.masterFits is None:
 			print 'Loading master cal ',os.path.basename(self.masterFile)
-			self.masterFits = FakeFITS(self.masterFile)
+			self.masterFits = self.fitsLoader(self.masterFile)
 	def setTarget(self,f):
 		pass
 	def getImage(self,extn):
@@ -214,7 +218,7 @@ class CalibratorMap(BokCalibrator):
 			if self.currentFits:
 				self.currentFits.close()
 			self.currentFile = cal
-			self.currentFits = FakeFITS(self.currentFile)
+			self.currentFits = self.fitsLoader(self.currentFile)
 			return True
 		return False
 	def getImage(self,extn):
@@ -241,7 +245,7 @@ class FringeMap(CalibratorMap):
 		changed = super(FringeMap,self).setTarget(f)
 		if changed:
 			if self.maskMap:
-				self.maskFits = FakeFITS(self.maskMap(f))
+				self.maskFits = FakeFITS(self.maskMap(f),mmap=True)
 			for extn in ['CCD%d' % i for i in range(1,5)]:
 				im = self.currentFits[extn]
 				mn,sig = array_stats(im[self.statsReg],method='median',
@@ -294,6 +298,7 @@ class BokDataManager(object):
 		self.firstStep = None
 		self.calDbFile = os.path.join(self.calDir,'caldb.pkl')
 		self.calMap = {}
+		self.calLoader = None
 		try:
 			self.calDb = load_caldb(self.calDbFile)
 			self._config_cals()
@@ -463,6 +468,17 @@ class BokDataManager(object):
 				                                     self.calNameMap)
 		else:
 			raise ValueError
+		if self.calLoader is not None:
+			self.calMap[calType].setLoader(self.calLoader)
+	def setCalibrationLoader(self,loader):
+		'''set the object used to load calibration images, e.g., a
+		   SharedCalibrationStore. loader=None restores the default.'''
+		self.calLoader = loader
+		for cal in self.calMap.values():
+			if loader is None:
+				cal.setLoader(FakeFITS)
+			else:
+				cal.setLoader(loader)
 	def getCalMap(self,calType):
 		return self.calMap[calType]
 	def getCalPath(self,calFn):
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
 import os
+import json
+import hashlib
+import pickle
+import shutil
 
 def IdentityNameMap(f):
 	return f
@@ -25,3 +29,176 @@ class FileNameMap(object):
 			fn = fn.replace('.fits',self.newSuffix+'.fits')
 		return os.path.join(newDir,fn)
 
+
+def file_signature(fileName):
+	'''(mtime,size) of a file, or None if it doesn't exist'''
+	try:
+		st = os.stat(fileName)
+	except OSError:
+		return None
+	return [st.st_mtime,st.st_size]
+
+def params_hash(params):
+	'''Hash the simple-valued (string, number, etc.) entries of a parameter
+	   dictionary, other values (maps, functions) are ignored.'''
+	simpleTypes = (basestring,int,long,float,bool,type(None))
+	def _simple(v):
+		if isinstance(v,(list,tuple)):
+			return all(_simple(_v) for _v in v)
+		return isinstance(v,simpleTypes)
+	simple = sorted( (k,v) for k,v in params.items() if _simple(v) )
+	return hashlib.md5(repr(simple)).hexdigest()
+
+class CompletionManifest(object):
+	'''Records which processing steps have completed in a small file kept
+	   in each output directory, so that finished outputs can be skipped
+	   without opening them. Each line is a JSON entry with the step name,
+	   the input file signature (mtime,size), a parameter hash, and the 
+	   output file and its signature after it was written. The file is only
+	   appended to, so it can be shared by multiple processes.
+	   An output is complete for a step if the chain of recorded steps that 
+	   have updated it in place since the step ran accounts for its current 
+	   signature.'''
+	manifestName = '.bokpipe_manifest'
+	def __init__(self):
+		self.entries = {}
+		self.offsets = {}
+	def _manifest_file(self,outputFile):
+		return os.path.join(os.path.dirname(os.path.abspath(outputFile)),
+		                    self.manifestName)
+	def _update(self,manifestFile):
+		# read any entries appended since the last read
+		entries = self.entries.setdefault(manifestFile,{})
+		offset = self.offsets.get(manifestFile,0)
+		try:
+			size = os.path.getsize(manifestFile)
+			if size == offset:
+				return entries
+			elif size < offset:
+				# manifest was removed and restarted
+				entries.clear()
+				offset = 0
+			with open(manifestFile) as mf:
+				mf.seek(offset)
+				for line in mf:
+					if not line.endswith('\n'):
+						# partially written entry
+						break
+					offset += len(line)
+					try:
+						entry = json.loads(line)
+					except ValueError:
+						continue
+					entries.setdefault(entry['output'],[]).append(entry)
+		except (IOError,OSError):
+			pass
+		self.offsets[manifestFile] = offset
+		return entries
+	@staticmethod
+	def _input_signature(inputFiles):
+		if isinstance(inputFiles,basestring):
+			return file_signature(inputFiles)
+		sigs = [ (os.path.basename(f),file_signature(f)) for f in inputFiles ]
+		return hashlib.md5(repr(sigs)).hexdigest()
+	def is_complete(self,step,inputFiles,outputFile,params=None):
+		'''True if the manifest says step already produced outputFile from 
+		   the current version of the input(s) with the same parameters.'''
+		manifestFile = self._manifest_file(outputFile)
+		if not os.path.exists(manifestFile):
+			return False
+		history = self._update(manifestFile).get(os.path.basename(outputFile))
+		sig = file_signature(outputFile)
+		if history is None or sig is None:
+			return False
+		# walk back through the steps that produced the current output
+		for entry in reversed(history):
+			if entry['outsig'] != sig:
+				# modified by something not in the manifest
+				return False
+			if entry['step'] == step:
+				if entry['params'] != params:
+					return False
+				return entry['inplace'] or \
+				        entry['insig'] == self._input_signature(inputFiles)
+			if not entry['inplace']:
+				# output was created by a different step after this one
+				return False
+			sig = entry['insig']
+		return False
+	def record(self,step,inputFiles,outputFile,params=None,inputSig=None):
+		'''Add an entry for outputFile, for in-place processing inputSig 
+		   should be the signature of the file before it was processed.'''
+		manifestFile = self._manifest_file(outputFile)
+		if inputSig is None:
+			inputSig = self._input_signature(inputFiles)
+		entry = {'step':step,'output':os.path.basename(outputFile),
+		         'inplace':inputFiles==outputFile,'insig':inputSig,
+		         'params':params,'outsig':file_signature(outputFile)}
+		try:
+			# single write of a complete line so that concurrent appends
+			# from other processes don't interleave
+			with open(manifestFile,'a') as mf:
+				mf.write(json.dumps(entry)+'\n')
+		except (IOError,OSError):
+			pass
+
+completionManifest = CompletionManifest()
+
+class StackCheckpoint(object):
+	'''A sidecar directory (<output>.ckpt) holding intermediate results of
+	   a stack, i.e., per-image norms and the finished extensions, so that
+	   an interrupted stack can be resumed. The checkpoint is tied to the
+	   input files (names and signatures) and stack parameters, and is 
+	   discarded if they change. Entries are pickled and written 
+	   atomically.'''
+	suffix = '.ckpt'
+	def __init__(self,outputFile,inputFiles,params=None):
+		self.dirName = outputFile + self.suffix
+		key = {'inputs':[ [f,file_signature(f)] for f in inputFiles ],
+		       'params':params}
+		keyFile = os.path.join(self.dirName,'key.json')
+		try:
+			with open(keyFile) as kf:
+				oldKey = json.load(kf)
+		except (IOError,OSError,ValueError):
+			oldKey = None
+		if oldKey != json.loads(json.dumps(key)):
+			self.clear()
+			os.makedirs(self.dirName)
+			with open(keyFile,'w') as kf:
+				json.dump(key,kf)
+	@classmethod
+	def exists(cls,outputFile):
+		return os.path.isdir(outputFile + cls.suffix)
+	def _path(self,name):
+		return os.path.join(self.dirName,name+'.pkl')
+	def has(self,name):
+		return os.path.exists(self._path(name))
+	def load(self,name):
+		try:
+			with open(self._path(name),'rb') as pf:
+				return pickle.load(pf)
+		except Exception:
+			# missing, truncated or otherwise unreadable (unpickling
+			# garbage can raise nearly anything)
+			return None
+	def save(self,name,obj):
+		tmpFile = self._path(name) + '.tmp'
+		with open(tmpFile,'wb') as pf:
+			pickle.dump(obj,pf,pickle.HIGHEST_PROTOCOL)
+		os.rename(tmpFile,self._path(name))
+	def remove(self,name):
+		try:
+			os.remove(self._path(name))
+		except OSError:
+			pass
+	def clear(self):
+		shutil.rmtree(self.dirName,True)
+
+class RollingStackState(StackCheckpoint):
+	'''The running sums of a rolling stack (<output>.roll), which persist
+	   as frames are added to and dropped from the stack. Only tied to the
+	   stack parameters.'''
+	suffix = '.roll'
+	def __init__(self,outputFile,params=None):
+		super(RollingStackState,self).__init__(outputFile,[],params)
@@ -5,10 +5,11 @@ import re
 from collections import OrderedDict
 import numpy as np
 from scipy.ndimage.filters import median_filter
-from scipy.interpolate import LSQUnivariateSpline
+from scipy.interpolate import splev
 import fitsio
 
-from .bokutil import BokProcess,array_clip,mask_saturation
+from .bokutil import BokProcess,array_clip,minmax_reject,mask_saturation,\
+                     masked_median,read_subset
 
 # argh
 ampOrder = [ 4,  3,  2,  1,  8,  7,  6,  5,  9, 10, 11, 12, 13, 14, 15, 16 ]
@@ -40,11 +41,83 @@ def extract_overscan(data,hdr):
 	data = data[y1:y2,x1:x2].astype(np.float32)
 	return ( data,overscan_cols,overscan_rows )
 
+def read_overscan(hdu):
+	'''Read only the overscan regions from a fitsio HDU for a single
+	   amplifier, as extracted by extract_overscan.
+	   Returns overscan_cols, overscan_rows
+	'''
+	hdr = hdu.read_header()
+	x1,x2,y1,y2 = _convertfitsreg(hdr['BIASSEC'])
+	overscan_cols = read_subset(hdu,np.s_[y1:y2,x1:x2]).astype(np.float32)
+	x1,x2,y1,y2 = _convertfitsreg(hdr['DATASEC'])
+	if hdr['NAXIS2'] > y2+1:
+		overscan_rows = read_subset(hdu,np.s_[y2:,:]).astype(np.float32)
+	else:
+		overscan_rows = None
+	return overscan_cols,overscan_rows
+
 oscan_fit_keywords = ['reject','method','apply_filter','filter_window',
-                      'mask_along','clip_iters','clip_sig',
+                      'mask_along','clip_iters','clip_sig','nlow','nhigh',
                       'spline_nknots','spline_niter']
 
-def fit_overscan(overscan,**kwargs):
+# cubic B-spline design matrices and their Gram matrices, by geometry
+_spline_bases = {}
+
+def spline_basis(npix,nknots):
+	'''The cubic B-spline design matrix for the overscan spline fits, 
+	   evaluated on pixels 0..npix-1 with nknots evenly spaced knots over
+	   [0,npix] (of which only the interior ones are used), and the Gram
+	   matrix B^T B. These only depend on the geometry and are cached.'''
+	key = (npix,nknots)
+	if key not in _spline_bases:
+		# the spline space on the pixel range is the same as the one
+		# LSQUnivariateSpline fits over the range of the unmasked pixels
+		# (all of the knots are interior), and its extrapolation beyond
+		# that range matches
+		knots = np.linspace(0,npix,nknots)[1:-1]
+		t = np.concatenate([[0]*4,knots,[npix-1]*4]).astype(np.float64)
+		nbasis = len(t) - 4
+		x = np.arange(npix)
+		B = np.empty((npix,nbasis))
+		for j in range(nbasis):
+			c = np.zeros(len(t))
+			c[j] = 1
+			B[:,j] = splev(x,(t,c,3))
+		_spline_bases[key] = (B,np.dot(B.T,B))
+	return _spline_bases[key]
+
+def _fit_splines(oscanvecs,nknots,niter):
+	# least-squares cubic spline fits to a stack of (masked) vectors, with
+	# the points that are outliers from the fit rejected for niter 
+	# iterations. The normal equations for each vector are the cached 
+	# Gram matrix less the contributions of its masked points.
+	nvec,npix = oscanvecs.shape
+	B,gram = spline_basis(npix,nknots)
+	y = oscanvecs.data.astype(np.float64)
+	mask = np.ma.getmaskarray(oscanvecs).copy()
+	oscan_fit = np.empty((nvec,npix))
+	active = np.ones(nvec,dtype=bool)
+	for iternum in range(niter):
+		ii = np.where(active)[0]
+		if len(ii) == 0:
+			break
+		m = mask[ii]
+		G = gram - np.einsum('ij,aj,jk->aik',B.T,m.astype(np.float64),B)
+		rhs = np.einsum('ij,aj->ai',B.T,np.where(m,0,y[ii]))
+		coeffs = np.linalg.solve(G,rhs[...,np.newaxis])[...,0]
+		oscan_fit[ii] = np.dot(coeffs,B.T)
+		res = array_clip(np.ma.masked_array(y[ii]-oscan_fit[ii],mask=m),
+		                 axis=1)
+		done = np.all(res.mask==m,axis=1)
+		active[ii[done]] = False
+		mask[ii[~done]] |= res.mask[~done]
+	return oscan_fit
+
+def fit_overscan_batch(overscans,**kwargs):
+	'''Fit a stack of overscan strips with the same shape (e.g., from all 
+	   of the amplifiers), as fit_overscan does for a single strip but with
+	   the rejection, collapse and filtering done on the whole stack.
+	   Returns an array of overscan vectors.'''
 	reject = kwargs.get('reject','sigma_clip')
 	method = kwargs.get('method','mean')
 	applyFilter = kwargs.get('apply_filter','median')
@@ -55,117 +128,191 @@ def fit_overscan(overscan,**kwargs):
 	spline_niter = kwargs.get('spline_niter',2)
 	if along == 'rows':
 		# make it look like a column overscan for simplicity
-		overscan = overscan.transpose()
-	npix = overscan.shape[0]
+		overscans = overscans.transpose(0,2,1)
+	nstrip,npix = overscans.shape[:2]
 	#
-	overscan = np.ma.masked_array(overscan)
-	overscan[:,maskAlong] = np.ma.masked
+	overscan = np.ma.masked_array(overscans)
+	overscan[:,:,maskAlong] = np.ma.masked
 	if along == 'rows':
 		# really the columns that need to be masked, but doesn't hurt to
 		# mask the edge rows above as well
-		overscan[maskAlong,:] = np.ma.masked
+		overscan[:,maskAlong,:] = np.ma.masked
 	# reject outlier values perpendicular to overscan axis
 	if reject == 'sigma_clip':
-		overscan = array_clip(overscan,axis=1,**kwargs)
+		overscan = array_clip(overscan,axis=2,**kwargs)
 	elif reject == 'minmax':
-		overscan[:,overscan.argmax(axis=1)] = np.ma.masked
-		overscan[:,overscan.argmin(axis=1)] = np.ma.masked
+		overscan.mask = minmax_reject(overscan.data,overscan.mask,axis=2,
+		                              nlow=kwargs.get('nlow',1),
+		                              nhigh=kwargs.get('nhigh',1))
 	# identify outliers along overscan vector (i.e., due to bleed trails
 	#   of saturated stars)
 	if True:
-		overscan = array_clip(overscan,axis=0,
+		overscan = array_clip(overscan,axis=1,
 		                      clip_iters=None,clip_sig=3.5,
 		                      clip_cenfunc=np.ma.median)
 	# collapse overscan into scalar or vector
 	if method == 'mean':
-		oscan_fit = overscan.mean(axis=1)
+		oscan_fit = overscan.mean(axis=2)
 	elif method == 'mean_value':
-		oscan_fit = np.repeat(overscan.mean(),npix)
+		oscan_fit = overscan.reshape(nstrip,-1).mean(axis=1)
+		oscan_fit = np.repeat(oscan_fit.filled(np.nan)[:,np.newaxis],
+		                      npix,axis=1)
 	elif method == 'median_value':
-		oscan_fit = np.repeat(np.ma.median(overscan),npix)
+		oscan_fit = masked_median(overscan.reshape(nstrip,-1),axis=1)
+		oscan_fit = np.repeat(oscan_fit.filled(np.nan)[:,np.newaxis],
+		                      npix,axis=1)
 	elif method == 'cubic_spline':
-		# LSQUnivariateSpline only wants the interior knots
-		knots = np.linspace(0,npix,spline_nknots)[1:-1]
-		oscanvec = overscan.mean(axis=1)
-		x = np.arange(npix)
-		for iternum in range(spline_niter):
-			g = ~oscanvec.mask
-			spl_fit = LSQUnivariateSpline(x[g],oscanvec.data[g],t=knots)
-			oscan_fit = spl_fit(x)
-			res = array_clip(oscanvec-oscan_fit)
-			if np.all(res.mask==oscanvec.mask):
-				break
-			oscanvec.mask |= res.mask
+		oscanvecs = overscan.mean(axis=2)
+		oscan_fit = _fit_splines(oscanvecs,spline_nknots,spline_niter)
 	else:
 		raise ValueError
 	if 'value' not in method and 'spline' not in method:
 		# another round of rejection, this time along the vector
-		oscan_fit = array_clip(oscan_fit,axis=0,
+		oscan_fit = array_clip(oscan_fit,axis=1,
 		                       clip_iters=None,clip_sig=3.0,
 		                       clip_cenfunc=np.ma.mean)
 		# fill any vector elements that were rejected as outliers
-		oscan_fit = oscan_fit.filled(np.ma.median(oscan_fit))
+		fillval = masked_median(oscan_fit,axis=1).filled(np.nan)
+		oscan_fit = np.where(np.ma.getmaskarray(oscan_fit),
+		                     fillval[:,np.newaxis],oscan_fit.data)
 		# smoothing filter along overscan vector
 		if applyFilter == 'median':
-			oscan_fit = median_filter(oscan_fit,windowSize)
+			oscan_fit = median_filter(oscan_fit,(1,windowSize))
 	return oscan_fit
 
-def overscan_subtract(data,hdr,returnFull=False,row_kwargs=None,**kwargs):
-	data,oscan_cols,oscan_rows = extract_overscan(data,hdr)
-	colbias = fit_overscan(oscan_cols,**kwargs)
-	data[:] -= colbias[:,np.newaxis]
-	if oscan_rows is not None:
+def fit_overscan(overscan,**kwargs):
+	return fit_overscan_batch(overscan[np.newaxis],**kwargs)[0]
+
+def _fit_overscans(overscans,**kwargs):
+	# apply fit_overscan_batch to each group of strips with the same shape
+	fits = [None]*len(overscans)
+	groups = OrderedDict()
+	for i,overscan in enumerate(overscans):
+		groups.setdefault(overscan.shape,[]).append(i)
+	for ii in groups.values():
+		batchFits = fit_overscan_batch(np.array([ overscans[i] for i in ii ]),
+		                               **kwargs)
+		for i,oscan_fit in zip(ii,batchFits):
+			fits[i] = oscan_fit
+	return fits
+
+def fit_overscans(overscans,row_kwargs=None,**kwargs):
+	'''Fit the overscans of a set of amplifiers together, given a list of
+	   (overscan_cols,overscan_rows) as returned by extract_overscan.
+	   Returns a list of (colbias,overscan_rows,rowbias) where the overscan
+	   rows have had the column bias removed.'''
+	colbias = _fit_overscans([ oscan_cols for oscan_cols,_ in overscans ],
+	                         **kwargs)
+	oscan_rows = [ rows for _,rows in overscans ]
+	rowbias = [None]*len(overscans)
+	ii = [ i for i,rows in enumerate(oscan_rows) if rows is not None ]
+	if len(ii) > 0:
 		# first fit and then subtract the overscan columns at the
 		# end of the strip of overscan rows
 		# XXX hardcoded geometry
-		_colbias = fit_overscan(oscan_rows[:,-20:],**kwargs)
-		oscan_rows = oscan_rows[:,:-20] - _colbias[:,np.newaxis]
+		_colbias = _fit_overscans([ oscan_rows[i][:,-20:] for i in ii ],
+		                          **kwargs)
+		for i,_cb in zip(ii,_colbias):
+			oscan_rows[i] = oscan_rows[i][:,:-20] - _cb[:,np.newaxis]
 		# now fit and subtract the overscan rows
 		if row_kwargs is None: 
 			row_kwargs = {'method':'cubic_spline'}
-		rowbias = fit_overscan(oscan_rows,along='rows',**row_kwargs)
+		_rowbias = _fit_overscans([ oscan_rows[i] for i in ii ],
+		                          along='rows',**row_kwargs)
+		for i,_rb in zip(ii,_rowbias):
+			rowbias[i] = _rb
+	return zip(colbias,oscan_rows,rowbias)
+
+def overscan_subtract(data,hdr,returnFull=False,row_kwargs=None,
+                      oscan_fit=None,**kwargs):
+	'''Trim the overscan from an amplifier image and subtract the overscan
+	   fits. oscan_fit can be given as an entry from fit_overscans to use
+	   fits already computed for this amplifier.'''
+	data,oscan_cols,oscan_rows = extract_overscan(data,hdr)
+	if oscan_fit is None:
+		oscan_fit, = fit_overscans([(oscan_cols,oscan_rows)],row_kwargs,
+		                           **kwargs)
+	colbias,oscan_rows,rowbias = oscan_fit
+	data[:] -= colbias[:,np.newaxis]
+	if rowbias is not None:
 		data[:] -= rowbias[np.newaxis,:data.shape[1]]
-	else:
-		rowbias = None
 	if returnFull:
 		return data,oscan_cols,oscan_rows,colbias,rowbias
 	else:
 		return data
 
 class OverscanCollection(object):
+	'''Collects the overscan strips of one extension from a series of 
+	   images, along with the residuals from the overscan fits, and writes
+	   them into a FITS image with the strips side-by-side (columns) or
+	   stacked (rows). The strips are written into memory-mapped arrays 
+	   that grow in blocks of strips, and the image is written to FITS in
+	   row blocks, so the collection is never held in memory.'''
+	# number of strips to add each time the arrays need to grow
+	blockSize = 64
+	# approximate size of the row blocks written to the FITS image
+	writeBytes = 64*1024**2
 	def __init__(self,oscanImgFile,along='columns'):
 		self.along = along
 		self.imgFile = oscanImgFile
-		if along=='columns':
-			self.arr_stack = np.hstack
-		else:
-			self.arr_stack = np.vstack
-		self.tmpfn1 = oscanImgFile+'_oscantmp.npy'
-		self.tmpfn2 = oscanImgFile+'_restmp.npy'
-		if os.path.exists(self.tmpfn1):
-			os.unlink(self.tmpfn1)
-		if os.path.exists(self.tmpfn2):
-			os.unlink(self.tmpfn2)
-		self.tmpOscanImgFile = open(self.tmpfn1,'ab')
-		self.tmpOscanResImgFile = open(self.tmpfn2,'ab')
+		self.tmpfn1 = oscanImgFile+'_oscantmp.dat'
+		self.tmpfn2 = oscanImgFile+'_restmp.dat'
+		for fn in [self.tmpfn1,self.tmpfn2]:
+			if os.path.exists(fn):
+				os.unlink(fn)
+		self.oscanArr = None
+		self.resArr = None
 		self.files = []
 	def close(self):
-		os.unlink(self.tmpfn1)
-		os.unlink(self.tmpfn2)
+		self.oscanArr = self.resArr = None
+		for fn in [self.tmpfn1,self.tmpfn2]:
+			if os.path.exists(fn):
+				os.unlink(fn)
+	def _map(self,fileName,nstrip,shape):
+		# extend the file as needed and map it as (nstrip,nrows,ncols)
+		nbytes = nstrip * shape[0] * shape[1] * 4
+		with open(fileName,'ab') as f:
+			f.truncate(nbytes)
+		return np.memmap(fileName,dtype=np.float32,mode='r+',
+		                 shape=(nstrip,)+shape)
 	def append(self,oscan,oscanFit,fileName):
 		if self.along=='columns':
 			resim = (oscan - oscanFit[:,np.newaxis]).astype(np.float32)
 		else:
 			resim = (oscan - oscanFit[np.newaxis,:]).astype(np.float32)
-		try:
-			np.save(self.tmpOscanImgFile,oscan.filled(np.nan))
-		except:
-			np.save(self.tmpOscanImgFile,oscan)
-		np.save(self.tmpOscanResImgFile,resim)
+		n = len(self.files)
+		if self.oscanArr is None or n == len(self.oscanArr):
+			if self.oscanArr is not None:
+				self.oscanArr.flush()
+				self.resArr.flush()
+			nstrip = n + self.blockSize
+			self.oscanArr = self._map(self.tmpfn1,nstrip,resim.shape)
+			self.resArr = self._map(self.tmpfn2,nstrip,resim.shape)
+		elif resim.shape != self.oscanArr.shape[1:]:
+			raise ValueError('overscan shape %s does not match %s' %
+			                 (resim.shape,self.oscanArr.shape[1:]))
+		self.oscanArr[n] = np.ma.filled(oscan,np.nan)
+		self.resArr[n] = resim
 		self.files.append(os.path.basename(fileName))
+	def _write_array(self,fits,arr,hdr=None):
+		nfiles,nrows,ncols = arr.shape
+		if self.along=='columns':
+			dims = [nrows,nfiles*ncols]
+		else:
+			dims = [nfiles*nrows,ncols]
+		fits.create_image_hdu(dims=dims,dtype='f4')
+		if hdr is not None:
+			fits[-1].write_keys(hdr)
+		nblock = max(1,self.writeBytes // (4*dims[1]))
+		for i in range(0,dims[0],nblock):
+			if self.along=='columns':
+				# the strips are side-by-side in each row
+				block = arr[:,i:i+nblock].transpose(1,0,2)
+				block = block.reshape(-1,dims[1])
+			else:
+				block = arr.reshape(dims)[i:i+nblock]
+			fits[-1].write(np.ascontiguousarray(block),start=[i,0])
 	def write_image(self):
-		self.tmpOscanImgFile.close() # could just reset file pointer?
-		self.tmpOscanResImgFile.close()
 		nfiles = len(self.files)
 		if nfiles==0:
 			return
@@ -173,23 +320,23 @@ class OverscanCollection(object):
 		hdr['NOVSCAN'] = nfiles
 		for n,f in enumerate(self.files,start=1):
 			hdr['OVSCN%03d'%n] = f
-		f1 = open(self.tmpfn1,'rb')
-		oscanImg = self.arr_stack([np.load(f1) for i in range(nfiles)])
-		f1.close()
-		f2 = open(self.tmpfn2,'rb')
-		oscanResImg = self.arr_stack([np.load(f2) for i in range(nfiles)])
-		f2.close()
+		self.oscanArr.flush()
+		self.resArr.flush()
 		if os.path.exists(self.imgFile+'.fits'):
 			os.unlink(self.imgFile+'.fits')
 		oscanFits = fitsio.FITS(self.imgFile+'.fits','rw')
-		oscanFits.write(oscanImg,header=hdr)
-		oscanFits.write(oscanResImg,clobber=False)
+		self._write_array(oscanFits,self.oscanArr[:nfiles],hdr)
+		self._write_array(oscanFits,self.resArr[:nfiles])
 		oscanFits.close()
 	def n_images(self):
 		return len(self.files)
 
 class BokOverscanSubtract(BokProcess):
 	_procMsg = 'overscan subtracting %s'
+	outputType = 'oscan'
+	# fit the overscans of all of the amplifiers together before the 
+	# images are processed, reading only the overscan regions
+	batchFit = True
 	def __init__(self,**kwargs):
 		kwargs.setdefault('header_key','OSCNSUB')
 		super(BokOverscanSubtract,self).__init__(**kwargs)
@@ -205,6 +352,7 @@ class BokOverscanSubtract(BokProcess):
 		self.oscanColsImgFile = kwargs.get('oscan_cols_file')
 		self.oscanRowsImgFile = kwargs.get('oscan_rows_file')
 		self.curFileName = None
+		self.oscanFits = {}
 		self._init_oscan_images()
 	def _init_oscan_images(self):
 		if self.writeOscanImg:
@@ -230,10 +378,17 @@ class BokOverscanSubtract(BokProcess):
 	def _preprocess(self,fits,f):
 		super(BokOverscanSubtract,self)._preprocess(fits,f)
 		self.curFileName = fits.fileName
+		if self.batchFit:
+			overscans = [ read_overscan(fits.fits[extn]) 
+			                for extn in fits.extensions ]
+			oscanFits = fit_overscans(overscans,self.row_fit_kwargs,
+			                          **self.fit_kwargs)
+			self.oscanFits = dict(zip(fits.extensions,oscanFits))
 	def process_hdu(self,extName,data,hdr):
 		data,oscan_cols,oscan_rows,colbias,rowbias = \
 		         overscan_subtract(data,hdr,returnFull=True,
 		                           row_kwargs=self.row_fit_kwargs,
+		                           oscan_fit=self.oscanFits.pop(extName,None),
 		                           **self.fit_kwargs)
 		# write the output file
 		hdr['OSCANSUB'] = 'method=%s' % self.fit_kwargs.get('method','default')
@@ -253,6 +408,8 @@ class BokOverscanSubtract(BokProcess):
 		self._finish_oscan_images()
 
 class BokOverscanSubtractWithSatFix(BokOverscanSubtract):
+	# the saturation fix can change the overscan regions
+	batchFit = False
 	def process_hdu(self,extName,data,hdr):
 		data,mask = mask_saturation(extName,data)
 		return super(BokOverscanSubtractWithSatFix,self).process_hdu(extName,
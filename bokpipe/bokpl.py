@@ -38,7 +38,7 @@ def makeccd4image(dataMap,inputFile,outputFile=None,**kwargs):
 		ccd4map = lambda f: outputFile
 	bokproc.combine_ccds([inputFile,],output_map=ccd4map,**kwargs)
 
-def overscan_subtract(dataMap,fixsaturation=False,header_fixes={},**kwargs):
+def _overscan_process(dataMap,fixsaturation=False,header_fixes={},**kwargs):
 	if fixsaturation:
 		oscanSubtract = BokOverscanSubtractWithSatFix(input_map=dataMap('raw'),
 	                                        output_map=dataMap('oscan'),
@@ -49,7 +49,26 @@ def overscan_subtract(dataMap,fixsaturation=False,header_fixes={},**kwargs):
 	                                        output_map=dataMap('oscan'),
 	                                        header_fixes=header_fixes,
 	                                        **kwargs)
-	oscanSubtract.process_files(dataMap.getFiles())
+	return oscanSubtract
+
+def overscan_subtract(dataMap,fixsaturation=False,header_fixes={},
+                      noobject=False,**kwargs):
+	oscanSubtract = _overscan_process(dataMap,fixsaturation,header_fixes,
+	                                  **kwargs)
+	if noobject:
+		# object frames are overscan subtracted within the fused chain
+		fileFilter = dataMap.fileFilter
+		def filterFun(obsDb,ii):
+			rv = obsDb['imType'][ii] != 'object'
+			if fileFilter:
+				rv &= fileFilter(obsDb,ii)
+			return rv
+		files = dataMap.getFiles(filterFun=filterFun)
+	else:
+		files = dataMap.getFiles()
+	if files is None or len(files)==0:
+		return
+	oscanSubtract.process_files(files)
 
 def _bias_worker(dataMap,biasStack,nSkip,writeccdim,biasIn,**kwargs):
 	biasFile,biasList = biasIn
@@ -260,7 +279,8 @@ def files_by_utdfilt(dataMap,imType='object',filt=None):
 
 def process_all(dataMap,nobiascorr=False,noflatcorr=False,
                 fixpix=False,rampcorr=False,noweightmap=False,
-                nocombine=False,prockey='CCDPROC',**kwargs):
+                nocombine=False,prockey='CCDPROC',fused=False,
+                fixsaturation=False,header_fixes={},**kwargs):
 	# 0. before processing, generate data quality masks: the badpix mask is
 	#    updated to include saturated pixels and regions around bright stars
 	#    are flagged.
@@ -284,8 +304,20 @@ def process_all(dataMap,nobiascorr=False,noflatcorr=False,
 	files,filesUtdFilt = files_by_utdfilt(dataMap)
 	if files is None or len(files)==0:
 		return
-	dqMask.process_files(files)
-	proc.process_files(filesUtdFilt)
+	if fused:
+		# overscan subtraction, data quality masks, and ccdproc are applied
+		# to each raw image in memory, skipping the intermediate files
+		oscan = _overscan_process(dataMap,fixsaturation,header_fixes,
+		                          **kwargs)
+		chain = bokutil.BokProcessChain([oscan,dqMask,proc],
+		                                input_map=dataMap('raw'),
+		                                output_map=dataMap('proc1'),
+		                                header_fixes=header_fixes,
+		                                **kwargs)
+		chain.process_files(filesUtdFilt)
+	else:
+		dqMask.process_files(files)
+		proc.process_files(filesUtdFilt)
 	if nocombine:
 		return
 	# 2. balance gains using background counts
@@ -369,7 +401,8 @@ def make_illumcorr_image(dataMap,byUtd=True,filterFun=None,
 		illum.write(outFn,opfun=normFun,clobber=True)
 
 def make_fringe_masters(dataMap,byUtd=False,
-                        min_images=10,max_images=None,**kwargs):
+                        min_images=10,max_images=None,rolling=False,
+                        **kwargs):
 	caldir = dataMap.getCalDir()
 	stackin = dataMap('fringe') # XXX
 	fringeStack = bokproc.BokFringePatternStack(input_map=stackin,
@@ -377,6 +410,7 @@ def make_fringe_masters(dataMap,byUtd=False,
 	                                            mask_type='nonzero',
 	                       raw_stack_file=bokio.FileNameMap(caldir,'_raw'),
 	                                        header_bad_key='BADSKY',
+	                                            rolling=rolling,
 	                                            **kwargs)
 	fringeStack.set_badpixelmask(dataMap.getCalMap('badpix4'))
 	if byUtd:
@@ -391,7 +425,8 @@ def make_fringe_masters(dataMap,byUtd=False,
 			outfn = dataMap.storeCalibrator('fringe',frames)
 			fringeStack.stack(files,outfn)
 
-def make_supersky_flats(dataMap,byUtd=False,interpFill=True,**kwargs):
+def make_supersky_flats(dataMap,byUtd=False,interpFill=True,rolling=False,
+                        **kwargs):
 	caldir = dataMap.getCalDir()
 	stackin = dataMap('sky') # XXX
 	statsReg = bokutil.stats_region(None,16)
@@ -401,6 +436,7 @@ def make_supersky_flats(dataMap,byUtd=False,interpFill=True,**kwargs):
 	                                            mask_map=dataMap('skymask'),
 	                    exposure_time_map=bokio.FileNameMap(caldir,'.exp'),
 	                                        header_bad_key='BADSKY',
+	                                            rolling=rolling,
 	                                            **kwargs)
 	skyFlatStack.set_badpixelmask(dataMap.getCalMap('badpix4'))
 	if byUtd:
@@ -420,7 +456,7 @@ def make_supersky_flats(dataMap,byUtd=False,interpFill=True,**kwargs):
 			                           output_file=outfn,
 			                           mask_file=dataMap.getCalMap('badpix4'))
 			expMapFn = bokio.FileNameMap(caldir,'.exp')(_outfn)
-			expFits = bokutil.FakeFITS(expMapFn)
+			expFits = bokutil.FakeFITS(expMapFn,mmap=True)
 			mask = {}
 			for ccd,data,hdr in fits:
 				expim = expFits[ccd]
@@ -446,7 +482,8 @@ def make_supersky_flats(dataMap,byUtd=False,interpFill=True,**kwargs):
 def process_all2(dataMap,skyArgs,noillumcorr=False,noskyflatcorr=False,
                  nofringecorr=False,noskysub=False,noweightmap=False,
                  prockey='CCDPRO2',redoskymask=False,save_sky=False,
-                 divide_exptime=True,**kwargs):
+                 divide_exptime=True,compress_sky=None,compress_qlevel=None,
+                 **kwargs):
 	#
 	# Second round: illumination, fringe, and skyflat corrections
 	#
@@ -506,6 +543,8 @@ def process_all2(dataMap,skyArgs,noillumcorr=False,noskyflatcorr=False,
 	                                output_map=dataMap('sky'),
 	                                mask_map=dataMap('skymask'),
 	                                skyfit_map=skyfitmap,
+	                                compress=compress_sky,
+	                                compress_qlevel=compress_qlevel,
 	                                **dict(skyArgs.items()+kwargs.items()))
 	skySub.add_mask(dataMap.getCalMap('badpix4'))
 	skySub.process_files(files)
@@ -595,85 +634,108 @@ def bokpipe(dataMap,**kwargs):
 	# fixpix is sticking nan's into the images in unmasked pixels (???)
 	fixpix = False #True
 	writeccdims = kwargs.get('calccdims',False)
-	timerLog = bokutil.TimerLog()
-	biasMap = None
-	if 'oscan' in steps:
-		overscan_subtract(dataMap,
-		                  fixsaturation=kwargs.get('fixsaturation'),
-		                  header_fixes=kwargs.get('header_fixes',{}),
-		                  **pipekwargs)
-		timerLog('overscans')
-	if 'bias2d' in steps:
-		make_2d_biases(dataMap,writeccdim=writeccdims,
-		               delete_files=not kwargs.get('keepcalims',False),
-		               **pipekwargs)
-		timerLog('2d biases')
-	if 'flat2d' in steps:
-		make_dome_flats(dataMap,writeccdim=writeccdims,
-		                nobiascorr=kwargs.get('nobiascorr',False),
-		                usepixflat=not kwargs.get('nousepixflat',False),
-		                maxflatcounts=kwargs.get('maxflatcounts'),
-		                delete_files=not kwargs.get('keepcalims',False),
-		                **pipekwargs)
-		timerLog('dome flats')
-	if 'ramp' in steps:
-		make_rampcorr_image(dataMap,**pipekwargs)
-		timerLog('ramp correction')
-	if 'proc1' in steps or 'comb' in steps:
-		process_all(dataMap,
-		            nobiascorr=kwargs.get('nobiascorr',False),
-		            noflatcorr=kwargs.get('noflatcorr',False),
-		            fixpix=fixpix,
-		            rampcorr=kwargs.get('rampcorr',False),
-		            nocombine=kwargs.get('nocombine',False),
-		            gain_multiply=not kwargs.get('nogainmul',False),
-		            nosavegain=kwargs.get('nosavegain',False),
-		            noweightmap=kwargs.get('noweightmap',False),
-		            prockey=kwargs.get('prockey','CCDPROC'),
-		            **pipekwargs)
-		timerLog('ccdproc')
-	if 'illum' in steps:
-		make_illumcorr_image(dataMap,
-		                     filterFun=kwargs.get('illum_filter_fun'),
-		                     **pipekwargs)
-		timerLog('illumination corr')
-	if 'fringe' in steps:
-		make_fringe_masters(dataMap,
-		                    byUtd=not kwargs.get('masterfringe'),
-		                    **pipekwargs)
-		timerLog('fringe masters')
-	if 'skyflat' in steps:
-		make_supersky_flats(dataMap,
-		                    byUtd=not kwargs.get('masterskyflat'),
-		                    **pipekwargs)
-		timerLog('supersky flats')
-	if 'proc2' in steps:
-		skyArgs = { k.lstrip('sky'):kwargs[k] 
-		                 for k in ['skymethod','skyorder']}
-		process_all2(dataMap,skyArgs,
-		             noillumcorr=kwargs.get('noillumcorr'),
-		             nofringecorr=kwargs.get('nofringecorr'),
-		             noskyflatcorr=kwargs.get('noskyflatcorr'),
-		             noweightmap=kwargs.get('noweightmap'),
-		             noskysub=kwargs.get('noskysub'),
-		             prockey=kwargs.get('prockey','CCDPRO2'),
-		             redoskymask=kwargs.get('redoskymask'),
-		             save_sky=kwargs.get('savesky'),
-		             divide_exptime=(not kwargs.get('nodivideexptime',False)),
-		             **pipekwargs)
-		timerLog('process2')
-	if 'wcs' in steps:
-		set_wcs(dataMap,
-		        savewcs=kwargs.get('savewcs',False),
-		        keepwcscat=kwargs.get('keepwcscat',True),
-		        **pipekwargs)
-		timerLog('wcs')
-	if 'cat' in steps:
-		make_catalogs(dataMap,**pipekwargs)
-		timerLog('catalog')
-	timerLog.dump()
-	if processes > 1:
-		pool.close()
+	if kwargs.get('shmcals',False):
+		# load each calibration image once into shared memory rather than
+		# separately in each subprocess
+		calStore = bokutil.SharedCalibrationStore(
+		                              maxGB=kwargs.get('shmcalsmaxmem',4))
+		dataMap.setCalibrationLoader(calStore)
+	else:
+		calStore = None
+	try:
+		timerLog = bokutil.TimerLog()
+		biasMap = None
+		fused = kwargs.get('fused',False) and 'proc1' in steps
+		if 'oscan' in steps:
+			overscan_subtract(dataMap,
+			                  fixsaturation=kwargs.get('fixsaturation'),
+			                  header_fixes=kwargs.get('header_fixes',{}),
+			                  noobject=fused,
+			                  **pipekwargs)
+			timerLog('overscans')
+		if 'bias2d' in steps:
+			make_2d_biases(dataMap,writeccdim=writeccdims,
+			               delete_files=not kwargs.get('keepcalims',False),
+			               **pipekwargs)
+			timerLog('2d biases')
+		if 'flat2d' in steps:
+			make_dome_flats(dataMap,writeccdim=writeccdims,
+			                nobiascorr=kwargs.get('nobiascorr',False),
+			                usepixflat=not kwargs.get('nousepixflat',False),
+			                maxflatcounts=kwargs.get('maxflatcounts'),
+			                delete_files=not kwargs.get('keepcalims',False),
+			                **pipekwargs)
+			timerLog('dome flats')
+		if 'ramp' in steps:
+			make_rampcorr_image(dataMap,**pipekwargs)
+			timerLog('ramp correction')
+		if 'proc1' in steps or 'comb' in steps:
+			process_all(dataMap,
+			            nobiascorr=kwargs.get('nobiascorr',False),
+			            noflatcorr=kwargs.get('noflatcorr',False),
+			            fixpix=fixpix,
+			            rampcorr=kwargs.get('rampcorr',False),
+			            nocombine=kwargs.get('nocombine',False),
+			            gain_multiply=not kwargs.get('nogainmul',False),
+			            nosavegain=kwargs.get('nosavegain',False),
+			            noweightmap=kwargs.get('noweightmap',False),
+			            prockey=kwargs.get('prockey','CCDPROC'),
+			            fused=fused,
+			            fixsaturation=kwargs.get('fixsaturation'),
+			            header_fixes=kwargs.get('header_fixes',{}),
+			            **pipekwargs)
+			timerLog('ccdproc')
+		if 'illum' in steps:
+			make_illumcorr_image(dataMap,
+			                     filterFun=kwargs.get('illum_filter_fun'),
+			                     **pipekwargs)
+			timerLog('illumination corr')
+		if 'fringe' in steps:
+			make_fringe_masters(dataMap,
+			                    byUtd=not kwargs.get('masterfringe'),
+			                    rolling=kwargs.get('rollingcals',False),
+			                    **pipekwargs)
+			timerLog('fringe masters')
+		if 'skyflat' in steps:
+			make_supersky_flats(dataMap,
+			                    byUtd=not kwargs.get('masterskyflat'),
+			                    rolling=kwargs.get('rollingcals',False),
+			                    **pipekwargs)
+			timerLog('supersky flats')
+		if 'proc2' in steps:
+			skyArgs = { k.lstrip('sky'):kwargs[k] 
+			                 for k in ['skymethod','skyorder']}
+			process_all2(dataMap,skyArgs,
+			             noillumcorr=kwargs.get('noillumcorr'),
+			             nofringecorr=kwargs.get('nofringecorr'),
+			             noskyflatcorr=kwargs.get('noskyflatcorr'),
+			             noweightmap=kwargs.get('noweightmap'),
+			             noskysub=kwargs.get('noskysub'),
+			             prockey=kwargs.get('prockey','CCDPRO2'),
+			             redoskymask=kwargs.get('redoskymask'),
+			             save_sky=kwargs.get('savesky'),
+			             divide_exptime=(not kwargs.get('nodivideexptime',False)),
+			             compress_sky=kwargs.get('compressout'),
+			             compress_qlevel=kwargs.get('compressqlevel'),
+			             **pipekwargs)
+			timerLog('process2')
+		if 'wcs' in steps:
+			set_wcs(dataMap,
+			        savewcs=kwargs.get('savewcs',False),
+			        keepwcscat=kwargs.get('keepwcscat',True),
+			        **pipekwargs)
+			timerLog('wcs')
+		if 'cat' in steps:
+			make_catalogs(dataMap,**pipekwargs)
+			timerLog('catalog')
+		timerLog.dump()
+	finally:
+		# the shared-memory copies would otherwise outlive the run
+		if processes > 1:
+			pool.close()
+		if calStore is not None:
+			dataMap.setCalibrationLoader(None)
+			calStore.clear()
 
 def make_variance_image(dataMap,f,bpMask,expTime,gains,skyAdu):
 	flatMap = dataMap.getCalMap('flat')
@@ -833,10 +895,18 @@ def init_pipeline_args(parser):
 	                help='increase output verbosity')
 	parser.add_argument('--maxmem',type=float,default=2,
 	                help='maximum memory in GB for stacking images')
+	parser.add_argument('--shmcals',action='store_true',
+	                help='share calibration images between processes '
+	                     'using /dev/shm')
+	parser.add_argument('--shmcalsmaxmem',type=float,default=4,
+	                help='maximum memory in GB for shared calibrations')
 	parser.add_argument('--calccdims',action='store_true',
 	                help='generate CCD-combined images for calibration data')
 	parser.add_argument('--fixsaturation',action='store_true',
 	                help='correct overflowed pixels to have saturation value')
+	parser.add_argument('--fused',action='store_true',
+	                help='go from raw to ccdproc images in memory, without '
+	                     'writing overscan-subtracted object images')
 	parser.add_argument('--nobiascorr',action='store_true',
 	                help='do not apply bias correction')
 	parser.add_argument('--noflatcorr',action='store_true',
@@ -893,10 +963,20 @@ def init_pipeline_args(parser):
 	                help='space separated list of optional wcs config files')
 	parser.add_argument('--maxflatcounts',type=int,
 	                help='maximum counts (ADU) to accept for a flat')
+	parser.add_argument('--rollingcals',action='store_true',
+	                help='update fringe and sky flats incrementally as frames '
+	                     'are added or dropped (not dome flats, which are '
+	                     'scaled relative to the other frames)')
 	parser.add_argument('--cleancals',action='store_true',
 	                help='delete calibration input files')
 	parser.add_argument('--compress',action='store_true',
 	                help='compress science images using fpack')
+	parser.add_argument('--compressout',type=str,default=None,
+	                choices=['rice','hcompress','gzip'],
+	                help='write sky-subtracted images tile-compressed')
+	parser.add_argument('--compressqlevel',type=float,default=None,
+	                help='quantization level for compressed images '
+	                     '(requires fitsio >= 1.1)')
 	return parser
 
 def run_pipe(dataMap,args,**_kwargs):
@@ -919,6 +999,9 @@ def run_pipe(dataMap,args,**_kwargs):
 		steps = args.steps.split(',')
 	if args.wcsconfig is not None:
 		args.wcsconfig = args.wcsconfig.split(',')
+	if args.compressqlevel is not None:
+		# fail now rather than at the first compressed write
+		bokutil.compress_args(args.compressout or 'rice',args.compressqlevel)
 
 	verbose = 0 if args.verbose is None else args.verbose
 	# convert command-line arguments into dictionary
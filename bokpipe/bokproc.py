@@ -8,7 +8,7 @@ import multiprocessing
 from functools import partial
 import numpy as np
 from scipy.interpolate import LSQBivariateSpline,RectBivariateSpline,griddata
-from scipy.interpolate import LSQUnivariateSpline
+from scipy.interpolate import splev
 from scipy.interpolate import interp1d,interp2d
 from scipy.signal import spline_filter
 from scipy.ndimage.morphology import binary_dilation,binary_closing
@@ -82,12 +82,15 @@ class BokImArith(bokutil.BokProcess):
 class BokImStat(bokutil.BokProcess):
 	def __init__(self,**kwargs):
 		kwargs.setdefault('read_only',True)
+		kwargs.setdefault('mmap',True)
 		super(BokImStat,self).__init__(**kwargs)
 		self.statSec = bokutil.stats_region(kwargs.get('stats_region'),
 		                                    kwargs.get('stats_stride'))
 		self.clipArgs = kwargs.get('clip_args',{})
 		self.quickprocess = kwargs.get('quickprocess',False)
 		self.checkbad = kwargs.get('checkbad',False)
+		# only the stats region needs to be read
+		self.lazyRead = not (self.quickprocess or self.checkbad)
 		self.meanVals = []
 		self.rmsVals = []
 		self.badVals = []
@@ -114,6 +117,11 @@ class BokImStat(bokutil.BokProcess):
 		self.imgMeans.append(v)
 		self.imgStds.append(s)
 		return data,hdr
+	def process_lazy_hdu(self,extName,hdu):
+		v,s = bokutil.array_stats(hdu[self.statSec],method='mean',
+		                          rms=True,clip=True,**self.clipArgs)
+		self.imgMeans.append(v)
+		self.imgStds.append(s)
 	def _postprocess(self,fits,f):
 		self.meanVals.append(self.imgMeans)
 		self.rmsVals.append(self.imgStds)
@@ -241,17 +249,19 @@ class BokBiasStack(bokutil.ClippedMeanStack):
 		super(BokBiasStack,self).__init__(**kwargs)
 		self.headerKey = 'BIAS'
 		self.findRollOffs = kwargs.get('find_rolloffs',False)
+		# roll-off detection works on the full image cube
+		self.streaming = self.streaming and not self.findRollOffs
 		self.minNexp = 5
 	def _reject_pixels(self,imCube):
 		imCube = super(BokBiasStack,self)._reject_pixels(imCube)
 		if self.findRollOffs:
 			bslice = imCube[5:10,500:1500].reshape(-1,imCube.shape[-1])
-			v = np.ma.median(bslice,axis=0).filled()
+			v = bokutil.masked_median(bslice,axis=0).filled()
 			bad = np.where(v < -50)[0]
 			imCube[:100,:,bad] = np.ma.masked
 		return imCube
 	def _postprocess(self,extName,stack,hdr):
-		colmedian = np.ma.median(stack,axis=0).filled(0)
+		colmedian = bokutil.masked_median(stack,axis=0).filled(0)
 		# don't know of a better way to fill along columns
 		colmedian = np.repeat(colmedian[np.newaxis,:],stack.shape[0],axis=0)
 		ismasked = stack.mask.copy() # copy suppresses a warning
@@ -330,15 +340,15 @@ class NormalizeFlat(bokutil.BokProcess):
 		spFit = LSQBivariateSpline(xx[~binnedIm.mask],yy[~binnedIm.mask],
 		                           binnedIm.data[~binnedIm.mask],tx,ty,
 		                           kx=self.splineOrder,ky=self.splineOrder)
-		gradientIm = spFit(np.arange(nx),np.arange(ny)).T
+		# spline evaluates in double precision, but don't carry it through
+		gradientIm = spFit(np.arange(nx),np.arange(ny)).T.astype(np.float32)
 		normedIm = im.data / gradientIm
 		if self.normedFlatFit is not None:
-			self.normedFlatFit.write(gradientIm.astype(np.float32),
-			                         extname=extName,header=hdr)
+			self.normedFlatFit.write(gradientIm,extname=extName,header=hdr)
 		if self.binnedFlat is not None:
 			self.binnedFlat.write(binnedIm.astype(np.float32),
 			                      extname=extName,header=hdr)
-		return normedIm.astype(np.float32),hdr
+		return normedIm,hdr
 
 class BokGenerateDataQualityMasks(bokutil.BokProcess):
 	# setting a relatively low value here because in 2016 a couple of the
@@ -356,6 +366,12 @@ class BokGenerateDataQualityMasks(bokutil.BokProcess):
 		# need to overload process_file in order to check for output before
 		# opening input image
 		outf = self.outputNameMap(f)
+		if not self.clobber and self.useManifest and \
+		     completionManifest.is_complete(self.headerKey,
+		                                    self.inputNameMap(f),outf,
+		                                    self.paramsHash):
+			self._proclog('data quality mask for %s already exists' % f)
+			return None
 		if os.path.exists(outf):
 			if self.clobber:
 				os.unlink(outf)
@@ -363,6 +379,9 @@ class BokGenerateDataQualityMasks(bokutil.BokProcess):
 				self._proclog('data quality mask for %s already exists' % f)
 				return None
 		super(BokGenerateDataQualityMasks,self).process_file(f)
+		if self.useManifest:
+			completionManifest.record(self.headerKey,self.inputNameMap(f),
+			                          outf,self.paramsHash)
 	def _preprocess(self,fits,f):
 		super(BokGenerateDataQualityMasks,self)._preprocess(fits,f)
 		self.hduData = []
@@ -400,14 +419,19 @@ class BokGenerateDataQualityMasks(bokutil.BokProcess):
 		self.hduData.append(data)
 		return data,hdr
 	def _postprocess(self,fits,f):
-		maskOut = fitsio.FITS(self.outputNameMap(f),'rw')
+		outf = self.outputNameMap(f)
+		if os.path.exists(outf) and not self.clobber:
+			# only reached when run within a BokProcessChain
+			self._proclog('data quality mask for %s already exists' % f)
+			return
+		maskOut = fitsio.FITS(outf,'rw',clobber=self.clobber)
 		maskOut.write(None,header=fits.get_header(0))
 		for ccdNum,extGroup in enumerate(amp_iterator(),start=1):
 			ims = [ self.hduData[ampNum-1] for ampNum in extGroup ]
 			hdr = fits.get_header(bokCenterAmps[ccdNum-1])
 			ccdIm,hdr = _orient_mosaic(hdr,ims,ccdNum,'center')
 			saturated = (ccdIm > self.satVal) & ~ccdIm.mask
-			maskIm = np.zeros(ccdIm.shape,dtype=np.int8)
+			maskIm = np.zeros(ccdIm.shape,dtype=bokutil.output_dtypes['dqmask'])
 			maskIm[ccdIm.mask] |= 1
 			maskIm[saturated] |= 2
 			# XXX this goes to gaincal? or remove it?
@@ -525,6 +549,7 @@ class BokCCDProcess(bokutil.BokProcess):
 
 class BokWeightMap(bokutil.BokProcess):
 	_procMsg = 'weight map %s'
+	outputType = 'weight'
 	def __init__(self,**kwargs):
 		kwargs.setdefault('header_key','WHTMAP')
 		super(BokWeightMap,self).__init__(**kwargs)
@@ -675,6 +700,19 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 		}
 		# hugely downsample
 		self.skyRegion = bokutil.stats_region('amp_central_quadrant',10)
+		# the edge strips needed from each extension, by position in file
+		self.edgeStrips = [ set() for i in range(16) ]
+		for ccdi in range(4):
+			for ampi,ampj,edgedir in self.ampMap[ccdi]:
+				if ampi != ampj:
+					for ampk in [ampi,ampj]:
+						self.edgeStrips[4*ccdi+ampk].add(('amp',edgedir))
+		for ccdNum,refExt,calExt,edgedir in self.ccdMap:
+			if refExt != calExt:
+				for ext in [refExt,calExt]:
+					self.edgeStrips[ext].add(('ccd',edgedir))
+		# only the strips and sky region are read from each image
+		self.lazyRead = True
 		self.gainTrendMethod = kwargs.get('gain_trend_meth','spline')
 		assert self.gainTrendMethod in ['median','spline']
 		self.reset()
@@ -691,15 +729,24 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 			# with duplicates when a subprocess is reused
 			self.reset()
 		self.files.append(f)
-		self.hduData = []
+		self.edgeData = []
 		self.rawSky = []
 		self.rawSkyRms = []
-	def process_hdu(self,extName,data,hdr):
-		self.hduData.append(data)
-		sky = bokutil.array_clip(data[self.skyRegion],clip_iters=2)
+	def _edge_slice(self,which,edgedir):
+		if which=='amp':
+			return self.ampEdgeSlices[edgedir]
+		elif which=='ccd':
+			return self.ccdEdgeSlices[edgedir]
+	def process_lazy_hdu(self,extName,hdu):
+		strips = {}
+		for which,edgedir in self.edgeStrips[len(self.edgeData)]:
+			imslice = hdu[self._edge_slice(which,edgedir)]
+			strips[which,edgedir] = np.ma.masked_array(imslice,
+			                                 mask=np.ma.getmaskarray(imslice))
+		self.edgeData.append(strips)
+		sky = bokutil.array_clip(hdu[self.skyRegion],clip_iters=2)
 		self.rawSky.append(sky.mean())
 		self.rawSkyRms.append(sky.std())
-		return data,hdr
 	def process_files(self,files,filters):
 		self.filters = filters
 		super(BokCalcGainBalanceFactors,self).process_files(files)
@@ -716,12 +763,8 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 			return None
 		return imslice
 	def _get_img_slices(self,refExt,calExt,edgedir,which):
-		if which=='amp':
-			s = self.ampEdgeSlices[edgedir]
-		elif which=='ccd':
-			s = self.ccdEdgeSlices[edgedir]
-		refslice = self._get_img_slice(self.hduData[refExt][s])
-		calslice = self._get_img_slice(self.hduData[calExt][s])
+		refslice = self._get_img_slice(self.edgeData[refExt][which,edgedir])
+		calslice = self._get_img_slice(self.edgeData[calExt][which,edgedir])
 		if refslice is None or calslice is None:
 			print 'could not correct ',which,refExt,calExt
 		return refslice,calslice
@@ -741,7 +784,11 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 			                              self.bsMaskType)
 			ampMasks = bokutil.ccd_split(ccdMaskIm,ccdNum)
 			for ampNum,ampMask in zip(extGroup,ampMasks):
-				self.hduData[ampNum-1].mask |= ampMask
+				strips = self.edgeData[ampNum-1]
+				for which,edgedir in strips:
+					s = self._edge_slice(which,edgedir)
+					strips[which,edgedir].mask |= ampMask[s]
+		bsMask.close()
 	def _postprocess(self,fits,f):
 		self._apply_bright_star_mask(f)
 		gains = np.zeros(16,dtype=np.float32)
@@ -770,6 +817,7 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 		self.ccdRelGains.append(ccdratios)
 		self.allSkyVals.append(np.array(self.rawSky))
 		self.allSkyRms.append(np.array(self.rawSkyRms))
+		self.edgeData = []
 	def _getOutput(self):
 		return (self.files,self.ampRelGains,self.ccdRelGains,self.allSkyVals)
 	def _null_result(self,f):
@@ -791,68 +839,150 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 		gc_clip = sigma_clip(gc,iters=2,sigma=2.0,axis=0)
 		gc[:] = gc_clip.mean(axis=0)
 		return gc.filled(0),gc.mask
-	def _spline_gain_trend(self,rawgc):
-		nimg,ngain = rawgc.shape
-		seqno = np.arange(nimg,dtype=np.float32)
-		gc = np.ma.array(rawgc,mask=(rawgc==0),copy=True)
-		msk = gc.mask.copy()
+	def _gain_spline_basis(self,nimg):
+		# B-spline design matrix for the gain trends, evaluated at each image
+		# in the sequence, with the knots LSQUnivariateSpline would use
+		k = self.splineOrder
 		knots = np.linspace(0,nimg,self.nSplineKnots+2)[1:-1]
-		for j in range(ngain):
-			if np.allclose(gc[:,j],1):
-				# a reference chip
-				continue
-			ii = np.where(~gc[:,j].mask)[0]
-			rejmask = np.zeros(len(seqno),dtype=np.bool)
-			try:
-				spfit = LSQUnivariateSpline(seqno[ii],gc[ii,j].filled(),
-				                            knots,bbox=[0,nimg],
-				                            k=self.splineOrder)
-				for iternum in range(self.nSplineRejIter):
-					ii = np.where(~(gc[:,j].mask | rejmask))[0]
-					resid = gc[ii,j] - spfit(seqno[ii])
-					resrms = np.ma.std(resid)
-					rejmask[ii] |= np.abs(resid/resrms) > self.splineRejThresh
-					ii = np.where(~(gc[:,j].mask | rejmask))[0]
-					spfit = LSQUnivariateSpline(seqno[ii],gc[ii,j].filled(),
-					                            knots,bbox=[0,nimg],
-					                            k=self.splineOrder)
-				gc[:,j] = spfit(seqno)
-				msk[:,j] |= rejmask
-				if ii[0] >= self.nFillEdge:
-					# force it to linear fit with no interior knots
-					i0 = min(5,len(ii)-5)
-					linspfit = LSQUnivariateSpline(seqno[ii[:i0]],
-					                               gc[ii[:i0],j].filled(),
-					                               [],bbox=[0,seqno[ii[i0]]],
-					                               k=1)
-					gc[:ii[0],j] = linspfit(seqno[:ii[0]])
-				if ii[-1] < len(seqno)-self.nFillEdge:
-					i0 = max(0,len(ii)-5)
-					linspfit = LSQUnivariateSpline(seqno[ii[i0:]],
-					                               gc[ii[i0:],j].filled(),
-					                               [],bbox=[seqno[ii[i0]],
-					                                        seqno[ii[-1]]],
-					                               k=1)
-					gc[ii[-1]+1:,j] = linspfit(seqno[ii[-1]+1:])
-			except ValueError:
-				print 'WARNING: spline fit failed, reverting to mean'
-				gc[:,j] = sigma_clip(gc[:,j],iters=2,sigma=2.0).mean()
-		return gc.filled(0),msk
+		t = np.concatenate([[0]*(k+1),knots,[nimg]*(k+1)]).astype(np.float64)
+		nbasis = len(t) - (k+1)
+		x = np.arange(nimg)
+		B = np.empty((nimg,nbasis))
+		for j in range(nbasis):
+			c = np.zeros(len(t))
+			c[j] = 1
+			B[:,j] = splev(x,(t,c,k))
+		return B
+	def _linear_edge_fits(self,x,y,w):
+		# least-squares lines through the points selected by w, per column
+		n = w.sum(axis=0)
+		sx = np.sum(w*x,axis=0)
+		sy = np.sum(w*y,axis=0)
+		sxx = np.sum(w*x*x,axis=0)
+		sxy = np.sum(w*x*y,axis=0)
+		with np.errstate(divide='ignore',invalid='ignore'):
+			slope = (n*sxy - sx*sy) / (n*sxx - sx**2)
+			icept = (sy - slope*sx) / n
+		return slope,icept,n
+	def _spline_gain_trends(self,rawgcs):
+		'''Fit smooth trends to all of the gain sequences (columns of each
+		   array in rawgcs, e.g., one array per filter) at once, as masked
+		   least-squares fits with a B-spline basis for each sequence 
+		   length. The sequences are padded to a common length. Points that
+		   are outliers from the trend are rejected, and the ends of the 
+		   sequences without data are filled with linear extrapolations of
+		   the trend. Returns a (trend,mask) pair for each array.'''
+		lengths = [ len(rawgc) for rawgc in rawgcs ]
+		nimg = max(lengths)
+		ngains = [ rawgc.shape[1] for rawgc in rawgcs ]
+		ngain = sum(ngains)
+		rawgc = np.zeros((nimg,ngain),dtype=np.float64)
+		seqlen = np.zeros(ngain,dtype=np.int64)
+		j = 0
+		for g,n in zip(rawgcs,ngains):
+			rawgc[:len(g),j:j+n] = g
+			seqlen[j:j+n] = len(g)
+			j += n
+		seqno = np.arange(nimg,dtype=np.float64)[:,np.newaxis]
+		inseq = seqno < seqlen
+		gc = np.ma.array(rawgc,mask=(rawgc==0),copy=True)
+		msk = np.ma.getmaskarray(gc).copy()
+		y = gc.data
+		# the basis for each sequence, zero over the padding
+		bases = { n:self._gain_spline_basis(n) for n in set(lengths) }
+		nbasis = bases[nimg].shape[1]
+		B = np.zeros((nimg,ngain,nbasis))
+		for n,Bn in bases.items():
+			B[:n,seqlen==n] = Bn[:,np.newaxis,:]
+		# reference chips are left alone
+		dofit = np.array([ not np.allclose(gc[:,j],1) 
+		                     for j in range(ngain) ])
+		failed = np.zeros(ngain,dtype=bool)
+		good = ~msk
+		rejmask = np.zeros_like(msk)
+		trend = np.zeros((nimg,ngain))
+		for iternum in range(self.nSplineRejIter+1):
+			jj = np.where(dofit & ~failed)[0]
+			if len(jj) == 0:
+				break
+			if iternum > 0:
+				resid = np.ma.array(y[:,jj]-trend[:,jj],mask=~good[:,jj])
+				with np.errstate(divide='ignore',invalid='ignore'):
+					resid /= resid.std(axis=0)
+				rejmask[:,jj] |= (np.abs(resid) > 
+				                     self.splineRejThresh).filled(False)
+				good[:,jj] &= ~rejmask[:,jj]
+			# normal equations for each sequence, with the masked points
+			# given zero weight
+			w = good[:,jj].astype(np.float64)
+			G = np.einsum('ija,ij,ijb->jab',B[:,jj],w,B[:,jj])
+			# equivalent to the Schoenberg-Whitney conditions on the knots
+			ok = np.linalg.matrix_rank(G) == nbasis
+			failed[jj[~ok]] = True
+			jj,G,w = jj[ok],G[ok],w[:,ok]
+			if len(jj) == 0:
+				break
+			rhs = np.einsum('ija,ij->ja',B[:,jj],w*y[:,jj])
+			coeffs = np.linalg.solve(G,rhs[...,np.newaxis])[...,0]
+			trend[:,jj] = np.einsum('ija,ja->ij',B[:,jj],coeffs)
+		# spline values are returned for the fitted sequences
+		fitted = dofit & ~failed
+		msk[:,fitted] |= rejmask[:,fitted]
+		gc[:,fitted] = trend[:,fitted]
+		# force the ends to a linear fit to the trend over the nearest
+		# good points, where the sequence has no data
+		ngood = good.sum(axis=0)
+		rank = np.cumsum(good,axis=0) - 1
+		first = np.argmax(good,axis=0)
+		last = nimg - 1 - np.argmax(good[::-1],axis=0)
+		i0 = np.minimum(5,ngood-5)
+		i0 = np.where(i0<0,np.maximum(ngood+i0,0),i0)
+		slope,icept,npts = self._linear_edge_fits(seqno,trend,
+		                                          good & (rank < i0))
+		fillLeft = fitted & (first >= self.nFillEdge)
+		edgeFailed = fillLeft & (npts < 2)
+		fillLeft &= ~edgeFailed
+		fill = fillLeft & (seqno < first)
+		gc[fill] = (icept + slope*seqno)[fill]
+		i0 = np.maximum(0,ngood-5)
+		slope,icept,npts = self._linear_edge_fits(seqno,trend,
+		                                          good & (rank >= i0))
+		fill = fitted & ~edgeFailed & (last < seqlen-self.nFillEdge) & \
+		         (seqno > last) & inseq
+		gc[fill] = (icept + slope*seqno)[fill]
+		# and the failed fits revert to the mean
+		for j in np.where(failed | edgeFailed)[0]:
+			print 'WARNING: spline fit failed, reverting to mean'
+			gc[:,j] = sigma_clip(gc[:,j],iters=2,sigma=2.0).mean()
+		gc = gc.filled(0)
+		rv = []
+		j = 0
+		for g,ng in zip(rawgcs,ngains):
+			rv.append((gc[:len(g),j:j+ng].astype(g.dtype),
+			           msk[:len(g),j:j+ng]))
+			j += ng
+		return rv
+	def _spline_gain_trend(self,rawgc):
+		return self._spline_gain_trends([rawgc])[0]
 	def calc_mean_corrections(self):
 		raw_ampg = self.ampRelGains = np.array(self.ampRelGains)
 		raw_ccdg = self.ccdRelGains = np.array(self.ccdRelGains)
 		filts = np.unique(self.filters)
 		ampg = np.zeros_like(raw_ampg)
 		ccdg = np.zeros_like(raw_ccdg)
-		for filt in filts:
-			ii = np.where(self.filters == filt)[0]
-			if len(ii)==0: continue
-			if self.gainTrendMethod == 'median':
-				ampg[ii],msk = self._median_gain_trend(raw_ampg[ii])
-				ccdg[ii],msk = self._median_gain_trend(raw_ccdg[ii])
-			elif self.gainTrendMethod == 'spline':
-				ampg[ii],msk = self._spline_gain_trend(raw_ampg[ii])
-				ccdg[ii],msk = self._spline_gain_trend(raw_ccdg[ii])
+		namp = raw_ampg.shape[1]
+		groups = [ np.where(self.filters == filt)[0] for filt in filts ]
+		groups = [ ii for ii in groups if len(ii) > 0 ]
+		# the amp and CCD sequences are fit together
+		rawgs = [ np.hstack([raw_ampg[ii],raw_ccdg[ii]]) for ii in groups ]
+		if self.gainTrendMethod == 'median':
+			trends = map(self._median_gain_trend,rawgs)
+		elif self.gainTrendMethod == 'spline':
+			# and the sequences for all of the filters as well
+			trends = self._spline_gain_trends(rawgs)
+		for ii,(g,msk) in zip(groups,trends):
+			ampg[ii] = g[:,:namp]
+			ccdg[ii] = g[:,namp:]
 		# propagate the gain corrections starting from the reference
 		ampgscale = ampg.copy()
 		for ccdi,extGroup in enumerate(amp_iterator()):
@@ -888,8 +1018,8 @@ class BokCalcGainBalanceFactors(bokutil.BokProcess):
 #                                                                             #
 ###############################################################################
 
-def _orient_mosaic(hdr,ims,ccdNum,origin):
-	outIm = bokutil.ccd_join(ims,ccdNum,origin=origin)
+def _orient_mosaic(hdr,ims,ccdNum,origin,out=None):
+	outIm = bokutil.ccd_join(ims,ccdNum,origin=origin,out=out)
 	ny,nx = outIm.shape
 	det_i = (ccdNum-1) // 2
 	det_j = ccdNum % 2
@@ -992,6 +1122,7 @@ def _combine_ccds(f,**kwargs):
 	hdr['CCDJOIN'] = bokutil.get_timestamp()
 	outFits.write(None,header=hdr)
 	refSkyCounts = None
+	outIm = None
 	for ccdNum,extGroup in enumerate(np.hsplit(extns,4),start=1):
 		hdr = inFits[bokCenterAmps[ccdNum-1]].read_header()
 		ccdIms = []
@@ -1029,14 +1160,14 @@ def _combine_ccds(f,**kwargs):
 				im /= _a
 			ccdIms.append(im)
 		# orient the channel images into a mosaic of CCDs and
-		# modify WCS & mosaic keywords
-		outIm,hdr = _orient_mosaic(hdr,ccdIms,ccdNum,origin)
+		# modify WCS & mosaic keywords. the output buffer is contiguous
+		# and is reused for each CCD once it has been written.
+		shape,dtype = bokutil.ccd_join_shape(ccdIms)
+		if outIm is None or outIm.shape != shape or outIm.dtype != dtype:
+			outIm = np.empty(shape,dtype=dtype)
+		outIm,hdr = _orient_mosaic(hdr,ccdIms,ccdNum,origin,out=outIm)
 		if len(satvals)>0:
 			hdr['SATUR'] = np.min(satvals)
-		if True:
-			# For some reason this results in a segfault when running
-			# on NERSC unless the image is copied...
-			outIm = outIm.copy()
 		outFits.write(outIm,extname='CCD%d'%ccdNum,header=hdr)
 	outFits.close()
 	if outputFile == inputFile:
@@ -1105,6 +1236,7 @@ def mask_bright_stars(im,saturation,minNSat=50):
 
 class BokGenerateSkyFlatMasks(bokutil.BokProcess):
 	_procMsg = 'generating sky mask for %s'
+	outputType = 'mask'
 	def __init__(self,**kwargs):
 		self.nBin = kwargs.get('binSize',4)
 		kwargs.setdefault('header_key','SKYMSK')
@@ -1125,7 +1257,6 @@ class BokGenerateSkyFlatMasks(bokutil.BokProcess):
 		self.clipArgs.setdefault('clip_cenfunc',np.ma.mean)
 		self.growKern = None #np.ones((self.binGrowSize,self.binGrowSize),dtype=bool)
 		self.nPad = 10
-		self.noConvert = True
 	def process_hdu(self,extName,data,hdr):
 		if (data>hdr['SATUR']).sum() > 50000:
 			# if too many pixels are saturated mask the whole damn thing
@@ -1167,7 +1298,7 @@ class BokGenerateSkyFlatMasks(bokutil.BokProcess):
 		bsmask = False # XXX
 		# construct the output array
 		maskIm = bokutil.magnify(mask,self.nBin) | bsmask
-		return maskIm.astype(np.uint8),hdr
+		return maskIm,hdr
 
 class BokFringePatternStack(bokutil.ClippedMeanStack):
 	def __init__(self,**kwargs):
@@ -1176,6 +1307,7 @@ class BokFringePatternStack(bokutil.ClippedMeanStack):
 		#kwargs.setdefault('scale','normalize_mode')
 		kwargs.setdefault('maxmem',5)
 		kwargs.setdefault('fill_value',1.0)
+		kwargs.setdefault('checkpoint',True)
 		super(BokFringePatternStack,self).__init__(**kwargs)
 		self.statsPix = bokutil.stats_region(kwargs.get('stats_region'),
 		                                     self.nSample)
@@ -1188,15 +1320,14 @@ class BokFringePatternStack(bokutil.ClippedMeanStack):
 		self.smoothingLength = kwargs.get('smoothing_length',0.05)
 		self.rawStackFile = kwargs.get('raw_stack_file')
 		self.rawStackFits = None
-		self.procmap = kwargs.get('procmap',map)
 		self.headerKey = 'FRG'
 	def _getnorm(self,f):
 		fits = bokutil.BokMefImage(self.inputNameMap(f),
 		                           mask_file=self.maskNameMap(f),
-		                           read_only=True)
+		                           read_only=True,mmap=True)
 		meanVals = []
-		for extn,data,hdr in fits:
-			meanVal = bokutil.array_stats(data[self.statsPix],
+		for extn,hdu in fits.iter_lazy():
+			meanVal = bokutil.array_stats(hdu[self.statsPix],
 			                              method=self.statsMethod,
 			                              **self.clipArgs)
 			meanVals.append(meanVal)
@@ -1209,13 +1340,9 @@ class BokFringePatternStack(bokutil.ClippedMeanStack):
 		           tuple((self.inputNameMap(f),)+tuple(meanVals))
 		return meanVals
 	def _preprocess(self,fileList,outFits):
-		# calculate the norms in subprocesses, need the workaround to
-		# avoid sending a Pool object
-		procmap = self.procmap
-		self.procmap = None
-		norms = procmap(self._getnorm,fileList)
+		# calculate the norms in subprocesses
+		norms = self._map_checkpointed('norms',self._getnorm,fileList)
 		self.norms = np.array(norms).astype(np.float32)
-		self.procmap = procmap
 		if self.rawStackFile is not None:
 			print 'writing raw stack to ',self.rawStackFile(outFits._filename)
 			rawFn = self.rawStackFile(outFits._filename)
@@ -1226,14 +1353,21 @@ class BokFringePatternStack(bokutil.ClippedMeanStack):
 			# needs to be clobbered (XXX but this didn't work??? added above)
 			self.rawStackFits.write(None,header=outFits[0].read_header(),
 			                        clobber=True)
-	def _rescale(self,imCube,scales=None):
+	def _norm_offsets(self,scales=None):
 		if scales is not None:
 			_scales = scales[np.newaxis,:]
 		else:
 			_scales = self.norms[np.newaxis,:]
 		_scales = _scales.mean(axis=-1) # XXX averaging across CCDs
 		self.scales = _scales.squeeze()
-		return imCube - _scales
+		return _scales
+	def _rescale(self,imCube,scales=None):
+		return imCube - self._norm_offsets(scales)
+	def _file_scales(self,inputFiles,masks,extn,scales=None):
+		_scales = self._norm_offsets(scales).ravel()
+		return np.broadcast_to(_scales,(len(inputFiles),))
+	def _rescale_image(self,im,scale):
+		return im - scale
 	def _postprocess(self,extName,stack,hdr):
 		cleanStack = stack.filled(1.0)
 		interpMask = False
@@ -1254,9 +1388,11 @@ class BokFringePatternStack(bokutil.ClippedMeanStack):
 class BokNightSkyFlatStack(bokutil.ClippedMeanStack):
 	def __init__(self,**kwargs):
 		kwargs.setdefault('stats_region','ccd_central_quadrant')
-		kwargs.setdefault('scale','normalize_mode')
+		# the images are scaled by their own norms (see _file_scales), not 
+		# the relative 'normalize' scales
 		kwargs.setdefault('maxmem',5)
 		kwargs.setdefault('fill_value',1.0)
+		kwargs.setdefault('checkpoint',True)
 		super(BokNightSkyFlatStack,self).__init__(**kwargs)
 		self.clipArgs = { k:v for k,v in kwargs.items() 
 		                     if k.startswith('clip_') }
@@ -1267,16 +1403,13 @@ class BokNightSkyFlatStack(bokutil.ClippedMeanStack):
 		self.clipArgs['clip_sig'] = 2.2
 		self.clipArgs['clip_cenfunc'] = np.ma.mean
 		self.smoothingLength = kwargs.get('smoothing_length',0.05)
-		self.procmap = kwargs.get('procmap',map)
 		self.normCCD = 'CCD1'
 		self.headerKey = 'SKYFL'
 	def _getnorm(self,f):
 		fits = bokutil.BokMefImage(self.inputNameMap(f),
 		                           mask_file=self.maskNameMap(f),
-		                           read_only=True)
-		# XXX have the get the full image and then subsample, because
-		#     fitsio doesn't handle negative slice boundaries
-		normpix = fits.get(self.normCCD)[self.statsPix]
+		                           read_only=True,mmap=True)
+		normpix = fits.get(self.normCCD,self.statsPix)
 		meanVal = bokutil.array_stats(normpix,method=self.statsMethod,
 		                              **self.clipArgs)
 		norm = 1/meanVal
@@ -1289,13 +1422,9 @@ class BokNightSkyFlatStack(bokutil.ClippedMeanStack):
 		           (self.inputNameMap(f),meanVal)
 		return norm
 	def _preprocess(self,fileList,outFits):
-		# calculate the norms in subprocesses, need the workaround to
-		# avoid sending a Pool object
-		procmap = self.procmap
-		self.procmap = None
-		norms = procmap(self._getnorm,fileList)
+		# calculate the norms in subprocesses
+		norms = self._map_checkpointed('norms',self._getnorm,fileList)
 		self.norms = np.array(norms).astype(np.float32)
-		self.procmap = procmap
 	def _rescale(self,imCube,scales=None):
 		if scales is not None:
 			_scales = scales[np.newaxis,:]
@@ -1303,6 +1432,11 @@ class BokNightSkyFlatStack(bokutil.ClippedMeanStack):
 			_scales = self.norms[np.newaxis,:]
 		self.scales = _scales.squeeze()
 		return imCube * _scales
+	def _file_scales(self,inputFiles,masks,extn,scales=None):
+		if scales is None:
+			scales = self.norms
+		self.scales = scales.squeeze()
+		return np.atleast_1d(self.scales)
 	def _postprocess(self,extName,stack,hdr):
 		# renormalize to unity
 		stack /= bokutil.array_clip(stack[self.statsPix]).mean()
@@ -2,9 +2,18 @@
 
 import os,sys
 import types
+import shutil
+import tempfile
+import hashlib
+import pickle
+import inspect
+import fcntl
+import resource
 from time import time
 from datetime import datetime
 from collections import OrderedDict
+from copy import deepcopy
+from functools import partial
 import multiprocessing
 import fitsio
 import numpy as np
@@ -13,28 +22,144 @@ from astropy.stats import sigma_clip
 
 from bokio import *
 
-# just translates the kwargs
+def _lane_median(data,valid,axis):
+	# median of the valid values along axis, with keepdims; NaN where there
+	# are no valid values. Lanes are grouped by their number of valid 
+	# values n, so that each group is partitioned with the invalid values
+	# pushed to the end and only two pivots ((n-1)//2 and n//2)
+	arr = np.moveaxis(np.where(valid,data,np.inf),axis,-1)
+	outShape = arr.shape[:-1]
+	arr = arr.reshape(-1,arr.shape[-1])
+	n = np.moveaxis(valid,axis,-1).reshape(arr.shape).sum(axis=-1)
+	med = np.empty(len(arr),dtype=arr.dtype)
+	med[:] = np.nan
+	for k in np.unique(n):
+		if k == 0:
+			continue
+		if k == n[0] and k == n[-1] and np.all(n == k):
+			ii = np.s_[:]
+		else:
+			ii = np.where(n == k)[0]
+		lo,hi = (k-1)//2,k//2
+		sub = np.partition(arr[ii],[lo,hi],axis=-1)
+		med[ii] = 0.5*(sub[:,lo]+sub[:,hi])
+	return np.expand_dims(med.reshape(outShape),axis)
+
+def masked_median(arr,axis=None):
+	'''Median of a (masked) array along axis, ignoring masked and
+	   non-finite values. Equivalent to np.ma.median but uses partitioning
+	   instead of sorting masked arrays.'''
+	data = np.ma.getdata(arr)
+	valid = ~np.ma.getmaskarray(arr) & np.isfinite(data)
+	if axis is None:
+		data,valid,_axis = data.ravel(),valid.ravel(),0
+	else:
+		_axis = axis
+	if not np.issubdtype(data.dtype,np.floating):
+		data = data.astype(np.float64)
+	med = _lane_median(data,valid,_axis).squeeze(axis=_axis)
+	return np.ma.masked_invalid(med)
+
+def sigma_clip_mask(data,mask=None,axis=None,**kwargs):
+	'''Sigma-clipping kernel on a plain array and boolean mask (True for 
+	   bad values). Follows astropy.stats.sigma_clip: values outside of
+	   center +/- clip_sig*std are rejected for clip_iters iterations (or
+	   until none are rejected if clip_iters is None), where the center is
+	   the mean or the median and std is about the mean. Non-finite values
+	   are rejected. Returns the updated mask.'''
+	clipSig = kwargs.get('clip_sig',2.5)
+	clipIters = kwargs.get('clip_iters',2)
+	cenfunc = kwargs.get('clip_cenfunc',np.ma.mean)
+	useMedian = cenfunc in (np.ma.median,np.median,np.nanmedian,masked_median)
+	shape = data.shape
+	if axis is None:
+		data,axis = data.ravel(),0
+		if mask is not None:
+			mask = np.ravel(mask)
+	if not np.issubdtype(data.dtype,np.floating):
+		data = data.astype(np.float64)
+	valid = np.isfinite(data)
+	if mask is not None:
+		valid &= ~mask
+	n = valid.sum(axis=axis,keepdims=True)
+	niter = 0
+	while clipIters is None or niter < clipIters:
+		with np.errstate(invalid='ignore',divide='ignore'):
+			x = np.where(valid,data,0)
+			mean = x.sum(axis=axis,keepdims=True) / n
+			x -= mean
+			x *= valid
+			x **= 2
+			std = np.sqrt(x.sum(axis=axis,keepdims=True) / n)
+			del x
+			if useMedian:
+				cen = _lane_median(data,valid,axis)
+			else:
+				cen = mean
+			valid &= data >= cen - clipSig*std
+			valid &= data <= cen + clipSig*std
+		niter += 1
+		lastn,n = n,valid.sum(axis=axis,keepdims=True)
+		if np.all(n == lastn):
+			# nothing rejected, further iterations won't change anything
+			break
+	return ~valid.reshape(shape)
+
+def minmax_reject(data,mask=None,axis=-1,nlow=1,nhigh=1):
+	'''Reject the nlow lowest and nhigh highest valid values at each 
+	   position along axis (as in IRAF minmax rejection). Masked and 
+	   non-finite values are never counted as extremes; where fewer than 
+	   nlow+nhigh values are valid all of them are rejected. Returns the
+	   updated mask.'''
+	valid = np.isfinite(data)
+	if mask is not None:
+		valid &= ~mask
+	rejmask = ~valid
+	nvals = data.shape[axis]
+	if nlow > 0:
+		ii = np.argpartition(np.where(valid,data,np.inf),
+		                     min(nlow,nvals)-1,axis=axis)
+		ii = np.take(ii,np.arange(min(nlow,nvals)),axis=axis)
+		np.put_along_axis(rejmask,ii,True,axis=axis)
+	if nhigh > 0:
+		ii = np.argpartition(np.where(valid,data,-np.inf),
+		                     -min(nhigh,nvals),axis=axis)
+		ii = np.take(ii,np.arange(nvals-min(nhigh,nvals),nvals),axis=axis)
+		np.put_along_axis(rejmask,ii,True,axis=axis)
+	return rejmask
+
 def array_clip(arr,axis=None,**kwargs):
+	'''Sigma-clip an array, returning a masked array with the rejected
+	   values masked (the data are not copied). Uses sigma_clip_mask unless
+	   a center function other than mean/median is requested.'''
 	# for some reason in newer version of astropy (>1.1) axis=-1 
 	# no longer works ...
 	if axis is not None and axis < 0:
 		axis = len(arr.shape) + axis
-	arr = sigma_clip(arr,axis=axis,
-	                 sigma=kwargs.get('clip_sig',2.5),
-	                 iters=kwargs.get('clip_iters',2),
-	                 cenfunc=kwargs.get('clip_cenfunc',np.ma.mean))
-	return arr
+	cenfunc = kwargs.get('clip_cenfunc',np.ma.mean)
+	if cenfunc not in (np.ma.mean,np.mean,np.ma.median,np.median,
+	                   np.nanmedian,masked_median):
+		return sigma_clip(arr,axis=axis,
+		                  sigma=kwargs.get('clip_sig',2.5),
+		                  iters=kwargs.get('clip_iters',2),
+		                  cenfunc=cenfunc)
+	data = np.ma.getdata(arr)
+	mask = np.ma.getmask(arr)
+	if mask is np.ma.nomask:
+		mask = None
+	mask = sigma_clip_mask(data,mask,axis=axis,**kwargs)
+	return np.ma.masked_array(data,mask=mask)
 
 def array_stats(arr,axis=None,method='median',clip=True,rms=False,
                 retArray=False,**kwargs):
 	if clip:
 		arr = array_clip(arr,axis=axis,**kwargs)
 	if method=='median':
-		val = np.ma.median(arr,axis=axis)
+		val = masked_median(arr,axis=axis)
 	elif method=='mean':
 		val = np.ma.mean(arr,axis=axis)
 	elif method=='mode':
-		val = 3*np.ma.median(arr,axis=axis) - 2*np.ma.mean(arr,axis=axis)
+		val = 3*masked_median(arr,axis=axis) - 2*np.ma.mean(arr,axis=axis)
 	else:
 		raise ValueError('array stats method %s unrecognized' % method)
 	if axis==None:
@@ -129,24 +254,41 @@ def rows2slice(rows):
 		s = np.s_[rows[0]:rows[1],:]
 	return s
 
-def ccd_join(ims,ccdNum,origin='center'):
-	'''Given a set of 4 amplifier images (in numerical order, i.e., CCD1 is
-	       [IM1,IM2,IM3,IM4]), combine them into a single CCD image.
-	     origin='center' means (x,y) = (0,0) is at the corner nearest to
-	            the center of the focal plane.
-	'''
-	im1,im2,im3,im4 = ims
-	# if the arrays are masked, np.[hv]stack will unmask all elements.
-	# but if they are not masked, np.ma.[hv]stack will make them masked.
-	if any([isinstance(im,np.ma.masked_array) for im in ims]):
-		hstack,vstack = np.ma.hstack,np.ma.vstack
-	else:
-		hstack,vstack = np.hstack,np.vstack
-	# orient the channel images N through E and stack into CCD image
-	ccdIm = vstack([ hstack([ np.flipud(np.rot90(im2)),
-	                          np.rot90(im4,3) ]),
-	                 hstack([ np.rot90(im1),
-	                          np.fliplr(np.rot90(im3)) ]) ])
+def resolve_subset(subset,shape):
+	'''Translate a tuple of slices (which may have negative bounds or 
+	   strides) into a contiguous block with absolute row/column ranges that
+	   can be read directly by fitsio, and the slices to apply to the block
+	   afterward. Returns None if there is no such block.'''
+	if not isinstance(subset,tuple):
+		subset = (subset,)
+	if len(subset) != len(shape) or \
+	     not all(isinstance(s,slice) for s in subset):
+		return None
+	readSlices,postSlices = [],[]
+	for s,n in zip(subset,shape):
+		start,stop,step = s.indices(n)
+		if step < 0 or stop <= start:
+			return None
+		readSlices.append(slice(start,stop))
+		postSlices.append(slice(None,None,step))
+	return tuple(readSlices),tuple(postSlices)
+
+def read_subset(hdu,subset):
+	'''Read a subset of an image from a fitsio HDU, or from an array (e.g.,
+	   for FakeFITS), using absolute ranges so that only the bounding rows
+	   and columns are read.'''
+	if isinstance(hdu,np.ndarray):
+		return hdu[subset]
+	rs = resolve_subset(subset,hdu.get_dims())
+	if rs is None:
+		return hdu.read()[subset]
+	readSlices,postSlices = rs
+	return hdu[readSlices][postSlices]
+
+def _ccd_orient(ccdIm,ccdNum,origin):
+	'''Reorient a CCD image from origin='lower left' to the requested origin.
+	   The flips are their own inverse, so the same call maps back. Returns
+	   a view of the input.'''
 	if origin == 'lower left':
 		pass
 	elif origin == 'center':
@@ -160,22 +302,60 @@ def ccd_join(ims,ccdNum,origin='center'):
 			ccdIm = np.flipud(ccdIm)
 	return ccdIm
 
+def ccd_join_shape(ims):
+	'''The shape and dtype of the CCD image formed by ccd_join(ims).'''
+	im1,im2,im3,im4 = ims
+	return ((im2.shape[1]+im1.shape[1],im2.shape[0]+im4.shape[0]),
+	        np.result_type(*ims))
+
+def ccd_join(ims,ccdNum,origin='center',out=None):
+	'''Given a set of 4 amplifier images (in numerical order, i.e., CCD1 is
+	       [IM1,IM2,IM3,IM4]), combine them into a single CCD image.
+	     origin='center' means (x,y) = (0,0) is at the corner nearest to
+	            the center of the focal plane.
+	   The amplifier images are copied directly into the output array, 
+	   which can be supplied with out (a masked array if the inputs are 
+	   masked and the mask should be written in place as well).
+	'''
+	im1,im2,im3,im4 = ims
+	# orient the channel images N through E and stack into CCD image
+	nx1,ny1 = im2.shape[0],im2.shape[1]
+	shape,dtype = ccd_join_shape(ims)
+	if out is None:
+		out = np.empty(shape,dtype=dtype)
+	elif out.shape != shape or out.dtype != dtype:
+		raise ValueError('output array should be %s %s' % (shape,dtype))
+	# fill the blocks of the lower-left oriented image through a view of
+	# the output, so that the output itself is contiguous
+	outData = _ccd_orient(np.ma.getdata(out),ccdNum,origin)
+	outData[:ny1,:nx1] = np.flipud(np.rot90(np.ma.getdata(im2)))
+	outData[:ny1,nx1:] = np.rot90(np.ma.getdata(im4),3)
+	outData[ny1:,:nx1] = np.rot90(np.ma.getdata(im1))
+	outData[ny1:,nx1:] = np.fliplr(np.rot90(np.ma.getdata(im3)))
+	if any([isinstance(im,np.ma.masked_array) for im in ims]):
+		# carry the masks in a parallel boolean array
+		if isinstance(out,np.ma.masked_array) and \
+		     out.mask is not np.ma.nomask:
+			mask = out.mask
+		else:
+			mask = np.empty(shape,dtype=np.bool)
+		outMask = _ccd_orient(mask,ccdNum,origin)
+		im1,im2,im3,im4 = [ np.ma.getmaskarray(im) for im in ims ]
+		outMask[:ny1,:nx1] = np.flipud(np.rot90(im2))
+		outMask[:ny1,nx1:] = np.rot90(im4,3)
+		outMask[ny1:,:nx1] = np.rot90(im1)
+		outMask[ny1:,nx1:] = np.fliplr(np.rot90(im3))
+		if mask is not np.ma.getmask(out):
+			out = np.ma.masked_array(np.ma.getdata(out),mask=mask)
+	return out
+
 def ccd_split(ccdIm,ccdNum,origin='center'):
 	'''Inverse of ccd_join: given a CCD image, split it into 4 amplifier
 	   images with their original orientation. Returned in numerical order
-	   (i.e., [IM1,IM2,IM3,IM4] for CCD1)'''
+	   (i.e., [IM1,IM2,IM3,IM4] for CCD1). The amplifier images are views
+	   of the input image.'''
 	# see above (ccd_join).
-	if origin == 'lower left':
-		pass
-	elif origin == 'center':
-		if ccdNum == 1:
-			ccdIm = np.fliplr(ccdIm)
-		elif ccdNum == 2:
-			ccdIm = np.rot90(ccdIm,2)
-		elif ccdNum == 3:
-			pass
-		elif ccdNum == 4:
-			ccdIm = np.flipud(ccdIm)
+	ccdIm = _ccd_orient(ccdIm,ccdNum,origin)
 	tmp1,tmp2 = np.vsplit(ccdIm,2)
 	im2,im4 = np.hsplit(tmp1,2)
 	im1,im3 = np.hsplit(tmp2,2)
@@ -185,27 +365,88 @@ def ccd_split(ccdIm,ccdNum,origin='center'):
 	im3 = np.rot90(np.fliplr(im3),-1)
 	return [im1,im2,im3,im4]
 
+class FitsHandleCache(object):
+	'''Keeps read-only fitsio.FITS handles open so that a set of files can
+	   be accessed repeatedly (e.g., for each extension and row chunk of a
+	   stack) without reopening them. The least recently used handle is 
+	   closed when the number open reaches maxOpen, which by default is 
+	   half of the per-process file descriptor limit. Headers are cached 
+	   as well and should not be modified.'''
+	def __init__(self,maxOpen=None):
+		if maxOpen is None:
+			maxOpen = resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 2
+		self.maxOpen = max(maxOpen,1)
+		self.handles = OrderedDict()
+		self.headers = {}
+	def __call__(self,fileName):
+		try:
+			fits = self.handles.pop(fileName)
+		except KeyError:
+			if len(self.handles) >= self.maxOpen:
+				_,lruFits = self.handles.popitem(last=False)
+				lruFits.close()
+			fits = fitsio.FITS(fileName)
+		self.handles[fileName] = fits
+		return fits
+	def read_header(self,fileName,ext=0):
+		try:
+			return self.headers[fileName,ext]
+		except KeyError:
+			hdr = self(fileName)[ext].read_header()
+			self.headers[fileName,ext] = hdr
+			return hdr
+	def close(self):
+		for fits in self.handles.values():
+			fits.close()
+		self.handles = OrderedDict()
+		self.headers = {}
+
+def read_image_chunk(fileName,extn,maskFile=None,rows=None,subset=None,
+                     badKey=None,maskType='gtzero',fitsCache=None):
+	'''Read a row chunk (or a subset) of one extension of an image, and
+	   of its mask file if given. Returns (data,mask), with mask=None when
+	   there is no mask file.'''
+	if fitsCache is None:
+		openFits = fitsio.FITS
+	else:
+		openFits = fitsCache
+	if subset is None:
+		readim = lambda hdu: hdu[rows2slice(rows)]
+	else:
+		readim = lambda hdu: read_subset(hdu,subset)
+	data = readim(openFits(fileName)[extn])
+	if maskFile is None:
+		return data,None
+	hdu = openFits(maskFile)[extn]
+	mask = load_mask(readim(hdu),maskType)
+	# hacky to put this special case here...
+	if badKey is not None:
+		if fitsCache is None:
+			hdr = hdu.read_header()
+		else:
+			hdr = fitsCache.read_header(maskFile,extn)
+		if badKey in hdr:
+			mask = np.ones(data.shape,dtype=np.bool)
+	return data,mask
+
 def build_cube(fileList,extn,masks=None,rows=None,badKey=None,
-               maskType='gtzero'):
-	s = rows2slice(rows)
-	cube = np.dstack( [ fitsio.FITS(f)[extn][s] for f in fileList ] )
-	_masks = []
+               maskType='gtzero',fitsCache=None,subset=None):
+	if masks is None:
+		maskFiles = [None]*len(fileList)
+	elif isinstance(masks,FileNameMap):
+		maskFiles = [ masks(f) for f in fileList ]
+	else:
+		maskFiles = masks
+	ims = [ read_image_chunk(f,extn,maskFile=mf,rows=rows,subset=subset,
+	                         badKey=badKey,maskType=maskType,
+	                         fitsCache=fitsCache)
+	          for f,mf in zip(fileList,maskFiles) ]
+	cube = np.dstack([ im for im,_ in ims ])
 	if masks is not None:
-		if isinstance(masks,FileNameMap):
-			maskFiles = [ masks(f) for f in fileList ]
-		else:
-			maskFiles = masks
-		for f in maskFiles:
-			hdu = fitsio.FITS(f)[extn]
-			_masks.append(load_mask(hdu[s],maskType))
-			# hacky to put this special case here...
-			if badKey is not None:
-				hdr = hdu.read_header()
-				if badKey in hdr:
-					_masks[-1][:] = True
-		mask = np.dstack(_masks).astype(np.bool)
+		mask = np.dstack([ m for _,m in ims ]).astype(np.bool)
 	else:
 		mask = None
+	del ims
 	cube = np.ma.masked_array(cube,mask)
 	return cube
 
@@ -255,6 +496,38 @@ def mask_saturation(extName,data,correct_inverted=True):
 		mask = filledmask
 	return data,mask
 
+# data types for each kind of output product. overscan-subtracted images
+# are not written as scaled integers (like the raw images) because the 
+# fitted bias levels are fractional. DQ masks are signed because negative
+# values flag pixels that are only suspect
+output_dtypes = {
+  'image':np.float32,
+  'oscan':np.float32,
+  'weight':np.float32,
+  'mask':np.uint8,
+  'dqmask':np.int8,
+}
+
+def convert_dtype(data,dtype):
+	'''Convert an array to the output data type, without a copy if it is
+	   already that type. Conversion to an integer type rounds and clips
+	   to the range of the type.'''
+	dtype = np.dtype(dtype)
+	if data.dtype == dtype:
+		return data
+	if dtype.kind in 'iu' and data.dtype.kind == 'f':
+		info = np.iinfo(dtype)
+		data = np.clip(np.rint(data),info.min,info.max)
+	return data.astype(dtype)
+
+def pack_mask(mask):
+	'''Store a boolean mask as bits.'''
+	return mask.shape,np.packbits(mask)
+
+def unpack_mask(packedMask):
+	shape,bits = packedMask
+	return np.unpackbits(bits)[:np.prod(shape)].reshape(shape).view(np.bool_)
+
 def load_mask(maskIm,maskType):
 	if maskIm.dtype == np.dtype(np.bool):
 		return maskIm
@@ -267,6 +540,45 @@ def load_mask(maskIm,maskType):
 	else:
 		raise ValueError
 
+_bitpix2dtype = {8:'u1',16:'>i2',32:'>i4',64:'>i8',-32:'>f4',-64:'>f8'}
+
+def mmap_hdu(hdu):
+	'''Return a read-only memory map of the image data in a fitsio HDU, or
+	   None if the data can't be mapped directly from the file (i.e., the
+	   file is compressed or the pixel values are scaled).'''
+	fileName = hdu.get_filename()
+	if fileName.endswith('.gz') or hdu.is_compressed() or not hdu.has_data():
+		return None
+	hdr = hdu.read_header()
+	if hdr.get('BSCALE',1) != 1 or hdr.get('BZERO',0) != 0:
+		return None
+	try:
+		dtype = _bitpix2dtype[hdr['BITPIX']]
+	except KeyError:
+		return None
+	offset = hdu.get_offsets()['data_start']
+	return np.memmap(fileName,dtype=dtype,mode='r',offset=offset,
+	                 shape=tuple(hdu.get_dims()))
+
+# quantization level for tile compression was added in fitsio 1.1
+_fitsio_has_qlevel = 'qlevel' in inspect.getargspec(fitsio.FITS.write_image)[0]
+
+def compress_args(compress,qlevel=None):
+	'''Keyword arguments for fitsio to write tile-compressed HDUs, compress
+	   is one of rice, hcompress, gzip, or None for no compression. qlevel
+	   sets the quantization of floating point images (integer images,
+	   e.g., masks, are always compressed losslessly). Raises ValueError
+	   if qlevel is given but the installed fitsio doesn't support it.'''
+	if compress is None:
+		return {}
+	kwargs = {'compress':compress}
+	if qlevel is not None:
+		if not _fitsio_has_qlevel:
+			raise ValueError('compression qlevel requires fitsio >= 1.1 '
+			                 '(installed is %s)' % fitsio.__version__)
+		kwargs['qlevel'] = qlevel
+	return kwargs
+
 class BokMefImage(object):
 	'''A wrapper around fitsio that allows the MEF files to be iterated
 	   over while updating the data arrays and headers either in-place or
@@ -278,13 +590,26 @@ class BokMefImage(object):
 		self.clobber = kwargs.get('clobber',False)
 		self.headerKey = kwargs.get('header_key')
 		self.readOnly = kwargs.get('read_only',False)
+		# memory-map the image data when possible (read-only access only)
+		self.mmap = kwargs.get('mmap',False) and self.readOnly
+		self._mmaps = {}
 		self.keepHeaders = kwargs.get('keep_headers',True)
 		self.extensions = kwargs.get('extensions')
+		self.compressArgs = compress_args(kwargs.get('compress'),
+		                                  kwargs.get('compress_qlevel'))
+		self.tmpFileName = None
+		self.outputDtype = kwargs.get('output_dtype',output_dtypes['image'])
 		maskFits = kwargs.get('mask_file')
 		maskType = kwargs.get('mask_type','gtzero')
 		headerCards = kwargs.get('add_header',{})
 		self.headerFixes = kwargs.get('header_fixes',[])
 		self.closeFiles = []
+		if not self.readOnly and self.compressArgs and \
+		     self.outFileName == self.fileName:
+			# can't compress the HDUs in place, instead write a new file 
+			# and move it over the input file when closed
+			self._check_header_key(self.fileName)
+			self.tmpFileName = self.outFileName = self.fileName + '.tmp'
 		if self.readOnly:
 			self.fits = fitsio.FITS(self.fileName)
 		else:
@@ -351,12 +676,12 @@ class BokMefImage(object):
 		#	return ValueError
 		self.masks.append(maskFits)
 		self.maskTypes.append(maskType)
-	def update(self,data,header=None,noconvert=False):
+	def update(self,data,header=None,dtype=None):
 		if self.readOnly:
 			return
-		if not noconvert:
-			# should probably instead track down all the upcasts
-			data = data.astype(np.float32)
+		if dtype is None:
+			dtype = self.outputDtype
+		data = convert_dtype(data,dtype)
 		# apply any header fixes
 		if header is not None:
 			for extNum,hdrfix in self.headerFixes:
@@ -374,26 +699,45 @@ class BokMefImage(object):
 			self.outFits[self.curExtName].write_keys(header)
 		else:
 			self.outFits.write(data,extname=self.curExtName,header=header,
-			                   clobber=False)
+			                   clobber=False,**self.compressArgs)
+	def _mmap_data(self,extName):
+		if not self.mmap:
+			return None
+		if extName not in self._mmaps:
+			self._mmaps[extName] = mmap_hdu(self.fits[extName])
+		return self._mmaps[extName]
 	def _load_masks(self,extName,subset):
 		if subset is None:
 			subset = np.s_[:,:]
-		mask = load_mask(self.masks[0][extName][subset],self.maskTypes[0])
+		mask = load_mask(read_subset(self.masks[0][extName],subset),
+		                 self.maskTypes[0])
 		for m,mtyp in zip(self.masks[1:],self.maskTypes[1:]):
-			mask |= load_mask(m[extName][subset],mtyp)
+			# not in-place, boolean masks may be (read-only) cached arrays
+			mask = mask | load_mask(read_subset(m[extName],subset),mtyp)
 		return mask
 	def __iter__(self):
 		for self.curExtName in self.extensions:
-			data = self.fits[self.curExtName].read()
+			data = self._mmap_data(self.curExtName)
+			if data is None:
+				data = self.fits[self.curExtName].read()
 			hdr = self.fits[self.curExtName].read_header()
 			if len(self.masks) > 0:
 				mask = self._load_masks(self.curExtName,None)
 				data = np.ma.masked_array(data,mask=mask)
 			yield self.curExtName,data,hdr
+	def iter_lazy(self):
+		'''Iterate over the extensions without reading them, yielding
+		   (extName,BokLazyHDU) pairs.'''
+		for self.curExtName in self.extensions:
+			yield self.curExtName,BokLazyHDU(self,self.curExtName)
 	def get(self,extName,subset=None,header=False):
 		if subset is None:
 			subset = np.s_[:,:]
-		data = self.fits[extName][subset]
+		data = self._mmap_data(extName)
+		if data is not None:
+			data = data[subset]
+		else:
+			data = read_subset(self.fits[extName],subset)
 		if len(self.masks) > 0:
 			mask = self._load_masks(extName,subset)
 			data = np.ma.masked_array(data,mask=mask)
@@ -440,8 +784,42 @@ class BokMefImage(object):
 		rv['nbin'] = nbin
 		return rv
 	def close(self):
+		if self.tmpFileName is not None:
+			# carry over any extensions that weren't processed
+			outExts = [ h.get_extname().upper() for h in self.outFits[1:] ]
+			for hdu in self.fits[1:]:
+				if hdu.get_extname().upper() not in outExts:
+					self.outFits.write(hdu.read(),extname=hdu.get_extname(),
+					                   header=hdu.read_header(),
+					                   **self.compressArgs)
 		for fits in self.closeFiles:
 			fits.close()
+		self._mmaps = {}
+		if self.tmpFileName is not None:
+			os.rename(self.tmpFileName,self.fileName)
+			self.tmpFileName = None
+
+class BokLazyHDU(object):
+	'''Proxy for an extension of a BokMefImage that doesn't read anything
+	   until asked for. Subsets are read directly from the file, including
+	   slices with negative bounds (e.g., from stats_region).'''
+	def __init__(self,fits,extName):
+		self.fits = fits
+		self.extName = extName
+		self._header = None
+	@property
+	def header(self):
+		if self._header is None:
+			self._header = self.fits.get_header(self.extName)
+		return self._header
+	@property
+	def shape(self):
+		dims = self.fits.fits[self.extName].get_dims()
+		return tuple(int(n) for n in dims)
+	def __getitem__(self,subset):
+		return self.fits.get(self.extName,subset)
+	def read(self):
+		return self.fits.get(self.extName)
 
 # make the instance methods pickleable using code from 
 # https://gist.github.com/bnyeggen/1086393
@@ -479,8 +857,10 @@ def mplog(msg,nProc=None):
 class FakeFITS(object):
 	'''Make a fake fitsio.FITS class that stores the image data from a FITS
 	   object in a dictionary. This object is pickle-able and so can be used
-	   with the multiprocessing feature in BokProcess, unlike fitsio.FITS.'''
-	def __init__(self,fits):
+	   with the multiprocessing feature in BokProcess, unlike fitsio.FITS.
+	   With mmap=True the extensions of uncompressed files are read-only
+	   memory maps, so only the pages that are accessed get read.'''
+	def __init__(self,fits,mmap=False):
 		if isinstance(fits,basestring):
 			fits = fitsio.FITS(fits)
 		# this gets accessed for FITS objects, so need to replicate it
@@ -488,7 +868,10 @@ class FakeFITS(object):
 		self.data = [None] # empty first extension, like FITS MEF
 		self.extMap = {}
 		for extNum,hdu in enumerate(fits[1:],start=1):
-			self.data.append(hdu.read())
+			data = mmap_hdu(hdu) if mmap else None
+			if data is None:
+				data = hdu.read()
+			self.data.append(data)
 			self.extMap[hdu.get_extname().upper()] = extNum
 	def __getitem__(self,extn):
 		'''index either by extension number or name'''
@@ -499,8 +882,136 @@ class FakeFITS(object):
 		'''need to provide hook for this because fits.close() is used often'''
 		pass
 
+class SharedFITS(FakeFITS):
+	'''A FakeFITS where the image data are stored once in a shared directory
+	   (by default in /dev/shm) and accessed through read-only memory maps.
+	   Worker processes that load the same file attach to the existing
+	   copy instead of decoding the FITS file again, and pickling only sends
+	   the location of the shared copy.'''
+	def __init__(self,fits,store):
+		if isinstance(fits,basestring):
+			fileName = fits
+		else:
+			fileName = fits._filename
+		self._filename = fileName
+		self.store = store
+		self.cacheDir = store.cache_dir(fileName)
+		self._resolve(fits)
+	def _resolve(self,fits):
+		# attach under a shared lock on the store, so that the copy can't
+		# be evicted between finding it and mapping it
+		while True:
+			lockf = self.store.lock(fcntl.LOCK_SH)
+			try:
+				if os.path.exists(os.path.join(self.cacheDir,'extmap.pkl')):
+					self._attach()
+					return
+			finally:
+				lockf.close()
+			self.store.put(fits,self.cacheDir)
+	def _attach(self):
+		with open(os.path.join(self.cacheDir,'extmap.pkl'),'rb') as f:
+			self.extMap = pickle.load(f)
+		self.data = [None]
+		for extNum in range(1,len(self.extMap)+1):
+			npyFile = os.path.join(self.cacheDir,'%d.npy'%extNum)
+			self.data.append(np.load(npyFile,mmap_mode='r'))
+		# mark as recently used
+		os.utime(self.cacheDir,None)
+	def __getstate__(self):
+		return {'_filename':self._filename,'store':self.store,
+		        'cacheDir':self.cacheDir}
+	def __setstate__(self,state):
+		self.__dict__.update(state)
+		# puts it back if evicted from the store since it was pickled
+		self._resolve(self._filename)
+
+class SharedCalibrationStore(object):
+	'''Loads calibration images into a directory on a shared-memory
+	   filesystem, returning SharedFITS objects. Least recently used images
+	   are evicted once the store exceeds maxGB; processes that already
+	   have an evicted image mapped keep their view of it.'''
+	def __init__(self,shmDir=None,maxGB=4.0):
+		if shmDir is None:
+			if os.path.isdir('/dev/shm'):
+				shmDir = '/dev/shm'
+			else:
+				shmDir = tempfile.gettempdir()
+			shmDir = os.path.join(shmDir,'bokpipe_cals_%d' % os.getpid())
+		self.shmDir = shmDir
+		self.maxBytes = maxGB * 1024**3
+		if not os.path.exists(self.shmDir):
+			os.makedirs(self.shmDir)
+	def cache_dir(self,fileName):
+		st = os.stat(fileName)
+		key = '%s|%d|%d' % (os.path.abspath(fileName),st.st_mtime,st.st_size)
+		return os.path.join(self.shmDir,hashlib.md5(key).hexdigest())
+	def put(self,fits,cacheDir):
+		if isinstance(fits,basestring):
+			fits = fitsio.FITS(fits)
+		# write to a temporary directory and then rename it, so that other
+		# processes never attach to a partially written copy
+		tmpDir = tempfile.mkdtemp(prefix='.tmp',dir=self.shmDir)
+		extMap = {}
+		for extNum,hdu in enumerate(fits[1:],start=1):
+			np.save(os.path.join(tmpDir,'%d.npy'%extNum),hdu.read())
+			extMap[hdu.get_extname().upper()] = extNum
+		with open(os.path.join(tmpDir,'extmap.pkl'),'wb') as f:
+			pickle.dump(extMap,f)
+		lockf = self.lock(fcntl.LOCK_EX)
+		try:
+			try:
+				os.rename(tmpDir,cacheDir)
+			except OSError:
+				# another process got there first
+				shutil.rmtree(tmpDir)
+			self._evict(keep=cacheDir)
+		finally:
+			lockf.close()
+	def lock(self,op):
+		'''Lock the store with flock, returning the open lock file (closing
+		   it releases the lock). Attaching takes a shared lock and eviction
+		   an exclusive one.'''
+		lockf = open(os.path.join(self.shmDir,'.lock'),'a')
+		fcntl.flock(lockf,op)
+		return lockf
+	def _evict(self,keep):
+		# only call with the exclusive lock held
+		entries = []
+		for d in os.listdir(self.shmDir):
+			if d.startswith('.'):
+				# the lock file and copies still being written
+				continue
+			d = os.path.join(self.shmDir,d)
+			if not os.path.exists(os.path.join(d,'extmap.pkl')):
+				continue
+			try:
+				nbytes = sum([ os.path.getsize(os.path.join(d,f))
+				                 for f in os.listdir(d) ])
+				entries.append((os.path.getmtime(d),nbytes,d))
+			except OSError:
+				pass
+		totBytes = sum([ e[1] for e in entries ])
+		for mtime,nbytes,d in sorted(entries):
+			if totBytes <= self.maxBytes:
+				break
+			if d != keep:
+				shutil.rmtree(d,ignore_errors=True)
+				totBytes -= nbytes
+	def __call__(self,fits):
+		return SharedFITS(fits,self)
+	def clear(self):
+		shutil.rmtree(self.shmDir,ignore_errors=True)
+
+# options that don't change the outputs
+_manifest_ignore_keys = ['clobber','verbose','debug','processes','procmap',
+                         'maxmem','mmap','ignore_existing',
+                         'use_manifest','checkpoint']
+
 class BokProcess(object):
 	_procMsg = '<BokProcess> %s'
+	# key into output_dtypes for the product written by this process
+	outputType = 'image'
 	def __init__(self,**kwargs):
 		self.inputNameMap = kwargs.get('input_map',IdentityNameMap)
 		self.outputNameMap = kwargs.get('output_map',IdentityNameMap)
@@ -516,6 +1027,9 @@ class BokProcess(object):
 			self.maskNameMap = NullNameMap
 		self.clobber = kwargs.get('clobber',False)
 		self.readOnly = kwargs.get('read_only',False)
+		self.mmap = kwargs.get('mmap',False)
+		self.compress = kwargs.get('compress')
+		self.compressQlevel = kwargs.get('compress_qlevel')
 		self.headerKey = kwargs.get('header_key')
 		self.headerFixes = kwargs.get('header_fixes',{})
 		self.ignoreExisting = kwargs.get('ignore_existing',True)
@@ -525,7 +1039,13 @@ class BokProcess(object):
 		self.debug = kwargs.get('debug',False)
 		self.nProc = kwargs.get('processes',1)
 		self.procMap = kwargs.get('procmap',map)
-		self.noConvert = False
+		# read-only processes that only need parts of each image can 
+		# implement process_lazy_hdu and set this
+		self.lazyRead = False
+		# skip outputs recorded as complete without opening them
+		self.useManifest = kwargs.get('use_manifest',True)
+		self.paramsHash = params_hash(dict( (k,v) for k,v in kwargs.items()
+		                      if k not in _manifest_ignore_keys ))
 	def add_mask(self,maskFits,maskType='gtzero'):
 		if not isinstance(maskFits,FakeFITS):
 			try:
@@ -540,6 +1060,10 @@ class BokProcess(object):
 		self._proclog(f)
 	def process_hdu(self,extName,data,hdr):
 		raise NotImplementedError
+	def process_lazy_hdu(self,extName,hdu):
+		'''called instead of process_hdu for read-only processes that set
+		   lazyRead, with a BokLazyHDU'''
+		raise NotImplementedError
 	def _postprocess(self,fits,f):
 		pass
 	def _finish(self):
@@ -550,35 +1074,80 @@ class BokProcess(object):
 		'''parallel routines may need to collect output from processing
 	       of individual files before finishing.'''
 		pass
+	def _open_image(self,f,**kwargs):
+		return BokMefImage(self.inputNameMap(f),
+		                   output_file=self.outputNameMap(f),
+		                   mask_file=self.maskNameMap(f),
+		                   mask_type=self.maskType,
+		                   keep_headers=self.keepHeaders,
+		                   clobber=self.clobber,
+		                   header_key=self.headerKey,
+		                   header_fixes=self.headerFixes.get(f,{}),
+		                   read_only=self.readOnly,
+		                   mmap=self.mmap,
+		                   compress=self.compress,
+		                   compress_qlevel=self.compressQlevel,
+		                   output_dtype=output_dtypes[self.outputType],
+		                   extensions=self.extensions,
+		                   **kwargs)
+	def _check_manifest(self,f):
+		if self.clobber or not self.useManifest or \
+		     self.readOnly or self.headerKey is None:
+			return False
+		if completionManifest.is_complete(self.headerKey,self.inputNameMap(f),
+		                                  self.outputNameMap(f),
+		                                  self.paramsHash):
+			_f = self.outputNameMap(f)
+			if not self.ignoreExisting:
+				raise OutputExistsError('%s already processed by %s' %
+				                        (_f,self.headerKey))
+			if self.verbose > 0:
+				print '%s already processed by %s'%(_f,self.headerKey)
+			return True
+		return False
+	def _record_manifest(self,f,inputSig=None):
+		if self.useManifest and not self.readOnly and \
+		     self.headerKey is not None:
+			completionManifest.record(self.headerKey,self.inputNameMap(f),
+			                          self.outputNameMap(f),self.paramsHash,
+			                          inputSig)
 	def process_file(self,f):
+		if self._check_manifest(f):
+			return
+		inputSig = file_signature(self.inputNameMap(f))
 		try:
-			fits = BokMefImage(self.inputNameMap(f),
-			                   output_file=self.outputNameMap(f),
-			                   mask_file=self.maskNameMap(f),
-			                   mask_type=self.maskType,
-			                   keep_headers=self.keepHeaders,
-			                   clobber=self.clobber,
-			                   header_key=self.headerKey,
-			                   header_fixes=self.headerFixes.get(f,{}),
-			                   read_only=self.readOnly,
-			                   extensions=self.extensions)
+			fits = self._open_image(f)
 		except OutputExistsError,msg:
 			if self.ignoreExisting:
 				if self.verbose > 0:
 					_f = self.outputNameMap(f)
 					print '%s already processed by %s'%(_f,self.headerKey)
+				# found by the header key, so record it for next time
+				self._record_manifest(f)
 				return
 			else:
 				raise OutputExistsError(msg)
 		for maskIm,maskType in zip(self.masks,self.maskTypes):
 			fits.add_mask(maskIm,maskType)
 		self._preprocess(fits,f)
-		for extName,data,hdr in fits:
-			data,hdr = self.process_hdu(extName,data,hdr)
-			fits.update(data,hdr,noconvert=self.noConvert)
+		if self.lazyRead and self.readOnly:
+			for extName,hdu in fits.iter_lazy():
+				self.process_lazy_hdu(extName,hdu)
+		else:
+			for extName,data,hdr in fits:
+				data,hdr = self.process_hdu(extName,data,hdr)
+				self._check_dtype(extName,data)
+				fits.update(data,hdr)
 		self._postprocess(fits,f)
 		fits.close()
+		self._record_manifest(f,inputSig)
 		return self._getOutput()
+	def _check_dtype(self,extName,data):
+		if self.debug and data.dtype == np.float64:
+			# double precision is never written, so this is just wasted
+			# memory and time in process_hdu
+			mplog('WARNING: %s returned float64 data for %s' % 
+			        (self.__class__.__name__,extName), self.nProc)
 	def _null_result(self,f):
 		return None
 	def _process_file_exc(self,f):
@@ -609,11 +1178,184 @@ class BokProcess(object):
 		self.procMap = procMap
 		self._finish()
 
+class _ChainStageImage(object):
+	'''The image as seen by one stage of a BokProcessChain: headers are
+	   returned as they were passed into that stage, everything else comes
+	   from the image being processed by the chain.'''
+	def __init__(self,fits,hdr0):
+		self._fits = fits
+		self._headers = { 0:deepcopy(hdr0) }
+	def set_header(self,extName,hdr):
+		self._headers[extName] = deepcopy(hdr)
+	def get_header(self,extName):
+		return deepcopy(self._headers[extName])
+	def __getattr__(self,attr):
+		return getattr(self._fits,attr)
+
+class BokProcessChain(BokProcess):
+	'''Apply a sequence of BokProcess stages to each HDU in memory, so
+	   that the input is read once and only the output of the last stage
+	   is written (along with any files the stages write themselves, e.g.,
+	   data quality masks). Read-only stages are given a copy of the data
+	   at that point in the chain. Intermediate products can be saved by
+	   passing write_stages, a list of name maps (or None) for each stage.'''
+	_procMsg = 'processing chain %s'
+	def __init__(self,stages,**kwargs):
+		kwargs.setdefault('input_map',stages[0].inputNameMap)
+		kwargs.setdefault('output_map',stages[-1].outputNameMap)
+		kwargs.setdefault('header_key',stages[-1].headerKey)
+		super(BokProcessChain,self).__init__(**kwargs)
+		self.stages = stages
+		self.stageOutputMaps = kwargs.get('write_stages',[None]*len(stages))
+		self.outputType = stages[-1].outputType
+		self.closeFiles = []
+	def _stage_masks(self,stage,f):
+		masks = zip(stage.masks,stage.maskTypes)
+		maskFits = stage.maskNameMap(f)
+		if maskFits is not None:
+			if isinstance(maskFits,basestring):
+				maskFits = fitsio.FITS(maskFits)
+				self.closeFiles.append(maskFits)
+			masks.append((maskFits,stage.maskType))
+		return masks
+	def _open_stage_outputs(self,f):
+		stageFits = []
+		for stage,view,outMap in zip(self.stages,self.stageImages,
+		                             self.stageOutputMaps):
+			if outMap is None or stage.readOnly:
+				stageFits.append(None)
+				continue
+			outFits = fitsio.FITS(outMap(f),'rw',clobber=True)
+			hdr = view.get_header(0)
+			if stage.headerKey is not None:
+				hdr[stage.headerKey] = get_timestamp()
+			outFits.write(None,header=hdr)
+			stageFits.append(outFits)
+		self.closeFiles.extend(filter(lambda s: s is not None,stageFits))
+		return stageFits
+	def _open_image(self,f):
+		# the output gets the same primary header as when the stages are
+		# run in sequence, including the keys stamped by each stage
+		addHdr = OrderedDict()
+		for extNum,hdrfix in self.headerFixes.get(f,{}):
+			if extNum == 0:
+				addHdr.update(hdrfix)
+		for stage in self.stages[:-1]:
+			if stage.headerKey is not None and not stage.readOnly:
+				addHdr[stage.headerKey] = get_timestamp()
+		return super(BokProcessChain,self)._open_image(f,add_header=addHdr)
+	def _preprocess(self,fits,f):
+		super(BokProcessChain,self)._preprocess(fits,f)
+		self.curHeaderFixes = self.headerFixes.get(f,{})
+		hdr0 = fits.get_header(0)
+		for extNum,hdrfix in self.curHeaderFixes:
+			if extNum == 0:
+				for k,v in hdrfix.items():
+					hdr0[k] = v
+		self.stageImages = []
+		for stage in self.stages:
+			self.stageImages.append(_ChainStageImage(fits,hdr0))
+			if stage.headerKey is not None and not stage.readOnly:
+				hdr0[stage.headerKey] = get_timestamp()
+		self.stageMasks = [ self._stage_masks(stage,f) 
+		                      for stage in self.stages ]
+		self.stageFits = self._open_stage_outputs(f)
+		for stage,view in zip(self.stages,self.stageImages):
+			stage._preprocess(view,f)
+	def _stage_output(self,stage,extName,data,hdr):
+		'''apply what writing the stage output and reading it back in would
+		   do to the data and header.'''
+		for extNum,hdrfix in self.curHeaderFixes:
+			if extNum == extName:
+				for k,v in hdrfix.items():
+					hdr[k] = v
+		# NOAO archive adds these keywords. FITSHDR.delete() leaves the
+		# index of the remaining keys stale, so build a new header.
+		hdr = fitsio.FITSHDR([ rec for rec in hdr.records()
+		                         if rec['name'] not in ['BZERO','BSCALE'] ])
+		data = convert_dtype(data,output_dtypes[stage.outputType])
+		return data,hdr
+	def process_hdu(self,extName,data,hdr):
+		lastStage = self.stages[-1]
+		for stage,view,masks,outFits in zip(self.stages,self.stageImages,
+		                                    self.stageMasks,self.stageFits):
+			view.set_header(extName,hdr)
+			if stage.readOnly:
+				stageData,stageHdr = data.copy(),deepcopy(hdr)
+			else:
+				stageData,stageHdr = data,hdr
+			if len(masks) > 0:
+				mask = load_mask(masks[0][0][extName][:,:],masks[0][1])
+				for m,mtyp in masks[1:]:
+					mask = mask | load_mask(m[extName][:,:],mtyp)
+				stageData = np.ma.masked_array(stageData,mask=mask)
+			stageData,stageHdr = stage.process_hdu(extName,stageData,stageHdr)
+			if stage.readOnly:
+				continue
+			stage._check_dtype(extName,stageData)
+			# masks are not carried between stages
+			data = np.ma.getdata(stageData)
+			hdr = stageHdr
+			if stage is not lastStage:
+				data,hdr = self._stage_output(stage,extName,data,hdr)
+			if outFits is not None:
+				outData = convert_dtype(data,output_dtypes[stage.outputType])
+				outFits.write(outData,extname=extName,header=hdr)
+		return data,hdr
+	def _postprocess(self,fits,f):
+		for stage,view in zip(self.stages,self.stageImages):
+			stage._postprocess(view,f)
+		for _fits in self.closeFiles:
+			_fits.close()
+		self.closeFiles = []
+	def _getOutput(self):
+		return [ stage._getOutput() for stage in self.stages ]
+	def _ingestOutput(self,procOutput):
+		for i,stage in enumerate(self.stages):
+			stageOut = [ out[i] for out in procOutput ]
+			stage._ingestOutput(filter(lambda p: p is not None,stageOut))
+	def _finish(self):
+		for stage in self.stages:
+			stage._finish()
+	def process_files(self,fileList):
+		# the stages get sent to the subprocesses along with the chain, so
+		# their pool objects need to be removed as well
+		procMaps = [ stage.procMap for stage in self.stages ]
+		for stage in self.stages:
+			stage.procMap = None
+		try:
+			super(BokProcessChain,self).process_files(fileList)
+		finally:
+			for stage,procMap in zip(self.stages,procMaps):
+				stage.procMap = procMap
+
+_stackWorker = None
+
+def _init_stack_worker(stacker):
+	global _stackWorker
+	_stackWorker = stacker
+	# each worker needs its own file handles, those inherited from the
+	# parent process can't be used
+	stacker.fitsCache = FitsHandleCache()
+	# and closes them when the worker exits
+	multiprocessing.util.Finalize(stacker.fitsCache,stacker.fitsCache.close,
+	                              exitpriority=10)
+
+def _stack_unit_worker(unit):
+	extn,rows = unit
+	return _stackWorker._stack_unit(extn,rows)
+
 class BokMefImageCube(object):
+	# maxmem is met by using fewer workers before chunks get thinner
+	minChunkRows = 64
+	# columns of the per-image statistics table
+	statNames = ['median','mean','mode','rms']
 	def __init__(self,**kwargs):
 		self.withVariance = kwargs.get('with_variance',False)
 		self.scale = kwargs.get('scale')
 		self.reject = kwargs.get('reject','sigma_clip')
+		self.nLow = kwargs.get('nlow',1)
+		self.nHigh = kwargs.get('nhigh',1)
 		self.inputNameMap = kwargs.get('input_map',IdentityNameMap)
 		self.outputNameMap = kwargs.get('output_map',IdentityNameMap)
 		self.maskNameMap = kwargs.get('mask_map',NullNameMap)
@@ -624,9 +1366,9 @@ class BokMefImageCube(object):
 		self.statsRegion = kwargs.get('stats_region')
 		self.statsStride = kwargs.get('stats_stride')
 		self.statsPix = stats_region(self.statsRegion,self.statsStride)
-		self.clipArgs = {'iters':kwargs.get('clip_iters',2),
-		                 'sig':kwargs.get('clip_sig',2.5),
-		                 'cenfunc':kwargs.get('clip_cenfunc',np.ma.mean)}
+		self.clipArgs = {'clip_iters':kwargs.get('clip_iters',2),
+		                 'clip_sig':kwargs.get('clip_sig',2.5),
+		                 'clip_cenfunc':kwargs.get('clip_cenfunc',np.ma.mean)}
 		self.fillValue = kwargs.get('fill_value',np.nan)
 		self.maxMemBytes = self.maxMemGB = kwargs.get('maxmem')
 		if self.maxMemBytes:
@@ -635,12 +1377,30 @@ class BokMefImageCube(object):
 		self.ignoreExisting = kwargs.get('ignore_existing',True)
 		self.deleteFiles = kwargs.get('delete_files',False)
 		self.verbose = kwargs.get('verbose',0)
+		self.nProc = kwargs.get('processes',1)
+		self.compressArgs = compress_args(kwargs.get('compress'),
+		                                  kwargs.get('compress_qlevel'))
+		self.useManifest = kwargs.get('use_manifest',True)
+		self.paramsHash = params_hash(dict( (k,v) for k,v in kwargs.items()
+		                      if k not in _manifest_ignore_keys ))
+		# save norms and finished extensions so an interrupted stack can
+		# be resumed
+		self.useCheckpoint = kwargs.get('checkpoint',False)
+		self.checkpoint = None
+		# keep running sums beside the output so that the stack can be 
+		# updated as frames are added or dropped
+		self.rolling = kwargs.get('rolling',False)
+		self.rollFiles = None
 		self.headerKey = 'CUBE'
 		self.extensions = None
 		self.badPixelMask = None
 		self.scaleKey = kwargs.get('scale_key','IMSCL')
+		self.procmap = kwargs.get('procmap',map)
 		self._scales = None
+		self.imStats = None
 		self.minNexp = None
+		self.fitsCache = None
+		self._stackArgs = None
 	def set_badpixelmask(self,maskFits):
 		if isinstance(maskFits,FakeFITS):
 			self.badPixelMask = maskFits
@@ -656,28 +1416,78 @@ class BokMefImageCube(object):
 		elif self.scale is None:
 			return imCube
 		elif self._scales is not None:
+			# normalize scales are set up before stacking from the image
+			# statistics table
 			scales = self._scales
-		elif self.scale.startswith('normalize'):
-			method = self.scale[self.scale.find('_')+1:]
-			imScales = imCube[self.statsPix] / imCube[self.statsPix+([0],)]
-			imScales = imScales.reshape(-1,imCube.shape[-1])
-			scales = array_stats(imScales,axis=0,method=method)
-			scales /= scales.max()
-			scales **= -1
 		else:
 			scales = self.scale(imCube)
 		self.scales = scales.squeeze()
-		# save the scales that were used. note that for nsplit>1, this has
-		# the effect of using the scales from the first chunk only.
+		# save the scales that were used. note that for nsplit>1, a scale
+		# function only sees the first chunk.
 		self._scales = scales
 		return imCube * scales
+	def _image_stats(self,f,extensions):
+		'''Clipped statistics (one row per extension with the columns in
+		   statNames) of the stats region of each extension of an image.'''
+		fitsCache = FitsHandleCache()
+		if self.maskNameMap == NullNameMap:
+			maskFile = None
+		else:
+			maskFile = self.maskNameMap(f)
+		stats = []
+		for extn in extensions:
+			im,mask = read_image_chunk(self.inputNameMap(f),extn,maskFile,
+			                           subset=self.statsPix,
+			                           badKey=self.badKey,
+			                           maskType=self.maskType,
+			                           fitsCache=fitsCache)
+			arr = array_clip(np.ma.masked_array(im,mask))
+			med = masked_median(arr)
+			mean = arr.mean()
+			vals = [med,mean,3*med-2*mean,arr.std()]
+			stats.append([ float(np.ma.filled(v,np.nan)) for v in vals ])
+		fitsCache.close()
+		return np.array(stats)
+	def _stats_scales(self,fileList,extensions):
+		'''Scales for scale='normalize_<stat>', from the ratio of the image
+		   statistic to that of the first image, taking the median over the
+		   extensions. The statistics are computed once per image (in
+		   parallel, and saved in the checkpoint) and apply to every chunk
+		   and extension.'''
+		method = self.scale[self.scale.find('_')+1:]
+		statsFun = partial(self._image_stats,extensions=extensions)
+		self.imStats = np.array(self._map_checkpointed('imstats',statsFun,
+		                                               fileList))
+		stats = self.imStats[:,:,self.statNames.index(method)]
+		scales = np.nanmedian(stats/stats[0],axis=1)
+		scales /= scales.max()
+		scales **= -1
+		return scales
+	def _file_scales(self,inputFiles,masks,extn,scales=None):
+		'''The per-image equivalent of _rescale, for stacks that read one
+		   image at a time: returns the scale for each input file, or None.'''
+		if scales is not None:
+			pass
+		elif self.scale is None:
+			return None
+		elif self._scales is not None:
+			scales = self._scales
+		else:
+			raise ValueError('scale function requires the image cube')
+		self.scales = scales.squeeze()
+		self._scales = scales
+		return np.atleast_1d(self.scales)
+	def _rescale_image(self,im,scale):
+		return im * scale
 	def _reject_pixels(self,imCube):
 		if self.reject == 'sigma_clip':
 			imCube = array_clip(imCube,axis=-1,**self.clipArgs)
 		elif self.reject == 'minmax':
-			imCube = np.ma.masked_array(imCube)
-			imCube[:,:,imCube.argmax(axis=-1)] = np.ma.masked
-			imCube[:,:,imCube.argmin(axis=-1)] = np.ma.masked
+			mask = np.ma.getmask(imCube)
+			mask = minmax_reject(np.ma.getdata(imCube),
+			                     None if mask is np.ma.nomask else mask,
+			                     axis=-1,nlow=self.nLow,nhigh=self.nHigh)
+			imCube = np.ma.masked_array(np.ma.getdata(imCube),mask=mask)
 		return imCube
 	def _load_weights(self,weights,fileList,extn,rows):
 		# if it's a map convert it to a list of files
@@ -685,11 +1495,40 @@ class BokMefImageCube(object):
 			weights = [weights(f) for f in fileList]
 		# if it's a list of files convert it to arrays
 		if type(weights) is list:
-			weights = build_cube(weights,extn,rows=rows)
+			weights = build_cube(weights,extn,rows=rows,
+			                     fitsCache=self.fitsCache)
 		# return either the arrays, and input weight array, or None
 		return weights
-	def _stack_cube(self,imCube,weights=None,**kwargs):
+	def _stack_cube(self,imCube,weights=None,expTimes=None,**kwargs):
+		'''Reduce the (masked) image cube along the last axis. Returns the
+		   stack and the number of images, exposure time, and variance for
+		   each pixel; any of the last three can be None to get the 
+		   default (unweighted) calculation when they are needed.'''
 		raise NotImplementedError
+	def _can_stream(self,weights=None,scales=None):
+		'''True if the stack can be accumulated one image at a time, in 
+		   which case the inputs are not split into row chunks.'''
+		return False
+	def _stack_chunk(self,fileList,inputFiles,masks,extn,rows,
+	                 weights=None,scales=None,expTimes=None,**kwargs):
+		'''Stack a row chunk of one extension. Returns the stack and the
+		   number of unrejected images, exposure time, and variance for 
+		   each pixel (the last three are None when not needed).'''
+		imCube = build_cube(inputFiles,extn,masks=masks,rows=rows,
+		                    badKey=self.badKey,maskType=self.maskType,
+		                    fitsCache=self.fitsCache)
+		imCube = self._rescale(imCube,scales=scales)
+		imCube = self._reject_pixels(imCube)
+		w = self._load_weights(weights,fileList,extn,rows)
+		_stack,nexp,expTime,var = self._stack_cube(imCube,w,
+		                                           expTimes=expTimes,**kwargs)
+		if self.minNexp is not None and nexp is None:
+			nexp = np.sum(~imCube.mask,axis=-1)
+		if expTimes is not None and expTime is None:
+			expTime = np.sum(~imCube.mask*expTimes,axis=-1)
+		if self.withVariance and var is None:
+			var = np.ma.var(imCube,axis=-1)
+		return _stack,nexp,expTime,var
 	def _preprocess(self,fileList,outFits):
 		pass
 	def _postprocess(self,extName,stack,hdr):
@@ -699,8 +1538,28 @@ class BokMefImageCube(object):
 		return stack,hdr
 	def stack(self,fileList,outputFile,weights=None,scales=None,**kwargs):
 		outputFile = self.outputNameMap(outputFile)
+		inputFiles = map(self.inputNameMap,fileList)
+		if self.rolling and \
+		     (weights is not None or not self._can_stream(weights,scales)):
+			raise ValueError('rolling stack requires an unweighted '
+			                 'streaming clipped mean')
+		if self.rolling and (scales is not None or self.scale is not None):
+			# scales relative to the other frames change as frames are
+			# added and dropped, and the sums can't be rescaled to match
+			raise ValueError('rolling stack can\'t use relative scales')
+		if self.useManifest and not self.clobber and \
+		     completionManifest.is_complete(self.headerKey,inputFiles,
+		                                    outputFile,self.paramsHash):
+			if not self.ignoreExisting:
+				raise OutputExistsError("%s already exists" % outputFile)
+			if self.verbose > 0:
+				print '%s already stacked' % outputFile
+			return
 		if os.path.exists(outputFile):
-			if self.clobber:
+			if self.clobber or self.rolling or \
+			     (self.useCheckpoint and StackCheckpoint.exists(outputFile)):
+				# a checkpoint is only left by an incomplete stack, and a
+				# rolling stack is rewritten from its sums
 				clobberHdus = True
 			else:
 				if self.ignoreExisting:
@@ -711,7 +1570,16 @@ class BokMefImageCube(object):
 					raise OutputExistsError("%s already exists" % outputFile)
 		else:
 			clobberHdus = False
-		inputFiles = map(self.inputNameMap,fileList)
+		stackFiles = fileList
+		if self.rolling:
+			self.checkpoint = RollingStackState(outputFile,self.paramsHash)
+			stackFiles = self._rolling_files(fileList)
+		elif self.useCheckpoint:
+			self.checkpoint = StackCheckpoint(outputFile,inputFiles,
+			                                  self.paramsHash)
+		stackInputs = map(self.inputNameMap,stackFiles)
+		# input files are opened once and reused for each extension/chunk
+		self.fitsCache = FitsHandleCache()
 		outFits = fitsio.FITS(outputFile,'rw',clobber=clobberHdus)
 		hdr = _write_stack_header_cards(inputFiles,self.headerKey)
 		outFits.write(None,header=hdr)
@@ -723,10 +1591,12 @@ class BokMefImageCube(object):
 				pass
 			expTimeFits = fitsio.FITS(expFn,'rw')
 			expTimeFits.write(None,header=hdr)
-			expTimes = [ fitsio.read_header(_f,ext=0)['EXPTIME']
-			                 for _f in inputFiles]
+			expTimes = [ self.fitsCache.read_header(_f,0)['EXPTIME']
+			                 for _f in stackInputs]
 			expTimes = np.array(expTimes).astype(np.float32)
 			expTimes = expTimes[np.newaxis,np.newaxis,:]
+		else:
+			expTimes = None
 		if self.withVariance:
 			varFn = outputFile.replace('.fits','_var.fits')
 			try:
@@ -737,87 +1607,519 @@ class BokMefImageCube(object):
 			varFits.write(None,header=hdr)
 		extensions = self.extensions
 		if extensions is None:
-			_fits = fitsio.FITS(inputFiles[0])
+			_fits = self.fitsCache(inputFiles[0])
 			extensions = [ h.get_extname() for h in _fits[1:] ]
-		if self.maxMemBytes is None:
-			nsplits = 1
-		else:
-			numRows,numCols = 4032,4096
-			nbytes = np.dtype(np.float32).itemsize
-			stacksize = nbytes * numRows * numCols * len(inputFiles)
-			nsplits = stacksize // int(self.maxMemBytes) + 1
-		if nsplits == 1:
-			rowChunks = [None,]
-		else:
-			rowsplits = np.linspace(0,numRows,nsplits+1,dtype=np.int32)
-			rowChunks = [ (row1,row2) 
-			         for row1,row2 in zip(rowsplits[:-1],rowsplits[1:]) ]
-		self._preprocess(fileList,outFits)
+		rowChunks,nProc = self._plan_chunks(inputFiles,extensions,
+		                                    weights,scales)
+		if self.rolling:
+			# the sums are kept for whole extensions
+			rowChunks = { extn:[None] for extn in extensions }
+		self._preprocess(stackFiles,outFits)
 		if self.maskNameMap == NullNameMap:
 			# argh, this is a hacky way to check for masks
 			masks = None
 		else:
-			masks = [ self.maskNameMap(f) for f in fileList ]
-		for extn in extensions:
-			stack = []
-			if self.withExpTimeMap:
-				expTime = []
-			if self.withVariance:
-				var = []
-			for rows in rowChunks:
-				print '::: %s extn %s <%s>' % (outputFile,extn,rows)
-				imCube = build_cube(inputFiles,extn,masks=masks,rows=rows,
-				                    badKey=self.badKey,maskType=self.maskType)
-				imCube = self._rescale(imCube,scales=scales)
-				imCube = self._reject_pixels(imCube)
-				w = self._load_weights(weights,fileList,extn,rows)
-				_stack = self._stack_cube(imCube,w,**kwargs)
-				if self.badPixelMask is not None:
-					bpmsk = self.badPixelMask[extn][rows2slice(rows)]
-					_stack.mask |= load_mask(bpmsk,'gtzero')
-				if self.minNexp is not None:
-					nexp = np.sum(~imCube.mask,axis=-1)
-					_stack.mask |= nexp < self.minNexp
-				stack.append(_stack)
+			masks = [ self.maskNameMap(f) for f in stackFiles ]
+		if scales is None and isinstance(self.scale,basestring):
+			if not self.scale.startswith('normalize'):
+				raise ValueError('unknown scale %s' % self.scale)
+			self._scales = self._stats_scales(stackFiles,extensions)
+			self.scales = self._scales
+		self._stackArgs = (outputFile,stackFiles,stackInputs,masks,weights,
+		                   scales,expTimes,kwargs)
+		if self.checkpoint is None or self.rolling:
+			doneExtns = []
+		else:
+			doneExtns = [ extn for extn in extensions
+			                     if self.checkpoint.has(extn) ]
+			if len(doneExtns) > 0:
+				# the scales set up by the first unit are needed to continue
+				savedScales = self.checkpoint.load('scales')
+				if savedScales is None:
+					print 'WARNING: %s checkpoint unreadable, restacking' % \
+					         outputFile
+					doneExtns = []
+				else:
+					self._scales,self.scales = savedScales
+		units = [ (extn,rows) for extn in extensions 
+		                        if extn not in doneExtns
+		                          for rows in rowChunks[extn] ]
+		results = self._map_units(units,nProc)
+		try:
+			for extn in extensions:
+				restored = None
+				if extn in doneExtns:
+					restored = self.checkpoint.load(extn)
+					if restored is None:
+						print 'WARNING: %s extn %s checkpoint unreadable, ' \
+						      'restacking' % (outputFile,extn)
+					elif self.verbose > 0:
+						print '%s extn %s restored from checkpoint' % \
+						         (outputFile,extn)
+				if restored is not None:
+					stack,expTime,var = restored
+				else:
+					if extn in doneExtns:
+						chunks = ( self._stack_unit(extn,rows) 
+						             for rows in rowChunks[extn] )
+					else:
+						chunks = ( results.next() for rows in rowChunks[extn] )
+					stack = []
+					expTime = []
+					var = []
+					for _stack,_expTime,_var in chunks:
+						stack.append(_stack)
+						expTime.append(_expTime)
+						var.append(_var)
+					stack = np.ma.vstack(stack)
+					if self.withExpTimeMap:
+						expTime = np.ma.vstack(expTime)
+					if self.withVariance:
+						var = np.ma.vstack(var)
+					if self.checkpoint is not None and not self.rolling:
+						self.checkpoint.save('scales',
+						               (self._scales,getattr(self,'scales',None)))
+						self.checkpoint.save(extn,(stack,expTime,var))
+				hdr = self.fitsCache(inputFiles[0])[extn].read_header()
+				stack,hdr = self._postprocess(extn,stack,hdr)
+				try:
+					finalStack = stack.filled(self.fillValue).astype(np.float32)
+				except AttributeError:
+					finalStack = stack.astype(np.float32)
+				outFits.write(finalStack,extname=extn,header=hdr,
+				              **self.compressArgs)
 				if self.withExpTimeMap:
-					expTime.append(np.sum(~imCube.mask*expTimes,axis=-1))
+					expTimeFits.write(expTime,extname=extn,header=hdr,
+					                  **self.compressArgs)
 				if self.withVariance:
-					# XXX this isn't the right variance for a weighted sum,
-					#     really the var calculation needs to happen in 
-					#     _stack_cube since it is implementation-dependent
-					var.append(np.ma.var(imCube,axis=-1))
-			stack = np.ma.vstack(stack)
-			hdr = fitsio.read_header(inputFiles[0],extn)
-			stack,hdr = self._postprocess(extn,stack,hdr)
-			try:
-				finalStack = stack.filled(self.fillValue).astype(np.float32)
-			except AttributeError:
-				finalStack = stack.astype(np.float32)
-			outFits.write(finalStack,extname=extn,header=hdr)
-			if self.withExpTimeMap:
-				expTime = np.ma.vstack(expTime)
-				expTimeFits.write(expTime,extname=extn,header=hdr)
-			if self.withVariance:
-				var = np.ma.vstack(var)
-				var = var.filled(0).astype(np.float32)
-				varFits.write(var,extname=extn,header=hdr)
+					var = var.filled(0).astype(np.float32)
+					varFits.write(var,extname=extn,header=hdr,
+					              **self.compressArgs)
+			# run the generator to the end, which shuts down the workers
+			for rv in results:
+				pass
+		finally:
+			# or stops them if the stack failed part way
+			results.close()
 		outFits.close()
 		if self.withExpTimeMap:
 			expTimeFits.close()
 		if self.withVariance:
 			varFits.close()
-		if self.deleteFiles:
+		self.fitsCache.close()
+		self.fitsCache = None
+		self._stackArgs = None
+		if self.rolling:
+			self._rolling_done(fileList)
+		elif self.checkpoint is not None:
+			self.checkpoint.clear()
+		self.checkpoint = None
+		if self.useManifest:
+			completionManifest.record(self.headerKey,inputFiles,outputFile,
+			                          self.paramsHash)
+		if self.deleteFiles and not self.rolling:
+			# (frames are re-read when dropped from a rolling stack)
 			map(os.unlink,inputFiles)
 		self._cleanup()
+	def _rolling_files(self,fileList):
+		'''The frames to stack for a rolling update: the current frames 
+		   followed by the frames from earlier updates that are dropped.'''
+		prevFiles = self.checkpoint.load('frames') or []
+		dropFiles = [ f for f in prevFiles if f not in fileList ]
+		# the extensions are updated separately, so until all of them are
+		# done any of these frames can be in the sums
+		self.checkpoint.save('frames',fileList+dropFiles)
+		self.rollFiles = set(fileList)
+		return fileList + dropFiles
+	def _rolling_done(self,fileList):
+		self.checkpoint.save('frames',fileList)
+		# forget the per-image values for dropped frames
+		norms = self.checkpoint.load('norms')
+		if norms is not None:
+			norms = { f:v for f,v in norms.items() if f in self.rollFiles }
+			self.checkpoint.save('norms',norms)
+		self.rollFiles = None
+	def _map_checkpointed(self,name,fun,fileList):
+		'''Compute fun(f) for each image using procmap, reusing the values
+		   saved under name in the checkpoint.'''
+		vals = None
+		if self.checkpoint is not None:
+			vals = self.checkpoint.load(name)
+		if vals is None:
+			vals = {}
+		missing = [ f for f in fileList if f not in vals ]
+		if len(missing) > 0:
+			# pool objects can't be pickled, need to remove from object
+			# while sending to subprocesses
+			procmap = self.procmap
+			self.procmap = None
+			try:
+				vals.update(zip(missing,procmap(fun,missing)))
+			finally:
+				self.procmap = procmap
+			if self.checkpoint is not None:
+				self.checkpoint.save(name,vals)
+		return [ vals[f] for f in fileList ]
+	def _stack_unit(self,extn,rows):
+		'''Stack one (extension,row chunk) unit and apply the masks for bad
+		   pixels and minimum number of exposures.'''
+		outputFile,fileList,inputFiles,masks,weights,scales,expTimes,kwargs = \
+		                                                 self._stackArgs
+		print '::: %s extn %s <%s>' % (outputFile,extn,rows)
+		_stack,nexp,expTime,var = \
+		       self._stack_chunk(fileList,inputFiles,masks,extn,rows,
+		                         weights,scales,expTimes,**kwargs)
+		if self.badPixelMask is not None:
+			bpmsk = self.badPixelMask[extn][rows2slice(rows)]
+			_stack.mask |= load_mask(bpmsk,'gtzero')
+		if self.minNexp is not None:
+			_stack.mask |= nexp < self.minNexp
+		return _stack,expTime,var
+	def _pixel_bytes(self,nFiles,itemSize,weights=None,scales=None):
+		'''Estimate the memory used per pixel of a row chunk while it is
+		   stacked, counting the arrays that can be allocated at the same
+		   time. Errs on the high side.'''
+		if self._can_stream(weights,scales):
+			# per-pixel sums and clipping bounds, plus one image at a time
+			# with its float64 copy, mask and selection arrays
+			niter = self.clipArgs['clip_iters'] or 5
+			nbytes = 3*8 + niter*2*4 + (itemSize+8+4)
+			if weights is not None:
+				nbytes += 2*8 + 4
+			if self.withExpTimeMap:
+				nbytes += 4
+			# the final mean and variance
+			return nbytes + 3*8
+		# the images as read and stacked into a cube, the masks, a float64
+		# scaled copy, and clipping temporaries
+		nbytes = 2*itemSize + 3 + 8 + (8+3)
+		if weights is not None:
+			nbytes += 4 + 8
+		if self.withVariance:
+			nbytes += 2*8
+		if self.withExpTimeMap:
+			nbytes += 4
+		return nFiles * nbytes
+	def _plan_chunks(self,inputFiles,extensions,weights=None,scales=None):
+		'''Split each extension into row chunks, using the actual image
+		   dimensions, and choose the number of workers, such that the 
+		   units being stacked at the same time fit within maxmem. Returns
+		   the row chunks for each extension and the number of workers.'''
+		rowBytes = {}
+		for extn in extensions:
+			info = self.fitsCache(inputFiles[0])[extn].get_info()
+			nrows,ncols = info['dims']
+			itemSize = abs(info['img_type']) // 8
+			rowBytes[extn] = (int(nrows),
+			                  ncols * self._pixel_bytes(len(inputFiles),
+			                                     itemSize,weights,scales))
+		if multiprocessing.current_process().daemon:
+			# already in a pool worker, which can't have children, and
+			# threads can't be used since cfitsio isn't thread-safe
+			nProc = 1
+		else:
+			nProc = self.nProc
+		if self.maxMemBytes is None:
+			return { extn:[None] for extn in extensions },\
+			         min(nProc,len(extensions))
+		maxMem = int(self.maxMemBytes)
+		# use fewer workers rather than very thin chunks
+		minBytes = max( min(self.minChunkRows,nrows)*nbytes 
+		                  for nrows,nbytes in rowBytes.values() )
+		nProc = max(1,min(nProc,maxMem//minBytes))
+		rowChunks = {}
+		for extn,(nrows,nbytes) in rowBytes.items():
+			chunkRows = max(maxMem // (nProc*nbytes),1)
+			nsplits = -(-nrows // chunkRows)
+			if nsplits == 1:
+				rowChunks[extn] = [None,]
+			else:
+				rowsplits = np.linspace(0,nrows,nsplits+1).astype(np.int32)
+				rowChunks[extn] = [ (row1,row2) 
+				     for row1,row2 in zip(rowsplits[:-1],rowsplits[1:]) ]
+		# there can't be more workers than units
+		nUnits = sum(map(len,rowChunks.values()))
+		nProc = min(nProc,nUnits)
+		if self.verbose > 0:
+			print 'stacking with %d workers and %d units' % (nProc,nUnits)
+		return rowChunks,nProc
+	def _map_units(self,units,nProc):
+		'''Generate the stacked units in order, distributing them over a
+		   pool of workers if processes > 1. Worker processes are forked 
+		   and inherit the stack state, only the results are sent back.'''
+		nProc = min(nProc,len(units))
+		if nProc <= 1:
+			for extn,rows in units:
+				yield self._stack_unit(extn,rows)
+			return
+		# the first unit is run here so that anything set up on the first
+		# call (e.g., the image scales) is shared by all of the workers
+		extn,rows = units[0]
+		yield self._stack_unit(extn,rows)
+		pool = multiprocessing.Pool(nProc,_init_stack_worker,(self,))
+		try:
+			for rv in pool.imap(_stack_unit_worker,units[1:]):
+				yield rv
+		except:
+			pool.terminate()
+			raise
+		else:
+			# let the workers exit normally so their file handles are closed
+			pool.close()
+		finally:
+			pool.join()
 	def _cleanup(self):
 		self._scales = None
 
 class ClippedMeanStack(BokMefImageCube):
-	def _stack_cube(self,imCube,weights=None):
-		# why does it get promoted?
-		return np.ma.average(imCube,weights=weights,axis=-1).astype(np.float32)
+	'''Sigma-clipped (weighted) mean of the input images. By default the
+	   stack is accumulated one image at a time, using running sums per
+	   pixel: each clipping iteration is another pass over the inputs that
+	   applies the bounds from the previous iterations. Memory use is then
+	   independent of the number of inputs. Cases that need the full image
+	   cube (non-mean clipping center, minmax rejection, scaling functions,
+	   or weight arrays) fall back to stacking in row chunks.
+	   With rolling=True the sums are saved with the output, and stacking
+	   a new list of frames only reads the frames that were added or 
+	   dropped since the last update. Rolling stacks can't be weighted or
+	   use scales (e.g., scale='normalize_mode') that are relative to the
+	   other frames, only per-image normalizations that don't depend on 
+	   which frames are in the stack.'''
+	def __init__(self,**kwargs):
+		super(ClippedMeanStack,self).__init__(**kwargs)
+		self.streaming = kwargs.get('streaming',True)
+	def _stack_cube(self,imCube,weights=None,expTimes=None):
+		# all of the products come from one set of per-pixel sums,
+		# accumulated in double precision. the variance is the weighted
+		# variance of the unrejected values about the weighted mean (for
+		# no weights, the same as np.ma.var).
+		valid = ~np.ma.getmaskarray(imCube)
+		x = np.zeros(imCube.shape,dtype=np.float64)
+		np.copyto(x,imCube.data,where=valid)
+		nexp = valid.sum(axis=-1)
+		if weights is None:
+			sw = nexp
+			swx = x.sum(axis=-1)
+			if self.withVariance:
+				swxx = np.einsum('ijk,ijk->ij',x,x)
+		else:
+			w = np.zeros(imCube.shape,dtype=np.float64)
+			np.copyto(w,np.ma.getdata(weights),where=valid)
+			sw = w.sum(axis=-1)
+			w *= x
+			swx = w.sum(axis=-1)
+			if self.withVariance:
+				swxx = np.einsum('ijk,ijk->ij',w,x)
+			del w
+		del x
+		nodata = sw == 0
+		with np.errstate(invalid='ignore',divide='ignore'):
+			mean = swx / sw
+			if self.withVariance:
+				var = np.clip(swxx/sw - mean**2,0,None)
+		stack = np.ma.masked_array(mean.astype(np.float32),mask=nodata)
+		if self.withVariance:
+			var = np.ma.masked_array(var.astype(np.float32),mask=nodata)
+		else:
+			var = None
+		if expTimes is not None:
+			expTime = np.einsum('ijk,k->ij',valid,expTimes.ravel())
+		else:
+			expTime = None
+		return stack,nexp,expTime,var
+	def _can_stream(self,weights=None,scales=None):
+		if not self.streaming or self.reject != 'sigma_clip':
+			return False
+		if self.clipArgs['clip_cenfunc'] not in (np.ma.mean,np.mean):
+			# the streaming sums can only clip around the mean
+			return False
+		if scales is None and self._scales is None and \
+		     self.scale is not None and not isinstance(self.scale,basestring):
+			return False
+		return weights is None or isinstance(weights,(list,FileNameMap))
+	def _stream_pass(self,inputFiles,maskFiles,extn,rows,bounds,
+	                 fileScales,weightFiles,expTimes,exclude=None,
+	                 rejected=None):
+		'''Accumulate the per-pixel sums of the images over the pixels that
+		   are within the clipping bounds. exclude optionally gives packed
+		   masks of pixels to leave out of each image; if rejected is a list
+		   the packed masks of the pixels outside the bounds are appended
+		   to it.'''
+		sums = {}
+		for i,f in enumerate(inputFiles):
+			im,mask = read_image_chunk(f,extn,maskFile=maskFiles[i],
+			                           rows=rows,badKey=self.badKey,
+			                           maskType=self.maskType,
+			                           fitsCache=self.fitsCache)
+			if fileScales is not None:
+				im = self._rescale_image(im,fileScales[i])
+			im = im.astype(np.float64)
+			keep = np.isfinite(im)
+			if mask is not None:
+				keep &= ~mask
+			if exclude is not None and exclude[i] is not None:
+				keep &= ~unpack_mask(exclude[i])
+			if rejected is not None:
+				valid = keep.copy()
+			with np.errstate(invalid='ignore'):
+				for lo,hi in bounds:
+					keep &= (im >= lo) & (im <= hi)
+			if rejected is not None:
+				rejected.append(pack_mask(valid & ~keep))
+			im[~keep] = 0
+			if i == 0:
+				for k in ['n','x','xx']:
+					sums[k] = np.zeros(im.shape,dtype=np.float64)
+				if weightFiles is not None:
+					for k in ['w','wx','wxx']:
+						sums[k] = np.zeros(im.shape,dtype=np.float64)
+				if expTimes is not None:
+					sums['t'] = np.zeros(im.shape,dtype=np.float32)
+			sums['n'] += keep
+			sums['x'] += im
+			sums['xx'] += im**2
+			if weightFiles is not None:
+				w = self.fitsCache(weightFiles[i])[extn][rows2slice(rows)]
+				w = w * keep
+				sums['w'] += w
+				w *= im
+				sums['wx'] += w
+				sums['wxx'] += w * im
+			if expTimes is not None:
+				sums['t'] += keep * expTimes[i]
+		return sums
+	def _stack_chunk(self,fileList,inputFiles,masks,extn,rows,
+	                 weights=None,scales=None,expTimes=None,**kwargs):
+		if not self._can_stream(weights,scales):
+			return super(ClippedMeanStack,self)._stack_chunk(fileList,
+			                     inputFiles,masks,extn,rows,weights,scales,
+			                     expTimes,**kwargs)
+		if masks is None:
+			maskFiles = [None]*len(inputFiles)
+		elif isinstance(masks,FileNameMap):
+			maskFiles = [ masks(f) for f in fileList ]
+		else:
+			maskFiles = masks
+		if isinstance(weights,FileNameMap):
+			weights = [ weights(f) for f in fileList ]
+		if expTimes is not None:
+			expTimes = expTimes.ravel()
+		fileScales = self._file_scales(inputFiles,masks,extn,scales)
+		if self.rolling:
+			return self._rolling_chunk(fileList,inputFiles,maskFiles,extn,
+			                           fileScales,expTimes)
+		clipSig = self.clipArgs['clip_sig']
+		clipIters = self.clipArgs['clip_iters']
+		bounds = []
+		lastCount = None
+		while True:
+			sums = self._stream_pass(inputFiles,maskFiles,extn,rows,bounds,
+			                         fileScales,weights,expTimes)
+			n = sums['n']
+			with np.errstate(invalid='ignore',divide='ignore'):
+				mean = sums['x'] / n
+				var = np.clip(sums['xx']/n - mean**2,0,None)
+			# stop once an iteration doesn't reject anything, since the
+			# bounds can't change after that
+			count = n.sum()
+			if count == lastCount or len(bounds) == clipIters:
+				break
+			lastCount = count
+			std = np.sqrt(var)
+			bounds.append(( (mean - clipSig*std).astype(np.float32),
+			                (mean + clipSig*std).astype(np.float32) ))
+		del bounds
+		return self._stack_sums(sums)
+	def _stack_sums(self,sums):
+		'''The stack products from the per-pixel sums.'''
+		n = sums['n']
+		nodata = n == 0
+		with np.errstate(invalid='ignore',divide='ignore'):
+			if 'w' in sums:
+				mean = sums['wx'] / sums['w']
+				var = np.clip(sums['wxx']/sums['w'] - mean**2,0,None)
+				nodata |= sums['w'] == 0
+			else:
+				mean = sums['x'] / n
+				var = np.clip(sums['xx']/n - mean**2,0,None)
+		_stack = np.ma.masked_array(mean.astype(np.float32),mask=nodata)
+		nexp = n.astype(np.int32)
+		expTime = sums.get('t')
+		if self.withVariance:
+			var = np.ma.masked_array(var.astype(np.float32),mask=nodata)
+		else:
+			var = None
+		return _stack,nexp,expTime,var
+	def _rolling_chunk(self,fileList,inputFiles,maskFiles,extn,
+	                   fileScales,expTimes):
+		'''Update the saved sums for an extension with the frames added
+		   to and dropped from the stack, and return the stack from the 
+		   sums. Dropped frames are re-read and the pixels they contributed
+		   are subtracted. The added frames are clipped as in the streaming
+		   stack, with the bounds from the sums of all frames, but the 
+		   frames already in the sums are not clipped again.'''
+		sumsName = 'sums_' + extn
+		state = self.checkpoint.load(sumsName)
+		if state is None or (expTimes is not None and 't' not in state):
+			state = {'files':set()}
+		inSums = state.pop('files')
+		addIdx = [ i for i,f in enumerate(fileList)
+		             if f in self.rollFiles and f not in inSums ]
+		dropIdx = [ i for i,f in enumerate(fileList)
+		             if f not in self.rollFiles and f in inSums ]
+		select = lambda vals,idx: None if vals is None else \
+		                            [ vals[i] for i in idx ]
+		rejName = lambda f: 'rej_%s_%s' % (hashlib.md5(f).hexdigest(),extn)
+		if len(dropIdx) > 0:
+			exclude = [ self.checkpoint.load(rejName(fileList[i])) 
+			              for i in dropIdx ]
+			sums = self._stream_pass(select(inputFiles,dropIdx),
+			                         select(maskFiles,dropIdx),extn,None,[],
+			                         select(fileScales,dropIdx),None,
+			                         select(expTimes,dropIdx),
+			                         exclude=exclude)
+			for k in sums:
+				state[k] -= sums[k]
+		if len(addIdx) > 0:
+			clipSig = self.clipArgs['clip_sig']
+			clipIters = self.clipArgs['clip_iters']
+			bounds = []
+			lastCount = None
+			while True:
+				rejected = []
+				sums = self._stream_pass(select(inputFiles,addIdx),
+				                         select(maskFiles,addIdx),extn,None,
+				                         bounds,select(fileScales,addIdx),
+				                         None,select(expTimes,addIdx),
+				                         rejected=rejected)
+				for k in sums:
+					sums[k] += state.get(k,0)
+				n = sums['n']
+				with np.errstate(invalid='ignore',divide='ignore'):
+					mean = sums['x'] / n
+					var = np.clip(sums['xx']/n - mean**2,0,None)
+				count = n.sum()
+				if count == lastCount or len(bounds) == clipIters:
+					break
+				lastCount = count
+				std = np.sqrt(var)
+				bounds.append(( (mean - clipSig*std).astype(np.float32),
+				                (mean + clipSig*std).astype(np.float32) ))
+			del bounds
+			state = sums
+			for i,rej in zip(addIdx,rejected):
+				self.checkpoint.save(rejName(fileList[i]),rej)
+		for i in dropIdx:
+			self.checkpoint.remove(rejName(fileList[i]))
+		inSums.difference_update(select(fileList,dropIdx))
+		inSums.update(select(fileList,addIdx))
+		state['files'] = inSums
+		self.checkpoint.save(sumsName,state)
+		del state['files']
+		return self._stack_sums(state)
 
 class MedianStack(BokMefImageCube):
-	def _stack_cube(self,imCube,weights=None):
-		return np.ma.median(imCube,axis=-1).astype(np.float32)
+	def _stack_cube(self,imCube,weights=None,expTimes=None):
+		stack = masked_median(imCube,axis=-1).astype(np.float32)
+		return stack,None,None,None
 
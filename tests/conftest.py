@@ -0,0 +1,8 @@
+import os
+import sys
+
+# bokproc reads its configuration files from $BOKPIPE/config
+testDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(testDir))
+os.environ.setdefault('BOKPIPE',os.path.join(os.path.dirname(testDir),
+                                             'bokpipe'))
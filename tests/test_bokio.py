@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+import fitsio
+
+from bokpipe.bokio import CompletionManifest,StackCheckpoint
+from bokpipe import bokutil
+
+def _touch(fileName,contents='x'):
+	with open(fileName,'w') as f:
+		f.write(contents)
+
+def test_manifest_complete(tmpdir):
+	inFile = str(tmpdir.join('in.fits'))
+	outFile = str(tmpdir.join('out.fits'))
+	_touch(inFile)
+	_touch(outFile)
+	manifest = CompletionManifest()
+	assert not manifest.is_complete('STEP',inFile,outFile,'abc')
+	manifest.record('STEP',inFile,outFile,'abc')
+	assert manifest.is_complete('STEP',inFile,outFile,'abc')
+	# a different parameter hash or step isn't complete
+	assert not manifest.is_complete('STEP',inFile,outFile,'xyz')
+	assert not manifest.is_complete('OTHER',inFile,outFile,'abc')
+	# a new reader picks up the entries from the file
+	assert CompletionManifest().is_complete('STEP',inFile,outFile,'abc')
+
+def test_manifest_input_changed(tmpdir):
+	inFiles = [ str(tmpdir.join('in%d.fits'%i)) for i in range(3) ]
+	outFile = str(tmpdir.join('stack.fits'))
+	for f in inFiles:
+		_touch(f)
+	_touch(outFile)
+	manifest = CompletionManifest()
+	manifest.record('STACK',inFiles,outFile)
+	assert manifest.is_complete('STACK',inFiles,outFile)
+	# a changed input modification time invalidates the output
+	st = os.stat(inFiles[1])
+	os.utime(inFiles[1],(st.st_atime,st.st_mtime+10))
+	assert not manifest.is_complete('STACK',inFiles,outFile)
+	# and so does a different list of inputs
+	assert not manifest.is_complete('STACK',inFiles[:2],outFile)
+
+def test_manifest_output_changed(tmpdir):
+	inFile = str(tmpdir.join('in.fits'))
+	outFile = str(tmpdir.join('out.fits'))
+	_touch(inFile)
+	_touch(outFile)
+	manifest = CompletionManifest()
+	manifest.record('STEP',inFile,outFile)
+	# modified by something that isn't in the manifest
+	_touch(outFile,'xyz')
+	assert not manifest.is_complete('STEP',inFile,outFile)
+
+def test_manifest_inplace_chain(tmpdir):
+	imFile = str(tmpdir.join('im.fits'))
+	_touch(imFile)
+	manifest = CompletionManifest()
+	sig = manifest._input_signature(imFile)
+	_touch(imFile,'step1')
+	manifest.record('STEP1',imFile,imFile,inputSig=sig)
+	sig = manifest._input_signature(imFile)
+	_touch(imFile,'step1+2')
+	manifest.record('STEP2',imFile,imFile,inputSig=sig)
+	# both steps account for the current file
+	assert manifest.is_complete('STEP1',imFile,imFile)
+	assert manifest.is_complete('STEP2',imFile,imFile)
+
+def test_checkpoint_entries(tmpdir):
+	outFile = str(tmpdir.join('stack.fits'))
+	inFiles = [ str(tmpdir.join('in%d.fits'%i)) for i in range(3) ]
+	for f in inFiles:
+		_touch(f)
+	ckpt = StackCheckpoint(outFile,inFiles,'abc')
+	assert not ckpt.has('IM1') and ckpt.load('IM1') is None
+	ckpt.save('IM1',np.arange(5))
+	assert np.array_equal(StackCheckpoint(outFile,inFiles,'abc').load('IM1'),
+	                      np.arange(5))
+	# unreadable entries load as None
+	with open(ckpt._path('IM2'),'w') as f:
+		f.write('garbage')
+	assert ckpt.load('IM2') is None
+	# changed parameters or inputs discard the checkpoint
+	assert not StackCheckpoint(outFile,inFiles,'xyz').has('IM1')
+	ckpt = StackCheckpoint(outFile,inFiles,'abc')
+	ckpt.save('IM1',np.arange(5))
+	_touch(inFiles[0],'changed')
+	assert not StackCheckpoint(outFile,inFiles,'abc').has('IM1')
+
+def _make_images(tmpdir,nimg=6,extns=('IM1','IM2','IM3'),shape=(20,16)):
+	rs = np.random.RandomState(2)
+	files = []
+	for i in range(nimg):
+		fileName = str(tmpdir.join('im%d.fits'%i))
+		fits = fitsio.FITS(fileName,'rw',clobber=True)
+		fits.write(None,header={'EXPTIME':30.0})
+		for extn in extns:
+			im = rs.normal(1000*(1+0.1*i),10,shape).astype(np.float32)
+			im[rs.rand(*shape)<0.05] += 500
+			fits.write(im,extname=extn)
+		fits.close()
+		files.append(fileName)
+	return files
+
+class _Interrupted(Exception):
+	pass
+
+def test_checkpoint_resume(tmpdir,monkeypatch):
+	files = _make_images(tmpdir)
+	kw = dict(scale='normalize_median',stats_region=(2,14,2,18),
+	          use_manifest=False,with_variance=True,maxmem=None)
+	refFile = str(tmpdir.join('ref.fits'))
+	bokutil.ClippedMeanStack(**kw).stack(files,refFile)
+	# interrupt the stack after the second extension is saved
+	outFile = str(tmpdir.join('stack.fits'))
+	stackUnit = bokutil.BokMefImageCube._stack_unit
+	def interrupt(self,extn,rows):
+		if extn == 'IM3':
+			raise _Interrupted
+		return stackUnit(self,extn,rows)
+	monkeypatch.setattr(bokutil.BokMefImageCube,'_stack_unit',interrupt)
+	try:
+		bokutil.ClippedMeanStack(checkpoint=True,**kw).stack(files,outFile)
+	except _Interrupted:
+		pass
+	assert StackCheckpoint.exists(outFile)
+	# the resumed stack only stacks the remaining extension
+	stacked = []
+	def record(self,extn,rows):
+		stacked.append(extn)
+		return stackUnit(self,extn,rows)
+	monkeypatch.setattr(bokutil.BokMefImageCube,'_stack_unit',record)
+	bokutil.ClippedMeanStack(checkpoint=True,**kw).stack(files,outFile)
+	assert stacked == ['IM3']
+	assert not StackCheckpoint.exists(outFile)
+	for sfx in ['.fits','_var.fits']:
+		ref = fitsio.FITS(refFile.replace('.fits',sfx))
+		out = fitsio.FITS(outFile.replace('.fits',sfx))
+		for extn in ['IM1','IM2','IM3']:
+			assert np.array_equal(out[extn].read(),ref[extn].read())
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+from scipy.ndimage.filters import median_filter
+from scipy.interpolate import LSQUnivariateSpline
+import fitsio
+import pytest
+
+from bokpipe import bokoscan
+from bokpipe.bokutil import array_clip,minmax_reject
+
+def _fit_overscan_reference(overscan,**kwargs):
+	# the single-strip overscan fit that fit_overscan_batch replaced
+	reject = kwargs.get('reject','sigma_clip')
+	method = kwargs.get('method','mean')
+	applyFilter = kwargs.get('apply_filter','median')
+	windowSize = kwargs.get('filter_window',31)
+	maskAlong = kwargs.get('mask_along',[0,1,2,-1])
+	along = kwargs.get('along','columns')
+	spline_nknots = kwargs.get('spline_nknots',7)
+	spline_niter = kwargs.get('spline_niter',2)
+	if along == 'rows':
+		overscan = overscan.transpose()
+	npix = overscan.shape[0]
+	overscan = np.ma.masked_array(overscan)
+	overscan[:,maskAlong] = np.ma.masked
+	if along == 'rows':
+		overscan[maskAlong,:] = np.ma.masked
+	if reject == 'sigma_clip':
+		overscan = array_clip(overscan,axis=1,**kwargs)
+	elif reject == 'minmax':
+		overscan.mask = minmax_reject(overscan.data,overscan.mask,axis=1,
+		                              nlow=kwargs.get('nlow',1),
+		                              nhigh=kwargs.get('nhigh',1))
+	overscan = array_clip(overscan,axis=0,
+	                      clip_iters=None,clip_sig=3.5,
+	                      clip_cenfunc=np.ma.median)
+	if method == 'mean':
+		oscan_fit = overscan.mean(axis=1)
+	elif method == 'mean_value':
+		oscan_fit = np.repeat(overscan.mean(),npix)
+	elif method == 'median_value':
+		oscan_fit = np.repeat(np.ma.median(overscan),npix)
+	elif method == 'cubic_spline':
+		knots = np.linspace(0,npix,spline_nknots)[1:-1]
+		oscanvec = overscan.mean(axis=1)
+		x = np.arange(npix)
+		for iternum in range(spline_niter):
+			g = ~oscanvec.mask
+			spl_fit = LSQUnivariateSpline(x[g],oscanvec.data[g],t=knots)
+			oscan_fit = spl_fit(x)
+			res = array_clip(oscanvec-oscan_fit)
+			if np.all(res.mask==oscanvec.mask):
+				break
+			oscanvec.mask |= res.mask
+	if 'value' not in method and 'spline' not in method:
+		oscan_fit = array_clip(oscan_fit,axis=0,
+		                       clip_iters=None,clip_sig=3.0,
+		                       clip_cenfunc=np.ma.mean)
+		oscan_fit = oscan_fit.filled(np.ma.median(oscan_fit))
+		if applyFilter == 'median':
+			oscan_fit = median_filter(oscan_fit,windowSize)
+	return oscan_fit
+
+def _overscans(nstrip=4,npix=300,ncol=40,seed=1):
+	rs = np.random.RandomState(seed)
+	x = np.arange(npix)[np.newaxis,:,np.newaxis]
+	overscans = 500 + 3*np.sin(x/50.) + rs.normal(0,5,(nstrip,npix,ncol))
+	overscans += 10*rs.rand(nstrip)[:,np.newaxis,np.newaxis]
+	# cosmic rays and a bleed trail crossing the overscan
+	overscans[rs.rand(*overscans.shape)<0.01] += 2000
+	overscans[1,100:110] += 300
+	return overscans
+
+@pytest.mark.parametrize('kwargs',[
+	dict(),
+	dict(method='mean_value'),
+	dict(method='median_value'),
+	dict(method='cubic_spline'),
+	dict(reject='minmax'),
+	dict(apply_filter=None),
+	dict(along='rows',method='cubic_spline'),
+])
+def test_fit_overscan_batch(kwargs):
+	overscans = _overscans()
+	if kwargs.get('along') == 'rows':
+		overscans = overscans.transpose(0,2,1).copy()
+	batchFits = bokoscan.fit_overscan_batch(overscans,**kwargs)
+	assert len(batchFits) == len(overscans)
+	for overscan,oscan_fit in zip(overscans,batchFits):
+		ref = _fit_overscan_reference(overscan,**kwargs)
+		assert np.allclose(oscan_fit,ref,rtol=0,atol=1e-6)
+		assert np.allclose(bokoscan.fit_overscan(overscan,**kwargs),
+		                   oscan_fit,rtol=0,atol=1e-9)
+
+def test_fit_overscans_mixed_shapes():
+	# strips of different shapes are fit in separate batches
+	overscans = list(_overscans(nstrip=2)) + list(_overscans(2,250,30,2))
+	fits = bokoscan._fit_overscans(overscans)
+	for overscan,oscan_fit in zip(overscans,fits):
+		assert np.allclose(oscan_fit,_fit_overscan_reference(overscan),
+		                   rtol=0,atol=1e-6)
+
+def test_spline_basis():
+	B,gram = bokoscan.spline_basis(300,7)
+	assert B.shape == (300,9)
+	assert np.allclose(B.sum(axis=1),1)
+	assert np.allclose(gram,np.dot(B.T,B))
+	# cached by geometry
+	assert bokoscan.spline_basis(300,7)[0] is B
+
+def test_fit_splines():
+	rs = np.random.RandomState(3)
+	npix = 300
+	x = np.arange(npix)
+	vecs = 500 + 3*np.sin(x/40.) + rs.normal(0,1,(5,npix))
+	vecs[rs.rand(*vecs.shape)<0.02] += 50
+	mask = np.zeros(vecs.shape,dtype=bool)
+	# masked ends, where the fit extrapolates
+	mask[1,:5] = True
+	mask[2,-8:] = True
+	mask[3,100:140] = True
+	oscanvecs = np.ma.masked_array(vecs,mask=mask)
+	fits = bokoscan._fit_splines(oscanvecs,7,3)
+	knots = np.linspace(0,npix,7)[1:-1]
+	for vec,fit in zip(oscanvecs,fits):
+		vec = vec.copy()
+		for iternum in range(3):
+			g = ~vec.mask
+			ref = LSQUnivariateSpline(x[g],vec.data[g],t=knots)(x)
+			res = array_clip(vec-ref)
+			if np.all(res.mask==vec.mask):
+				break
+			vec.mask |= res.mask
+		assert np.allclose(fit,ref,rtol=0,atol=1e-8)
+
+@pytest.mark.parametrize('along',['columns','rows'])
+def test_overscan_collection(tmpdir,monkeypatch,along):
+	# small blocks, so that the arrays grow and the image is written in
+	# several row blocks
+	monkeypatch.setattr(bokoscan.OverscanCollection,'blockSize',3)
+	monkeypatch.setattr(bokoscan.OverscanCollection,'writeBytes',4*20*70)
+	rs = np.random.RandomState(4)
+	imgFile = str(tmpdir.join('oscan_IM1'))
+	collection = bokoscan.OverscanCollection(imgFile,along=along)
+	oscans,resims = [],[]
+	for i in range(7):
+		oscan = np.ma.masked_array(rs.normal(500,5,(50,10)))
+		oscan[rs.rand(50,10)<0.05] = np.ma.masked
+		if along == 'columns':
+			oscanFit = oscan.mean(axis=1).filled(0)
+			resim = oscan - oscanFit[:,np.newaxis]
+		else:
+			oscanFit = oscan.mean(axis=0).filled(0)
+			resim = oscan - oscanFit[np.newaxis,:]
+		collection.append(oscan,oscanFit,'/data/img%d.fits'%i)
+		oscans.append(oscan.filled(np.nan).astype(np.float32))
+		resims.append(resim.astype(np.float32))
+	assert collection.n_images() == 7
+	collection.write_image()
+	collection.close()
+	arr_stack = np.hstack if along == 'columns' else np.vstack
+	fits = fitsio.FITS(imgFile+'.fits')
+	# (NaN for the masked pixels)
+	np.testing.assert_array_equal(fits[0].read(),arr_stack(oscans))
+	np.testing.assert_array_equal(fits[1].read(),arr_stack(resims))
+	hdr = fits[0].read_header()
+	assert hdr['NOVSCAN'] == 7
+	assert hdr['OVSCN007'] == 'img6.fits'
+	fits.close()
+	assert not os.path.exists(collection.tmpfn1)
+	assert not os.path.exists(collection.tmpfn2)
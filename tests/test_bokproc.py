@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+import fitsio
+from scipy.interpolate import LSQUnivariateSpline
+from astropy.stats import sigma_clip
+
+from bokpipe import bokutil,bokproc,bokdm
+from bokpipe.bokoscan import BokOverscanSubtract
+from bokpipe.bokio import FileNameMap
+
+nx,ny,nover = 64,48,20
+
+def _write_raw(fileName,seed):
+	rs = np.random.RandomState(seed)
+	fits = fitsio.FITS(fileName,'rw',clobber=True)
+	fits.write(None,header={'EXPTIME':30.0,'OBJECT':'test'})
+	for ampNum in bokproc.ampOrder:
+		im = 500 + rs.normal(0,5,(ny,nx+nover))
+		im[:,:nx] += 3000*(1+0.01*ampNum) + rs.normal(0,20,(ny,nx))
+		hdr = {'BIASSEC':'[%d:%d,1:%d]'%(nx+1,nx+nover,ny),
+		       'DATASEC':'[1:%d,1:%d]'%(nx,ny),
+		       'CD1_1':0.0,'CD1_2':1.25e-4,'CD2_1':-1.25e-4,'CD2_2':0.0,
+		       'CRVAL1':10.,'CRVAL2':20.,'CRPIX1':1.,'CRPIX2':1.,
+		       'LTM1_1':1.,'LTM2_2':1.,'LTV1':0.,'LTV2':0.}
+		fits.write(im.astype(np.uint16),extname='IM%d'%ampNum,header=hdr)
+	fits.close()
+
+def _write_cal(fileName,level,scatter,dtype=np.float32,header=None):
+	rs = np.random.RandomState(int(level))
+	fits = fitsio.FITS(fileName,'rw',clobber=True)
+	fits.write(None)
+	for ampNum in bokproc.ampOrder:
+		im = level + scatter*rs.rand(ny,nx)
+		fits.write(im.astype(dtype),extname='IM%d'%ampNum,header=header)
+	fits.close()
+
+def _write_mef(fileName,images):
+	fits = fitsio.FITS(fileName,'rw',clobber=True)
+	fits.write(None)
+	for extn,im in images:
+		fits.write(im,extname=extn)
+	fits.close()
+
+def _stages(tmpdir,outDir,calFiles):
+	outDir = str(tmpdir.mkdir(outDir))
+	bpFile = calFiles['badpix']
+	oscan = BokOverscanSubtract(input_map=FileNameMap(None),
+	                            output_map=FileNameMap(outDir,'_oscan'),
+	                            header_fixes=calFiles['fixes'])
+	dqMask = bokproc.BokGenerateDataQualityMasks(
+	                            input_map=FileNameMap(outDir,'_oscan'),
+	                            output_map=FileNameMap(outDir,'_dq'),
+	                            mask_map=lambda f: bpFile)
+	proc = bokproc.BokCCDProcess(input_map=FileNameMap(outDir,'_oscan'),
+	                       output_map=FileNameMap(outDir,'_proc'),
+	                       mask_map=lambda f: bpFile,
+	                       bias=bokdm.MasterCalibrator(calFiles['bias']),
+	                       flat=bokdm.MasterCalibrator(calFiles['flat']))
+	return oscan,dqMask,proc
+
+def test_process_chain(tmpdir,monkeypatch):
+	monkeypatch.setattr(bokutil,'get_timestamp',lambda: '2016-01-01 00:00')
+	files = [ str(tmpdir.join('raw%d.fits'%i)) for i in range(2) ]
+	for i,f in enumerate(files):
+		_write_raw(f,i)
+	calFiles = { k:str(tmpdir.join(k+'.fits'))
+	               for k in ['bias','flat','badpix'] }
+	_write_cal(calFiles['bias'],2.,1.)
+	_write_cal(calFiles['flat'],1.,0.01)
+	_write_cal(calFiles['badpix'],0,1.5,np.uint8)
+	calFiles['fixes'] = { files[0]:[(0,{'OBJECT':'fixed'}),
+	                                ('IM4',{'CRVAL1':10.5})] }
+	# run the stages one after the other
+	oscan,dqMask,proc = _stages(tmpdir,'seq',calFiles)
+	for stage in [oscan,dqMask,proc]:
+		stage.process_files(files)
+	# and then as a chain without the intermediate files
+	stages = _stages(tmpdir,'chain',calFiles)
+	chain = bokutil.BokProcessChain(stages,input_map=FileNameMap(None),
+	                                header_fixes=calFiles['fixes'])
+	chain.process_files(files)
+	outFiles = [ fn for fn in os.listdir(str(tmpdir.join('chain')))
+	               if not fn.startswith('.') ]
+	assert sorted(outFiles) == \
+	         ['raw0_dq.fits','raw0_proc.fits','raw1_dq.fits','raw1_proc.fits']
+	for f in files:
+		for outMap1,outMap2 in zip([dqMask.outputNameMap,proc.outputNameMap],
+		                           [stages[1].outputNameMap,
+		                            stages[2].outputNameMap]):
+			assert open(outMap1(f),'rb').read() == open(outMap2(f),'rb').read()
+
+def test_combine_ccds(tmpdir):
+	inFile = str(tmpdir.join('amps.fits'))
+	outFile = str(tmpdir.join('ccds.fits'))
+	_write_cal(inFile,1000.,100.,
+	           header={'CD1_1':0.0,'CD1_2':1.25e-4,'CD2_1':-1.25e-4,
+	                   'CD2_2':0.0,'CRVAL1':10.,'CRVAL2':20.,
+	                   'CRPIX1':1.,'CRPIX2':1.})
+	bokproc.combine_ccds([inFile],output_map=lambda f: outFile,debug=True)
+	inFits = fitsio.FITS(inFile)
+	outFits = fitsio.FITS(outFile)
+	# the output buffer is reused for each CCD, check that every CCD
+	# written matches its own amplifiers
+	for ccdNum in range(1,5):
+		ims = [ inFits['IM%d'%ampNum].read() 
+		          for ampNum in range(4*ccdNum-3,4*ccdNum+1) ]
+		ccdIm = outFits['CCD%d'%ccdNum].read()
+		assert np.array_equal(ccdIm,bokutil.ccd_join(ims,ccdNum))
+
+class _FullImageGainBalance(bokproc.BokCalcGainBalanceFactors):
+	# the gain balance as it was done from the full images
+	def __init__(self,**kwargs):
+		super(_FullImageGainBalance,self).__init__(**kwargs)
+		self.lazyRead = False
+	def _preprocess(self,fits,f):
+		super(_FullImageGainBalance,self)._preprocess(fits,f)
+		self.hduData = []
+	def process_hdu(self,extName,data,hdr):
+		self.hduData.append(data)
+		sky = bokutil.array_clip(data[self.skyRegion],clip_iters=2)
+		self.rawSky.append(sky.mean())
+		self.rawSkyRms.append(sky.std())
+		return data,hdr
+	def _get_img_slices(self,refExt,calExt,edgedir,which):
+		s = self._edge_slice(which,edgedir)
+		return (self._get_img_slice(self.hduData[refExt][s]),
+		        self._get_img_slice(self.hduData[calExt][s]))
+	def _apply_bright_star_mask(self,f):
+		bsMask = fitsio.FITS(self.bsMaskNameMap(f))
+		for ccdNum,extGroup in enumerate(bokproc.amp_iterator(),start=1):
+			ccdMaskIm = bokutil.load_mask(bsMask['CCD%d'%ccdNum].read(),
+			                              self.bsMaskType)
+			ampMasks = bokutil.ccd_split(ccdMaskIm,ccdNum)
+			for ampNum,ampMask in zip(extGroup,ampMasks):
+				self.hduData[ampNum-1].mask |= ampMask
+		bsMask.close()
+
+def test_gain_balance_strips(tmpdir):
+	npix = 96
+	rs = np.random.RandomState(5)
+	files = [ str(tmpdir.join('img%d.fits'%i)) for i in range(2) ]
+	bpFile = str(tmpdir.join('badpix.fits'))
+	_write_mef(bpFile,[ ('IM%d'%ampNum,
+	                     (rs.rand(npix,npix)<0.01).astype(np.uint8))
+	                      for ampNum in range(1,17) ])
+	for f in files:
+		_write_mef(f,[ ('IM%d'%ampNum,((1+0.05*rs.rand())*
+		                  (1000+20*rs.randn(npix,npix))).astype(np.float32))
+		                 for ampNum in range(1,17) ])
+		# bright star masks, by CCD
+		fits = fitsio.FITS(f.replace('.fits','_bsmsk.fits'),'rw',clobber=True)
+		fits.write(None)
+		for ccdNum,extGroup in enumerate(bokproc.amp_iterator(),start=1):
+			ampMasks = [ (rs.rand(npix,npix)<0.02).astype(np.uint8)
+			               for ampNum in sorted(extGroup) ]
+			fits.write(bokutil.ccd_join(ampMasks,ccdNum),
+			           extname='CCD%d'%ccdNum)
+		fits.close()
+	kwargs = dict(mask_map=lambda f: bpFile,
+	              ccd_mask_map=lambda f: f.replace('.fits','_bsmsk.fits'),
+	              amp_strip_length=80,amp_strip_width=8,amp_strip_stride=2,
+	              ccd_strip_length=80,ccd_strip_width=(2,10),
+	              ccd_strip_stride=2)
+	gainCalc = bokproc.BokCalcGainBalanceFactors(**kwargs)
+	refCalc = _FullImageGainBalance(**kwargs)
+	for calc in [gainCalc,refCalc]:
+		# the default sky region is for full-size amplifiers
+		calc.skyRegion = np.s_[24:72:4,24:72:4]
+		calc.process_files(files,['g','g'])
+	assert len(gainCalc.ampRelGains) == 2
+	for k in ['ampRelGains','ccdRelGains','allSkyVals','allSkyRms']:
+		assert np.array_equal(getattr(gainCalc,k),getattr(refCalc,k))
+	# not all the ratios are trivial
+	assert np.all(np.array(gainCalc.ampRelGains) != 0)
+
+def _spline_gain_trend_reference(gbf,rawgc):
+	# the per-sequence LSQUnivariateSpline fits that the batched fit in
+	# BokCalcGainBalanceFactors._spline_gain_trend replaced
+	nimg,ngain = rawgc.shape
+	seqno = np.arange(nimg,dtype=np.float32)
+	gc = np.ma.array(rawgc,mask=(rawgc==0),copy=True)
+	msk = gc.mask.copy()
+	knots = np.linspace(0,nimg,gbf.nSplineKnots+2)[1:-1]
+	for j in range(ngain):
+		if np.allclose(gc[:,j],1):
+			continue
+		ii = np.where(~gc[:,j].mask)[0]
+		rejmask = np.zeros(len(seqno),dtype=np.bool)
+		try:
+			spfit = LSQUnivariateSpline(seqno[ii],gc[ii,j].filled(),
+			                            knots,bbox=[0,nimg],
+			                            k=gbf.splineOrder)
+			for iternum in range(gbf.nSplineRejIter):
+				ii = np.where(~(gc[:,j].mask | rejmask))[0]
+				resid = gc[ii,j] - spfit(seqno[ii])
+				resrms = np.ma.std(resid)
+				rejmask[ii] |= np.abs(resid/resrms) > gbf.splineRejThresh
+				ii = np.where(~(gc[:,j].mask | rejmask))[0]
+				spfit = LSQUnivariateSpline(seqno[ii],gc[ii,j].filled(),
+				                            knots,bbox=[0,nimg],
+				                            k=gbf.splineOrder)
+			gc[:,j] = spfit(seqno)
+			msk[:,j] |= rejmask
+			if ii[0] >= gbf.nFillEdge:
+				i0 = min(5,len(ii)-5)
+				linspfit = LSQUnivariateSpline(seqno[ii[:i0]],
+				                               gc[ii[:i0],j].filled(),
+				                               [],bbox=[0,seqno[ii[i0]]],
+				                               k=1)
+				gc[:ii[0],j] = linspfit(seqno[:ii[0]])
+			if ii[-1] < len(seqno)-gbf.nFillEdge:
+				i0 = max(0,len(ii)-5)
+				linspfit = LSQUnivariateSpline(seqno[ii[i0:]],
+				                               gc[ii[i0:],j].filled(),
+				                               [],bbox=[seqno[ii[i0]],
+				                                        seqno[ii[-1]]],
+				                               k=1)
+				gc[ii[-1]+1:,j] = linspfit(seqno[ii[-1]+1:])
+		except ValueError:
+			gc[:,j] = sigma_clip(gc[:,j],iters=2,sigma=2.0).mean()
+	return gc.filled(0),msk
+
+def _gain_sequences(rs,nimg,ngain=20):
+	x = np.arange(nimg)[:,np.newaxis]
+	g = 1 + 0.02*rs.randn(ngain) + 1e-4*rs.randn(ngain)*x + \
+	        0.003*rs.randn(nimg,ngain)
+	# reference chips
+	g[:,0] = 1
+	g[:,16] = 1
+	# outliers, missing points and missing ends of the sequences
+	g[rs.rand(nimg,ngain)<0.05] *= 1.1
+	g[rs.rand(nimg,ngain)<0.2] = 0
+	for j in range(ngain):
+		if rs.rand() < 0.3:
+			g[:rs.randint(0,nimg//3),j] = 0
+		if rs.rand() < 0.3:
+			g[nimg-rs.randint(0,nimg//3):,j] = 0
+	return g.astype(np.float32)
+
+def test_spline_gain_trend():
+	gbf = bokproc.BokCalcGainBalanceFactors()
+	rs = np.random.RandomState(3)
+	for trial in range(50):
+		g = _gain_sequences(rs,rs.randint(20,80))
+		gc,msk = gbf._spline_gain_trend(g.copy())
+		refgc,refmsk = _spline_gain_trend_reference(gbf,g.copy())
+		assert np.allclose(gc,refgc,rtol=0,atol=1e-5)
+		assert np.array_equal(msk,refmsk)
+
+def test_spline_gain_trend_failed_fit():
+	# sequences with too few points to fit revert to the mean
+	gbf = bokproc.BokCalcGainBalanceFactors()
+	g = _gain_sequences(np.random.RandomState(5),40)
+	g[:,5] = 0
+	g[[10,30],5] = [1.02,1.03]
+	gc,msk = gbf._spline_gain_trend(g.copy())
+	refgc,refmsk = _spline_gain_trend_reference(gbf,g.copy())
+	assert np.allclose(gc[:,5],1.025)
+	assert np.allclose(gc,refgc,rtol=0,atol=1e-5)
+	assert np.array_equal(msk,refmsk)
+
+def test_spline_gain_trends_filters():
+	# the sequences for several filters, of different lengths, are fit
+	# together with the same results as fitting them one at a time
+	gbf = bokproc.BokCalcGainBalanceFactors()
+	rs = np.random.RandomState(7)
+	gs = [ _gain_sequences(rs,nimg) for nimg in [60,25,41] ]
+	gs[1][:,3] = 0
+	gs[1][[4,20],3] = [1.02,1.03]
+	trends = gbf._spline_gain_trends([ g.copy() for g in gs ])
+	for g,(gc,msk) in zip(gs,trends):
+		refgc,refmsk = _spline_gain_trend_reference(gbf,g.copy())
+		assert gc.shape == g.shape and gc.dtype == g.dtype
+		assert np.allclose(gc,refgc,rtol=0,atol=1e-5)
+		assert np.array_equal(msk,refmsk)
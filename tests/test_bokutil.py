@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+
+import pytest
+import numpy as np
+import fitsio
+from astropy.stats import sigma_clip
+
+from bokpipe import bokutil
+
+def _write_mef(fileName,images,**kwargs):
+	fits = fitsio.FITS(fileName,'rw',clobber=True)
+	fits.write(None,header={'EXPTIME':30.0})
+	for extn,im in images:
+		fits.write(im,extname=extn,**kwargs)
+	fits.close()
+
+def _images(dtype=np.float32,shape=(40,30),seed=1):
+	rs = np.random.RandomState(seed)
+	return [ ('IM%d'%i,(1000*rs.rand(*shape)).astype(dtype)) 
+	           for i in range(1,4) ]
+
+def test_mmap_hdu(tmpdir):
+	fileName = str(tmpdir.join('im.fits'))
+	images = _images()
+	_write_mef(fileName,images)
+	fits = fitsio.FITS(fileName)
+	for extn,im in images:
+		data = bokutil.mmap_hdu(fits[extn])
+		assert isinstance(data,np.memmap)
+		assert np.array_equal(data,im)
+		assert np.array_equal(data[5:-5:3,::2],im[5:-5:3,::2])
+
+def test_mmap_hdu_fallback(tmpdir):
+	# scaled integer and compressed pixels can't be mapped
+	rawFile = str(tmpdir.join('raw.fits'))
+	_write_mef(rawFile,_images(np.uint16))
+	compFile = str(tmpdir.join('comp.fits'))
+	_write_mef(compFile,_images(),compress='rice')
+	for fileName in [rawFile,compFile]:
+		fits = fitsio.FITS(fileName)
+		assert bokutil.mmap_hdu(fits['IM1']) is None
+		fakeFits = bokutil.FakeFITS(fileName,mmap=True)
+		assert np.array_equal(fakeFits['IM1'],fits['IM1'].read())
+
+def test_fakefits_mmap(tmpdir):
+	fileName = str(tmpdir.join('im.fits'))
+	images = _images()
+	_write_mef(fileName,images)
+	mapped = bokutil.FakeFITS(fileName,mmap=True)
+	loaded = bokutil.FakeFITS(fileName)
+	for i,(extn,im) in enumerate(images,start=1):
+		assert isinstance(mapped[extn],np.memmap)
+		assert np.array_equal(mapped[extn],loaded[extn])
+		assert np.array_equal(mapped[i],im)
+	statsPix = bokutil.stats_region(None,4)
+	assert np.array_equal(mapped['IM2'][statsPix],loaded['IM2'][statsPix])
+
+def test_mefimage_mmap(tmpdir):
+	fileName = str(tmpdir.join('im.fits'))
+	images = _images()
+	_write_mef(fileName,images)
+	fits = bokutil.BokMefImage(fileName,read_only=True,mmap=True)
+	for (extn,data,hdr),(_extn,im) in zip(fits,images):
+		assert extn == _extn
+		assert np.array_equal(data,im)
+	assert np.array_equal(fits.get('IM3',np.s_[2:10,3:7]),images[2][1][2:10,3:7])
+	fits.close()
+
+def _ccd_join_stack(ims,ccdNum):
+	# reference implementation using hstack/vstack temporaries
+	im1,im2,im3,im4 = ims
+	ccdIm = np.vstack([ np.hstack([ np.flipud(np.rot90(im2)),
+	                                np.rot90(im4,3) ]),
+	                    np.hstack([ np.rot90(im1),
+	                                np.fliplr(np.rot90(im3)) ]) ])
+	return { 1:np.fliplr, 2:lambda im: np.rot90(im,2),
+	         3:lambda im: im, 4:np.flipud }[ccdNum](ccdIm)
+
+def test_ccd_join():
+	rs = np.random.RandomState(2)
+	ims = [ rs.rand(30,20).astype(np.float32) for i in range(4) ]
+	masks = [ rs.rand(30,20) > 0.8 for i in range(4) ]
+	out = np.empty((40,60),dtype=np.float32)
+	for ccdNum in range(1,5):
+		ccdIm = bokutil.ccd_join(ims,ccdNum)
+		assert ccdIm.flags.c_contiguous
+		assert np.array_equal(ccdIm,_ccd_join_stack(ims,ccdNum))
+		# joining into an existing buffer
+		rv = bokutil.ccd_join(ims,ccdNum,out=out)
+		assert rv is out
+		assert np.array_equal(out,ccdIm)
+		# masks are joined the same way as the data
+		maskedIms = [ np.ma.masked_array(im,mask=m) 
+		                for im,m in zip(ims,masks) ]
+		ccdIm = bokutil.ccd_join(maskedIms,ccdNum)
+		assert np.array_equal(ccdIm.data,_ccd_join_stack(ims,ccdNum))
+		assert np.array_equal(ccdIm.mask,_ccd_join_stack(masks,ccdNum))
+		# as with a masked output buffer
+		rv = bokutil.ccd_join(maskedIms,ccdNum,out=ccdIm.copy())
+		assert np.array_equal(rv.mask,ccdIm.mask)
+	for badOut in [np.empty((60,40),np.float32),np.empty((40,60),np.float64)]:
+		with pytest.raises(ValueError):
+			bokutil.ccd_join(ims,1,out=badOut)
+
+class _AddOne(bokutil.BokProcess):
+	def process_hdu(self,extName,data,hdr):
+		return data+1,hdr
+
+def test_process_manifest(tmpdir,monkeypatch):
+	inFile = str(tmpdir.join('im.fits'))
+	outFile = str(tmpdir.join('im_out.fits'))
+	_write_mef(inFile,_images())
+	proc = _AddOne(output_map=lambda f: outFile,header_key='ADDONE')
+	proc.process_file(inFile)
+	def no_open(*args,**kwargs):
+		raise AssertionError('output recorded in manifest was opened')
+	monkeypatch.setattr(bokutil,'BokMefImage',no_open)
+	# recorded as complete, skipped without opening the files
+	assert proc.process_file(inFile) is None
+	proc = _AddOne(output_map=lambda f: outFile,header_key='ADDONE',
+	               ignore_existing=False)
+	with pytest.raises(bokutil.OutputExistsError):
+		proc.process_file(inFile)
+
+def test_resolve_subset():
+	shape = (100,80)
+	arr = np.arange(np.prod(shape)).reshape(shape)
+	for subset in [ np.s_[10:20,5:15], np.s_[-30:,-8:], np.s_[-50:-10:4,::3],
+	                np.s_[::8,-40::10], np.s_[5:,:] ]:
+		readSlices,postSlices = bokutil.resolve_subset(subset,shape)
+		# the block is read with absolute, positive, unit-stride ranges
+		for s,n in zip(readSlices,shape):
+			assert 0 <= s.start < s.stop <= n and s.step is None
+		assert np.all(arr[readSlices][postSlices] == arr[subset])
+
+def test_resolve_subset_unreadable():
+	shape = (100,80)
+	# reversed and empty ranges, integer indexes, wrong dimensions
+	for subset in [ np.s_[::-1,:], np.s_[20:10,:], np.s_[:,-5:-5], 
+	                np.s_[5,:], np.s_[:] ]:
+		assert bokutil.resolve_subset(subset,shape) is None
+
+def test_read_subset(tmpdir):
+	fileName = str(tmpdir.join('im.fits'))
+	arr = np.random.RandomState(1).normal(size=(64,48)).astype(np.float32)
+	fitsio.write(fileName,arr,extname='IM1',clobber=True)
+	hdu = fitsio.FITS(fileName)['IM1']
+	for subset in [ np.s_[10:20,5:15], np.s_[-16::4,-24::3], 
+	                np.s_[::-2,:], np.s_[20:10,:] ]:
+		assert np.array_equal(bokutil.read_subset(hdu,subset),arr[subset])
+		assert np.array_equal(bokutil.read_subset(arr,subset),arr[subset])
+
+def test_lazy_hdu(tmpdir):
+	fileName = str(tmpdir.join('im.fits'))
+	maskFile = str(tmpdir.join('mask.fits'))
+	images = _images()
+	_write_mef(fileName,images)
+	masks = [ (extn,(im>800).astype(np.uint8)) for extn,im in images ]
+	_write_mef(maskFile,masks)
+	statsPix = bokutil.stats_region((5,-5,8,-8),4)
+	for maskFits in [None,maskFile]:
+		fits = bokutil.BokMefImage(fileName,read_only=True,
+		                           mask_file=maskFits)
+		lazy = list(fits.iter_lazy())
+		full = list(fits)
+		for (extn,hdu),(_extn,data,hdr) in zip(lazy,full):
+			assert extn == _extn
+			assert hdu.shape == data.shape
+			assert hdu.header['EXTNAME'] == hdr['EXTNAME']
+			for subset in [statsPix,np.s_[5:-5:3,::2],np.s_[-10:,:]]:
+				assert np.array_equal(hdu[subset],data[subset])
+				if maskFits is not None:
+					assert np.array_equal(hdu[subset].mask,data[subset].mask)
+			assert np.array_equal(hdu.read(),data)
+		fits.close()
+
+def test_convert_dtype():
+	data = np.array([-3.6,0.4,1.5,200.7,300.],dtype=np.float32)
+	assert bokutil.convert_dtype(data,np.float32) is data
+	assert np.array_equal(bokutil.convert_dtype(data,np.uint8),
+	                      [0,0,2,201,255])
+	assert np.array_equal(bokutil.convert_dtype(data,np.int8),
+	                      [-4,0,2,127,127])
+	assert bokutil.convert_dtype(data,np.float64).dtype == np.float64
+
+def _test_data(shape,seed=1):
+	rs = np.random.RandomState(seed)
+	data = rs.normal(100,5,shape).astype(np.float32)
+	# outliers, bad values and masked values
+	data[rs.rand(*shape)<0.02] += 100
+	data[rs.rand(*shape)<0.01] = np.nan
+	mask = rs.rand(*shape) < 0.05
+	return data,mask
+
+def test_sigma_clip_mask():
+	data,mask = _test_data((20,30,15))
+	marr = np.ma.masked_invalid(np.ma.masked_array(data,mask=mask))
+	for axis in [None,0,-1]:
+		for cenfunc in [np.ma.mean,np.ma.median]:
+			for iters in [1,2,None]:
+				kw = dict(clip_sig=2.5,clip_iters=iters,clip_cenfunc=cenfunc)
+				clipMask = bokutil.sigma_clip_mask(data,mask,axis=axis,**kw)
+				ref = sigma_clip(marr,sigma=2.5,iters=iters,cenfunc=cenfunc,
+				                 axis=axis)
+				assert np.array_equal(clipMask,np.ma.getmaskarray(ref))
+
+def test_array_clip():
+	data,mask = _test_data((50,40))
+	marr = np.ma.masked_invalid(np.ma.masked_array(data,mask=mask))
+	clipped = bokutil.array_clip(marr,axis=0,clip_sig=2.0,clip_iters=3)
+	ref = sigma_clip(marr,sigma=2.0,iters=3,cenfunc=np.ma.mean,axis=0)
+	assert np.array_equal(clipped.mask,ref.mask)
+	# the data aren't copied
+	assert np.may_share_memory(clipped.data,marr.data)
+
+def test_masked_median():
+	data,mask = _test_data((21,30,14))
+	# lanes with an even number, one, or no valid values
+	mask[:,0,0] = True
+	mask[1:,1,0] = True
+	mask[2:,2,0] = True
+	marr = np.ma.masked_invalid(np.ma.masked_array(data,mask=mask))
+	for axis in [None,0,1,-1]:
+		med = bokutil.masked_median(marr,axis=axis)
+		ref = np.ma.median(marr,axis=axis)
+		assert np.array_equal(np.ma.getmaskarray(med),np.ma.getmaskarray(ref))
+		assert np.allclose(np.ma.filled(med,0),np.ma.filled(ref,0),rtol=1e-6)
+	# non-finite values are ignored even when not masked
+	med = bokutil.masked_median(np.ma.masked_array(data,mask=mask),axis=0)
+	assert np.allclose(med.filled(0),np.ma.median(marr,axis=0).filled(0))
+	# integer input
+	idata = np.arange(35).reshape(5,7)[::-1]
+	assert np.array_equal(bokutil.masked_median(idata,axis=0),
+	                      np.median(idata,axis=0))
+
+def _write_stack_inputs(tmpdir,shape,n=5):
+	files = []
+	for i in range(n):
+		f = str(tmpdir.join('in%d.fits'%i))
+		_write_mef(f,_images(shape=shape,seed=i+1))
+		files.append(f)
+	return files
+
+def test_plan_chunks(tmpdir):
+	files = _write_stack_inputs(tmpdir,(300,30))
+	maxmem = 2e-4
+	stacker = bokutil.ClippedMeanStack(maxmem=maxmem,processes=3)
+	stacker.fitsCache = bokutil.FitsHandleCache()
+	extensions = ['IM1','IM2','IM3']
+	rowChunks,nProc = stacker._plan_chunks(files,extensions)
+	stacker.fitsCache.close()
+	nbytes = 30*stacker._pixel_bytes(len(files),4)
+	assert 1 <= nProc <= 3
+	for extn in extensions:
+		chunks = rowChunks[extn]
+		assert len(chunks) > 1
+		# the chunks cover every row exactly once
+		assert chunks[0][0] == 0 and chunks[-1][1] == 300
+		assert all( c1[1] == c2[0] for c1,c2 in zip(chunks[:-1],chunks[1:]) )
+		# and the units stacked at the same time fit in maxmem
+		maxRows = max( row2-row1 for row1,row2 in chunks )
+		assert nProc*maxRows*nbytes <= maxmem*1024**3
+	# without a memory limit each extension is a single unit
+	stacker = bokutil.ClippedMeanStack(processes=3)
+	stacker.fitsCache = bokutil.FitsHandleCache()
+	rowChunks,nProc = stacker._plan_chunks(files,extensions)
+	stacker.fitsCache.close()
+	assert rowChunks == { extn:[None] for extn in extensions }
+	assert nProc == 3
+
+def test_stack_chunked(tmpdir):
+	files = _write_stack_inputs(tmpdir,(300,30))
+	outFiles = [ str(tmpdir.join(f)) for f in ['full.fits','chunked.fits'] ]
+	bokutil.ClippedMeanStack().stack(files,outFiles[0])
+	bokutil.ClippedMeanStack(maxmem=2e-4).stack(files,outFiles[1])
+	for extn in ['IM1','IM2','IM3']:
+		assert np.array_equal(fitsio.read(outFiles[0],extn),
+		                      fitsio.read(outFiles[1],extn))
+
+def test_median_stack(tmpdir):
+	files = _write_stack_inputs(tmpdir,(40,30),n=6)
+	maskFiles = {}
+	rs = np.random.RandomState(3)
+	for f in files:
+		maskFiles[f] = f.replace('.fits','_msk.fits')
+		_write_mef(maskFiles[f],[ ('IM%d'%i,(rs.rand(40,30)<0.2)
+		                                         .astype(np.uint8))
+		                             for i in range(1,4) ])
+	# every input masked at one pixel
+	for f in files:
+		fits = fitsio.FITS(maskFiles[f],'rw')
+		msk = fits['IM1'].read()
+		msk[0,0] = 1
+		fits['IM1'].write(msk)
+		fits.close()
+	outFile = str(tmpdir.join('median.fits'))
+	stacker = bokutil.MedianStack(mask_map=lambda f: maskFiles[f])
+	stacker.stack(files,outFile)
+	for extn in ['IM1','IM2','IM3']:
+		cube = np.ma.dstack([ np.ma.masked_array(fitsio.read(f,extn),
+		                           mask=fitsio.read(maskFiles[f],extn)>0)
+		                        for f in files ])
+		ref = np.ma.median(cube,axis=-1).astype(np.float32)
+		stack = fitsio.read(outFile,extn)
+		assert np.array_equal(np.isnan(stack),np.ma.getmaskarray(ref))
+		assert np.allclose(stack[~np.isnan(stack)],ref.compressed())
+
+def test_stack_cube_products():
+	data,mask = _test_data((20,30,8))
+	mask |= ~np.isfinite(data)
+	imCube = np.ma.masked_array(data,mask=mask)
+	imCube.mask[0,0] = True
+	rs = np.random.RandomState(2)
+	weights = rs.rand(8)[np.newaxis,np.newaxis,:] * np.ones(data.shape)
+	expTimes = np.linspace(10,80,8).astype(np.float32)
+	expTimes = expTimes[np.newaxis,np.newaxis,:]
+	stacker = bokutil.ClippedMeanStack(with_variance=True)
+	for w in [None,weights]:
+		stack,nexp,expTime,var = stacker._stack_cube(imCube,w,
+		                                             expTimes=expTimes)
+		mean = np.ma.average(imCube,weights=w,axis=-1)
+		wts = np.ones(data.shape) if w is None else w
+		refVar = np.ma.average((imCube-mean[...,np.newaxis])**2,
+		                       weights=wts,axis=-1)
+		assert np.array_equal(stack.mask,np.ma.getmaskarray(mean))
+		assert np.allclose(stack.compressed(),mean.compressed(),rtol=1e-6)
+		assert np.array_equal(var.mask,np.ma.getmaskarray(refVar))
+		assert np.allclose(var.compressed(),refVar.compressed(),rtol=1e-4)
+		assert np.array_equal(nexp,(~imCube.mask).sum(axis=-1))
+		assert np.allclose(expTime,np.sum(~imCube.mask*expTimes,axis=-1))
+	# no weights gives np.ma.var
+	stack,nexp,expTime,var = stacker._stack_cube(imCube)
+	refVar = np.ma.var(imCube,axis=-1)
+	assert np.allclose(var.compressed(),refVar.compressed(),rtol=1e-4)
+	assert expTime is None
+
+def test_stack_streaming_products(tmpdir):
+	files = _write_stack_inputs(tmpdir,(40,30))
+	outFiles = [ str(tmpdir.join(f)) for f in ['stream.fits','cube.fits'] ]
+	for outFile,streaming in zip(outFiles,[True,False]):
+		stacker = bokutil.ClippedMeanStack(with_variance=True,
+		                  streaming=streaming,
+		                  exposure_time_map=lambda f: f.replace('.fits',
+		                                                        '_exp.fits'))
+		stacker.stack(files,outFile)
+	for extn in ['IM1','IM2','IM3']:
+		for suffix in ['','_var','_exp']:
+			im1,im2 = [ fitsio.read(f.replace('.fits',suffix+'.fits'),extn)
+			              for f in outFiles ]
+			assert np.allclose(im1,im2,rtol=1e-5)
+
+def _minmax_reference(data,mask,nlow,nhigh):
+	# reject the extremes one lane at a time, along the last axis
+	rejmask = mask | ~np.isfinite(data)
+	for idx in np.ndindex(data.shape[:-1]):
+		ii = np.where(~rejmask[idx])[0]
+		ii = ii[np.argsort(data[idx][ii])]
+		rejmask[idx][ii[:nlow]] = True
+		rejmask[idx][ii[len(ii)-nhigh:]] = True
+	return rejmask
+
+def test_minmax_reject():
+	data,mask = _test_data((12,10,7))
+	# a lane with fewer valid values than are rejected
+	mask[0,0,1:] = True
+	for nlow,nhigh in [(1,1),(0,2),(2,0),(2,3)]:
+		rejmask = bokutil.minmax_reject(data,mask,nlow=nlow,nhigh=nhigh)
+		ref = _minmax_reference(data,mask,nlow,nhigh)
+		assert np.array_equal(rejmask,ref)
+		# and along another axis
+		rejmask = bokutil.minmax_reject(data,mask,axis=0,
+		                                nlow=nlow,nhigh=nhigh)
+		ref = _minmax_reference(np.moveaxis(data,0,-1),
+		                        np.moveaxis(mask,0,-1),nlow,nhigh)
+		assert np.array_equal(rejmask,np.moveaxis(ref,-1,0))
+
+def test_normalize_scales(tmpdir):
+	imScales = np.array([1.0,1.2,0.8,1.1,0.9])
+	files = []
+	for i,s in enumerate(imScales):
+		f = str(tmpdir.join('in%d.fits'%i))
+		rs = np.random.RandomState(i)
+		_write_mef(f,[ ('IM%d'%j,(s*(1000+rs.normal(0,1,(300,30))))
+		                             .astype(np.float32))
+		                 for j in range(1,4) ])
+		files.append(f)
+	outFiles = [ str(tmpdir.join(f)) for f in ['full.fits','chunked.fits'] ]
+	stackers = [ bokutil.ClippedMeanStack(scale='normalize_median'),
+	             bokutil.ClippedMeanStack(scale='normalize_median',
+	                                      maxmem=2e-4,processes=2) ]
+	for stacker,outFile in zip(stackers,outFiles):
+		stacker.stack(files,outFile)
+		assert stacker.imStats.shape == (5,3,len(stacker.statNames))
+		assert np.allclose(stacker.scales,imScales.max()/imScales,rtol=1e-3)
+	# the same scales are applied to every chunk
+	assert np.array_equal(stackers[0].scales,stackers[1].scales)
+	for extn in ['IM1','IM2','IM3']:
+		assert np.array_equal(fitsio.read(outFiles[0],extn),
+		                      fitsio.read(outFiles[1],extn))
+
+def test_rolling_stack(tmpdir):
+	files = _write_stack_inputs(tmpdir,(40,30),n=7)
+	rollFile = str(tmpdir.join('rolling.fits'))
+	fullFile = str(tmpdir.join('full.fits'))
+	# wide clipping bounds, so that the frames already in the sums would
+	# not have been clipped differently by a full restack
+	kwargs = dict(clip_sig=10.,with_variance=True,
+	              exposure_time_map=lambda f: f.replace('.fits','_exp.fits'))
+	for frames in [files[:4],files[:6],files[2:6],files[3:]]:
+		bokutil.ClippedMeanStack(rolling=True,**kwargs).stack(frames,
+		                                                      rollFile)
+		bokutil.ClippedMeanStack(clobber=True,**kwargs).stack(frames,
+		                                                      fullFile)
+		for extn in ['IM1','IM2','IM3']:
+			for suffix in ['','_var','_exp']:
+				im1,im2 = [ fitsio.read(f.replace('.fits',suffix+'.fits'),
+				                        extn)
+				              for f in [rollFile,fullFile] ]
+				assert np.allclose(im1,im2,rtol=1e-5)
+	assert bokutil.RollingStackState.exists(rollFile)
+	assert not bokutil.StackCheckpoint.exists(rollFile)
+	# the sums can't follow scales relative to the other frames
+	with pytest.raises(ValueError):
+		bokutil.ClippedMeanStack(rolling=True,
+		                     scale='normalize_median').stack(files,rollFile)